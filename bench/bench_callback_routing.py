@@ -0,0 +1,136 @@
+"""Стоимость маршрутизации нажатия кнопки: цепочка фильтров F.data (до перехода на таблицу маршрутов)
+против одного обработчика с поиском действия в CALLBACK_ROUTES.
+
+Обработчики пустые. "Выбор" - только наблюдатель callback_query (проверка фильтров и вызов обработчика),
+"всего" - полный Dispatcher.feed_update с разбором обновления и middleware, одинаковыми для обеих схем.
+Запуск: python bench/bench_callback_routing.py"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bot-bench-"))
+os.environ.setdefault("ENV_FILE", os.path.join(os.environ["DATA_DIR"], ".env"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Dispatcher, F
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Update
+
+import bot as bot_module
+
+ROUNDS = int(os.getenv("BENCH_ROUNDS", "20000"))
+
+# Фильтры обработчиков нажатий в порядке регистрации до перехода на таблицу маршрутов
+LEGACY_FILTERS = [
+    F.data.startswith("admin_"),
+    F.data.startswith("edit_text_"),
+    F.data == "add_new_text",
+    F.data.startswith("edit_button_text_"),
+    F.data.startswith("edit_button_") & ~F.data.startswith("edit_button_text_"),
+    F.data == "add_new_buttons",
+    F.data.in_(["service_notifications_residence", "service_notifications_gph_conclusion", "service_notifications_gph_termination"]),
+    F.data == "back_to_notifications",
+    F.data.in_(["service_contracts_gph", "service_contracts_rent", "service_contracts_car"]),
+    F.data == "back_to_contracts",
+    F.data.in_(["service_migration_account_main", "service_migration_account_marriage", "service_migration_account_parents"]),
+    F.data == "back_to_migration_account",
+    F.data.startswith("service_"),
+    F.data == "chat_operator",
+    F.data == "back_to_menu",
+    F.data.startswith("accept_dialog_"),
+    F.data.startswith("reply_dialog_"),
+    F.data == "operator_dialogs",
+    F.data.startswith("close_dialog_"),
+    F.data.startswith("delete_dialog_"),
+    F.data == "continue_dialog",
+    F.data.startswith("cancel_user_dialog_"),
+    F.data == "admin_statistics",
+    F.data == "back_to_admin",
+    F.data == "admin_broadcast",
+    (F.data == "confirm_broadcast", bot_module.AdminStates.waiting_broadcast_confirm),
+    F.data == "admin_scheduled_broadcast",
+    (F.data == "confirm_schedule", bot_module.AdminStates.waiting_schedule_confirm),
+]
+
+# Одни и те же нажатия в старом и новом формате callback_data
+SAMPLES = [
+    ("service_patent", "service:patent"),
+    ("back_to_menu", "back_to_menu"),
+    ("accept_dialog_dialog_5_1700000000", "accept_dialog:d5"),
+    ("continue_dialog", "continue_dialog"),
+    ("cancel_user_dialog_dialog_5_1700000000", "cancel_user_dialog:d5"),
+]
+
+
+async def noop(*args, **kwargs):
+    pass
+
+
+def legacy_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=MemoryStorage())
+    for filters in LEGACY_FILTERS:
+        dp.callback_query.register(noop, *(filters if isinstance(filters, tuple) else (filters,)))
+    return dp
+
+
+def table_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=MemoryStorage())
+    routes = {action: noop for action in bot_module.CALLBACK_ROUTES}
+
+    @dp.callback_query()
+    async def route_callback(callback, state):
+        action, _ = bot_module.unpack_callback(callback.data or "")
+        handler = routes.get(action)
+        if handler is not None:
+            await handler(callback, state)
+
+    return dp
+
+
+def callback_update(data: str) -> Update:
+    return Update.model_validate({
+        "update_id": 1,
+        "callback_query": {
+            "id": "q1", "chat_instance": "bench", "data": data,
+            "from": {"id": 500, "is_bot": False, "first_name": "Bench"},
+            "message": {"message_id": 1, "date": int(time.time()), "text": "-", "chat": {"id": 500, "type": "private"}}
+        }
+    })
+
+
+async def measure(dp: Dispatcher, data: str) -> tuple:
+    update = callback_update(data)
+    callback = update.callback_query.as_(bot_module.bot)
+    routing_data = {"bot": bot_module.bot, "raw_state": None, "state": None}
+
+    async def routing():
+        await dp.callback_query.trigger(callback, **routing_data)
+
+    async def full():
+        await dp.feed_update(bot_module.bot, update)
+
+    results = []
+    for step in (routing, full):
+        for _ in range(200):
+            await step()
+        started = time.perf_counter()
+        for _ in range(ROUNDS):
+            await step()
+        results.append((time.perf_counter() - started) / ROUNDS * 1e6)
+    return results
+
+
+async def main():
+    legacy, table = legacy_dispatcher(), table_dispatcher()
+    print(f"{ROUNDS} повторов, время на одно нажатие в мкс")
+    print(f"{'нажатие':24} {'выбор: цепочка':>15} {'таблица':>8} {'всего: цепочка':>15} {'таблица':>8}")
+    for legacy_data, table_data in SAMPLES:
+        routing_before, full_before = await measure(legacy, legacy_data)
+        routing_after, full_after = await measure(table, table_data)
+        print(f"{table_data:24} {routing_before:15.1f} {routing_after:8.1f} {full_before:15.1f} {full_after:8.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+"""Размер и стоимость разбора документа dialogs с ID старого вида (dialog_<user>_<время>) и новыми (d1, d2, ...).
+
+ID диалога повторяется в ключе словаря dialogs и в индексах (pending_dialogs, closed_dialogs,
+operator_closed_dialogs, dialog_activity), а документ читается и разбирается при каждой операции
+с диалогами. Запуск: python bench/bench_dialog_ids.py"""
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from records import format_dialog_id
+
+DIALOGS = int(os.getenv("BENCH_DIALOGS", "20000"))
+MESSAGES = int(os.getenv("BENCH_MESSAGES", "10"))
+ROUNDS = int(os.getenv("BENCH_ROUNDS", "5"))
+BASE_TIME = 1_760_000_000
+OPERATORS = (2, 3, 4)
+
+
+def timestamp(seconds: int) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds))
+
+
+def build_document(new_ids: bool) -> dict:
+    """Документ в том виде, в каком его сохраняет бот: диалоги и индексы по ним"""
+    data = {"dialogs": {}, "user_active_dialogs": {}, "operator_active_dialogs": {}, "pending_dialogs": [],
+            "closed_dialogs": [], "operator_closed_dialogs": {}, "operator_offers": {}, "dialog_activity": {}}
+    if new_ids:
+        data["last_dialog_number"] = DIALOGS
+    for number in range(1, DIALOGS + 1):
+        user_id = 100000 + number
+        created = BASE_TIME + number * 60
+        dialog_id = format_dialog_id(number) if new_ids else f"dialog_{user_id}_{created}"
+        status = ("pending", "active", "closed")[number % 3]
+        operator_id = OPERATORS[number % len(OPERATORS)]
+        dialog = {
+            "user_id": user_id, "user_name": f"Пользователь {number}", "user_phone": f"+7999{number:07d}",
+            "username": f"user{number}", "operator_id": None if status == "pending" else operator_id, "status": status,
+            "created_at": timestamp(created), "button_path": ["Патент", "Оформление"],
+            "messages": [
+                {"from": "user" if index % 2 == 0 else "operator", "text": f"сообщение {index}", "timestamp": timestamp(created + index * 5)}
+                for index in range(MESSAGES)
+            ]
+        }
+        if status == "pending":
+            data["pending_dialogs"].append(dialog_id)
+        else:
+            dialog["accepted_at"] = timestamp(created + 30)
+        if status == "active":
+            data["user_active_dialogs"][str(user_id)] = dialog_id
+            data["operator_active_dialogs"].setdefault(str(operator_id), []).append(dialog_id)
+            data["dialog_activity"][dialog_id] = dialog["messages"][-1]["timestamp"] if dialog["messages"] else dialog["accepted_at"]
+        if status == "closed":
+            dialog["closed_at"] = timestamp(created + 900)
+            data["closed_dialogs"].append(dialog_id)
+            data["operator_closed_dialogs"].setdefault(str(operator_id), []).append(dialog_id)
+        data["dialogs"][dialog_id] = dialog
+    return data
+
+
+def measure(new_ids: bool) -> tuple:
+    raw = json.dumps(build_document(new_ids), ensure_ascii=False)
+    gc.collect()
+    tracemalloc.start()
+    document = json.loads(raw)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del document
+
+    timings = []
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        json.loads(raw)
+        timings.append(time.perf_counter() - started)
+    return len(raw.encode()), memory, min(timings)
+
+
+def main():
+    print(f"{DIALOGS} диалогов по {MESSAGES} сообщений, время разбора - лучшее из {ROUNDS}")
+    print(f"{'ID':24} {'документ, КиБ':>14} {'в памяти, МиБ':>14} {'json.loads, мс':>15} {'callback_data':>14}")
+    for new_ids, example in ((False, f"dialog_{100000 + DIALOGS}_{BASE_TIME + DIALOGS * 60}"), (True, format_dialog_id(DIALOGS))):
+        size, memory, elapsed = measure(new_ids)
+        callback_bytes = len(f"accept_dialog:{example}".encode())
+        print(f"{example:24} {size / 1024:14.0f} {memory / 2 ** 20:14.1f} {elapsed * 1000:15.1f} {callback_bytes:14}")
+
+
+if __name__ == "__main__":
+    main()
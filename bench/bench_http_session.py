@@ -0,0 +1,89 @@
+"""Задержка и пропускная способность запросов к Bot API при разных настройках пула соединений.
+
+Вместо api.telegram.org запросы идут на локальный сервер-заглушку, который отвечает на любой метод
+через SERVER_DELAY секунд (имитация сетевой задержки). Запуск: python bench/bench_http_session.py"""
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bot-bench-"))
+os.environ.setdefault("ENV_FILE", os.path.join(os.environ["DATA_DIR"], ".env"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from bot import TunedAiohttpSession
+
+REQUESTS = int(os.getenv("BENCH_REQUESTS", "3000"))
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "200"))
+SERVER_DELAY = float(os.getenv("BENCH_SERVER_DELAY", "0.02"))
+TOKEN = "123456:BENCH"
+
+
+async def handle_method(request: web.Request) -> web.Response:
+    await asyncio.sleep(SERVER_DELAY)
+    return web.json_response({"ok": True, "result": {
+        "message_id": 1, "date": int(time.time()), "chat": {"id": 1, "type": "private"}, "text": "ok"
+    }})
+
+
+def make_sessions(api: TelegramAPIServer) -> list:
+    no_keepalive = AiohttpSession(api=api)
+    no_keepalive._connector_init.update(force_close=True, limit=100)
+    return [
+        ("aiogram по умолчанию (limit=100)", AiohttpSession(api=api)),
+        ("без keep-alive, limit=100", no_keepalive),
+        ("limit=10, keep-alive 60 с", TunedAiohttpSession(api=api, limit=10, keepalive_timeout=60)),
+        ("limit=100, keep-alive 60 с", TunedAiohttpSession(api=api, limit=100, keepalive_timeout=60)),
+        ("limit=0 (без ограничений), keep-alive 60 с", TunedAiohttpSession(api=api, limit=0, keepalive_timeout=60)),
+    ]
+
+
+async def run(bot: Bot) -> tuple:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            started = time.perf_counter()
+            await bot.send_message(chat_id=1, text="bench")
+            latencies.append(time.perf_counter() - started)
+
+    await bot.send_message(chat_id=1, text="warmup")
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(REQUESTS)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return REQUESTS / elapsed, statistics.median(latencies), latencies[int(len(latencies) * 0.95)]
+
+
+async def main():
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", handle_method)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    api = TelegramAPIServer.from_base(f"http://127.0.0.1:{port}")
+
+    print(f"{REQUESTS} запросов, одновременно до {CONCURRENCY}, задержка сервера {SERVER_DELAY * 1000:.0f} мс")
+    print(f"{'настройки':45} {'запр/с':>8} {'p50, мс':>8} {'p95, мс':>8}")
+    for name, session in make_sessions(api):
+        bot = Bot(token=TOKEN, session=session)
+        try:
+            throughput, p50, p95 = await run(bot)
+        finally:
+            await session.close()
+        print(f"{name:45} {throughput:8.0f} {p50 * 1000:8.1f} {p95 * 1000:8.1f}")
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,156 @@
+"""Нагрузочный тест: пропускная способность 1..N процессов бота с общим хранилищем SQLite.
+
+Процессы bot.py запускаются как в bot@.service (webhook + STORAGE_BACKEND=sqlite, у каждого свой порт),
+Bot API заменён локальным сервером-заглушкой (BOT_API_URL). Генератор, как обратный прокси, раскладывает
+по портам нажатия кнопки раздела каталога от разных пользователей: каждое нажатие читает и пишет
+состояние FSM в общей базе и отвечает answerCallbackQuery. Обновление считается обработанным, когда
+заглушка получила ответ на его callback_query. Запуск: python bench/bench_processes.py"""
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiohttp import ClientSession, web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROCESSES = [int(value) for value in os.getenv("BENCH_PROCESSES", "1,2,4").split(",")]
+UPDATES = int(os.getenv("BENCH_UPDATES", "2000"))
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "100"))
+SERVER_DELAY = float(os.getenv("BENCH_SERVER_DELAY", "0.02"))
+SECRET = "bench-secret"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StandInApi:
+    """Заглушка Bot API: отвечает на любой метод через SERVER_DELAY и запоминает ответы на нажатия"""
+
+    def __init__(self):
+        self.answered = set()
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        data = await request.post()
+        await asyncio.sleep(SERVER_DELAY)
+        if method == "answercallbackquery":
+            self.answered.add(data.get("callback_query_id"))
+            if self.expected and len(self.answered) >= self.expected:
+                self.done.set()
+        if method.startswith(("send", "edit")):
+            chat_id = int(data.get("chat_id") or 0)
+            return web.json_response({"ok": True, "result": {
+                "message_id": int(data.get("message_id") or 1), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": "ok"
+            }})
+        if method == "getme":
+            return web.json_response({"ok": True, "result": {"id": 123456, "is_bot": True, "first_name": "bench"}})
+        return web.json_response({"ok": True, "result": True})
+
+
+def callback_update(number: int, data: str) -> dict:
+    user_id = 100000 + number
+    return {
+        "update_id": number,
+        "callback_query": {
+            "id": f"q{number}",
+            "chat_instance": "bench",
+            "data": data,
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "message": {
+                "message_id": 1, "date": int(time.time()), "text": "menu",
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 123456, "is_bot": True, "first_name": "bench"}
+            }
+        }
+    }
+
+
+async def wait_ready(ports: list, data_dir: str):
+    buttons_file = os.path.join(data_dir, "buttons.json")
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        ready = os.path.exists(buttons_file)
+        for port in ports:
+            try:
+                _, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.close()
+            except OSError:
+                ready = False
+        if ready:
+            return
+        await asyncio.sleep(0.2)
+    raise RuntimeError("процессы бота не запустились")
+
+
+async def run(processes: int) -> tuple:
+    data_dir = tempfile.mkdtemp(prefix="bot-bench-")
+    api = StandInApi()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    api_port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", api_port).start()
+
+    ports = [free_port() for _ in range(processes)]
+    workers = []
+    for port in ports:
+        env = dict(
+            os.environ, DATA_DIR=data_dir, ENV_FILE=os.path.join(data_dir, ".env"), STORAGE_BACKEND="sqlite",
+            BOT_MODE="webhook", WEBHOOK_URL="http://127.0.0.1", WEBHOOK_PATH="/webhook", WEBHOOK_SECRET=SECRET, WEBHOOK_HOST="127.0.0.1",
+            WEBHOOK_PORT=str(port), BOT_API_URL=f"http://127.0.0.1:{api_port}", BOT_TOKEN="123456:BENCH",
+            ADMIN_IDS="1", OPERATOR_IDS="2"
+        )
+        workers.append(subprocess.Popen([sys.executable, os.path.join(ROOT, "bot.py")], cwd=data_dir, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    try:
+        await wait_ready(ports, data_dir)
+        with open(os.path.join(data_dir, "buttons.json"), encoding="utf-8") as f:
+            catalog = json.load(f)["catalog"]
+        node_id = catalog["root"]["children"][0][0]
+
+        api.expected = UPDATES
+        semaphore = asyncio.Semaphore(CONCURRENCY)
+        async with ClientSession() as session:
+            async def post(number: int):
+                port = ports[number % processes]
+                async with semaphore:
+                    async with session.post(f"http://127.0.0.1:{port}/webhook", json=callback_update(number, f"service:{node_id}"),
+                                            headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as response:
+                        response.raise_for_status()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(post(number) for number in range(1, UPDATES + 1)))
+            await asyncio.wait_for(api.done.wait(), timeout=300)
+            elapsed = time.perf_counter() - started
+        # Даём процессам дописать сообщения после ответа на нажатие, чтобы не рвать их запросы
+        await asyncio.sleep(1)
+        return UPDATES / elapsed, elapsed
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+        await runner.cleanup()
+
+
+async def main():
+    print(f"{UPDATES} нажатий, одновременно до {CONCURRENCY}, задержка Bot API {SERVER_DELAY * 1000:.0f} мс, CPU: {os.cpu_count()}")
+    print(f"{'процессов':>9} {'обн/с':>8} {'время, с':>9}")
+    for processes in PROCESSES:
+        throughput, elapsed = await run(processes)
+        print(f"{processes:>9} {throughput:8.0f} {elapsed:9.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
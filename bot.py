@@ -1,25 +1,472 @@
 import asyncio
+import bisect
+import contextlib
+import csv
+import dataclasses
+import hashlib
+import heapq
+import html
 import json
 import os
+import re
+import signal
+import socket
+import sqlite3
+import string
+import tempfile
+import time
+import zlib
 import aiofiles
-from datetime import datetime
+from dotenv import dotenv_values
+from datetime import datetime, timedelta
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, MenuButtonCommands
+from aiogram.types import Update, Message, MessageId, CallbackQuery, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, MenuButtonCommands
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+try:
+    import fcntl
+except ImportError:  # Windows - межпроцессные блокировки недоступны
+    fcntl = None
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from config import BOT_TOKEN, ADMIN_ID, ADMIN_IDS, OPERATOR_ID, OPERATOR_IDS, DATA_DIR, TEXTS_FILE, BUTTONS_FILE, PHONES_FILE, NOTIFICATION_CHAT_ID, DIALOGS_FILE
+from config import BOT_TOKEN, ADMIN_ID, ADMIN_IDS, OPERATOR_ID, OPERATOR_IDS, DATA_DIR, TEXTS_FILE, BUTTONS_FILE, PHONES_FILE, NOTIFICATION_CHAT_ID, DIALOGS_FILE, RELAY_MERGE_WINDOW
+from config import BOT_API_URL, BOT_API_LOCAL, HTTP_POOL_LIMIT, HTTP_KEEPALIVE_TIMEOUT, HTTP_TIMEOUT
+from config import BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT
+from config import MAX_CONCURRENT_UPDATES, STORAGE_BACKEND, SQLITE_FILE, LOCKS_DIR, SCHEDULED_FILE, LEADER_LEASE_TTL, PROCESS_BACKLOG
+from config import THROTTLE_CALLBACK_BURST, THROTTLE_CALLBACK_RATE, THROTTLE_MESSAGE_BURST, THROTTLE_MESSAGE_RATE, CALLBACK_DEDUP_TTL
+from config import MENU_EDIT_IN_PLACE, DEFAULTS_FILE, LOCALES, DEFAULT_LOCALE
+from config import DASHBOARD_PAGE_SIZE, SEARCH_FILE
+from config import ENV_FILE, CONFIG_RELOAD_INTERVAL, DEFAULT_ADMIN_IDS, DEFAULT_OPERATOR_IDS, PROCESS_ENV, parse_ids
+from config import ASSIGNMENT_POLICY, OPERATOR_CAPACITY, ASSIGNMENT_TIMEOUT, OPERATOR_SKILLS, parse_skills
+from config import SLA_PENDING_TIMEOUT, SLA_ESCALATE_TIMEOUT, DIALOG_IDLE_TIMEOUT
+from config import OPERATOR_ACTIVE_WINDOW, PRESENCE_FILE
+from records import format_dialog_id
 
 # Создаём директорию для данных, если её нет
 os.makedirs(DATA_DIR, exist_ok=True)
+os.makedirs(LOCKS_DIR, exist_ok=True)
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+
+# Межпроцессная блокировка: asyncio.Lock внутри процесса + fcntl.flock между процессами
+class FileLock:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = asyncio.Lock()
+        self._fd = None
+    
+    async def __aenter__(self):
+        await self._lock.acquire()
+        if fcntl is None:
+            return self
+        
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Не блокируем event loop: пробуем взять блокировку, пока не получится
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(0.005)
+        except BaseException:
+            os.close(fd)
+            self._lock.release()
+            raise
+        
+        self._fd = fd
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+
+# Блокировки для операций "прочитать-изменить-записать"
+dialogs_lock = FileLock(os.path.join(LOCKS_DIR, "dialogs.lock"))
+phones_lock = FileLock(os.path.join(LOCKS_DIR, "phones.lock"))
+scheduled_lock = FileLock(os.path.join(LOCKS_DIR, "scheduled.lock"))
+
+# Блокировки пользователей между процессами (по корзинам, чтобы не плодить файлы)
+USER_LOCK_BUCKETS = 1024
+user_file_locks = {}
+
+
+def get_user_file_lock(user_id: int) -> FileLock:
+    bucket = user_id % USER_LOCK_BUCKETS
+    if bucket not in user_file_locks:
+        user_file_locks[bucket] = FileLock(os.path.join(LOCKS_DIR, f"user_{bucket}.lock"))
+    return user_file_locks[bucket]
+
+
+# Общее хранилище SQLite (режим WAL) для работы нескольких процессов бота
+def get_db_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(SQLITE_FILE, timeout=30)
+    conn.execute("PRAGMA busy_timeout=30000")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+def init_db():
+    """Создает таблицы общего хранилища и переносит в него данные из JSON-файлов"""
+    conn = get_db_connection()
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS documents (name TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT)")
+        
+        # Однократный перенос существующих данных
+        for name, path in (("dialogs", DIALOGS_FILE), ("phones", PHONES_FILE), ("scheduled", SCHEDULED_FILE), ("presence", PRESENCE_FILE)):
+            exists = conn.execute("SELECT 1 FROM documents WHERE name = ?", (name,)).fetchone()
+            if not exists and os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    content = f.read()
+                conn.execute("INSERT INTO documents (name, data) VALUES (?, ?)", (name, content))
+                print(f"[STORAGE] {path} перенесён в {SQLITE_FILE}")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def db_read_document(name: str) -> str | None:
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT data FROM documents WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+    finally:
+        conn.close()
+
+
+def db_write_document(name: str, content: str):
+    conn = get_db_connection()
+    try:
+        conn.execute(
+            "INSERT INTO documents (name, data) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET data = excluded.data",
+            (name, content)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# Хранилище состояний FSM в общей базе SQLite
+class SQLiteStorage(BaseStorage):
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:{key.business_connection_id}:{key.destiny}"
+    
+    @staticmethod
+    def _execute(query: str, params: tuple, fetch: bool = False):
+        conn = get_db_connection()
+        try:
+            cursor = conn.execute(query, params)
+            if fetch:
+                return cursor.fetchone()
+            conn.commit()
+        finally:
+            conn.close()
+    
+    async def set_state(self, key: StorageKey, state=None):
+        state = state.state if isinstance(state, State) else state
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO fsm (key, state) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET state = excluded.state",
+            (self._key(key), state)
+        )
+    
+    async def get_state(self, key: StorageKey) -> str | None:
+        row = await asyncio.to_thread(self._execute, "SELECT state FROM fsm WHERE key = ?", (self._key(key),), True)
+        return row[0] if row else None
+    
+    async def set_data(self, key: StorageKey, data: dict):
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO fsm (key, data) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET data = excluded.data",
+            (self._key(key), json.dumps(data, ensure_ascii=False))
+        )
+    
+    async def get_data(self, key: StorageKey) -> dict:
+        row = await asyncio.to_thread(self._execute, "SELECT data FROM fsm WHERE key = ?", (self._key(key),), True)
+        return json.loads(row[0]) if row and row[0] else {}
+    
+    async def close(self):
+        pass
+
+
+if STORAGE_BACKEND == "sqlite":
+    init_db()
+
+
+# HTTP-сессия с настраиваемым пулом соединений
+class TunedAiohttpSession(AiohttpSession):
+    def __init__(self, limit: int = 100, keepalive_timeout: float = 15, **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init.update(
+            limit=limit,
+            keepalive_timeout=keepalive_timeout,
+            ttl_dns_cache=3600
+        )
+
+
+def create_bot_session() -> AiohttpSession:
+    """Создает HTTP-сессию бота по настройкам из config.py"""
+    if BOT_API_URL:
+        api = TelegramAPIServer.from_base(BOT_API_URL, is_local=BOT_API_LOCAL)
+    else:
+        api = PRODUCTION
+    
+    return TunedAiohttpSession(
+        api=api,
+        timeout=HTTP_TIMEOUT,
+        limit=HTTP_POOL_LIMIT,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+    )
+
+
+bot = Bot(token=BOT_TOKEN, session=create_bot_session())
+dp = Dispatcher(storage=SQLiteStorage() if STORAGE_BACKEND == "sqlite" else MemoryStorage())
 scheduler = AsyncIOScheduler()
 
+# Последний известный message_id в недавних чатах (нужен, чтобы понять, что наше сообщение всё ещё последнее).
+# Словарь хранит порядок обращений, давно молчащие чаты вытесняются: для них пересылка просто не объединяется
+chat_last_message_id = {}
+CHAT_TRACKING_LIMIT = 10000
+
+# Пересылки сообщений пользователей операторам: (dialog_id, chat_id оператора) -> данные пересылки
+dialog_relays = {}
+
+
+def remember_chat_message(chat_id: int, message_id: int):
+    """Запоминает последний message_id в чате"""
+    last_message_id = chat_last_message_id.pop(chat_id, 0)
+    chat_last_message_id[chat_id] = max(last_message_id, message_id)
+    if len(chat_last_message_id) > CHAT_TRACKING_LIMIT:
+        del chat_last_message_id[next(iter(chat_last_message_id))]
+
+
+def forget_dialog_relays(dialog_id: str):
+    """Удаляет данные пересылок закрытого или удалённого диалога"""
+    for key in [key for key in dialog_relays if key[0] == dialog_id]:
+        del dialog_relays[key]
+
+
+# Отслеживаем сообщения, отправленные ботом
+@bot.session.middleware
+async def track_sent_messages(make_request, bot, method):
+    result = await make_request(bot, method)
+    if isinstance(result, Message):
+        remember_chat_message(result.chat.id, result.message_id)
+    elif isinstance(result, MessageId) and isinstance(getattr(method, "chat_id", None), int):
+        remember_chat_message(method.chat_id, result.message_id)
+    elif isinstance(result, list) and result and isinstance(result[-1], MessageId) and isinstance(getattr(method, "chat_id", None), int):
+        remember_chat_message(method.chat_id, max(message_id.message_id for message_id in result))
+    return result
+
+
+# Очередь обработки обновлений: обновления одного пользователя обрабатываются строго по порядку,
+# разные пользователи - параллельно (не более MAX_CONCURRENT_UPDATES одновременно)
+update_semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+
+# user_id -> {"lock": asyncio.Lock, "depth": число обновлений пользователя в очереди и в работе}
+user_update_queues = {}
+
+dispatch_metrics = {
+    "waiting": 0,          # Обновлений ждут своей очереди
+    "running": 0,          # Обновлений обрабатывается сейчас
+    "processed": 0,        # Всего обработано
+    "max_user_depth": 0,   # Максимальная длина очереди одного пользователя
+    "wait_total": 0.0,     # Суммарное время ожидания, сек
+    "wait_max": 0.0        # Максимальное время ожидания, сек
+}
+
+
+async def ordered_updates_middleware(handler, event, data: dict):
+    user = data.get("event_from_user")
+    queue = None
+    if user:
+        queue = user_update_queues.setdefault(user.id, {"lock": asyncio.Lock(), "depth": 0})
+        queue["depth"] += 1
+        dispatch_metrics["max_user_depth"] = max(dispatch_metrics["max_user_depth"], queue["depth"])
+    
+    dispatch_metrics["waiting"] += 1
+    queued_at = time.monotonic()
+    started = False
+    try:
+        if queue:
+            await queue["lock"].acquire()
+        try:
+            async with update_semaphore, user_process_lock(user):
+                started = True
+                wait_time = time.monotonic() - queued_at
+                dispatch_metrics["waiting"] -= 1
+                dispatch_metrics["running"] += 1
+                dispatch_metrics["wait_total"] += wait_time
+                dispatch_metrics["wait_max"] = max(dispatch_metrics["wait_max"], wait_time)
+                try:
+                    return await handler(event, data)
+                finally:
+                    dispatch_metrics["running"] -= 1
+                    dispatch_metrics["processed"] += 1
+        finally:
+            if queue:
+                queue["lock"].release()
+    finally:
+        if not started:
+            dispatch_metrics["waiting"] -= 1
+        if queue:
+            queue["depth"] -= 1
+            if queue["depth"] == 0:
+                user_update_queues.pop(user.id, None)
+
+
+def user_process_lock(user):
+    """Блокировка пользователя между процессами: при общем хранилище обновления одного
+    пользователя не должны обрабатываться в разных процессах одновременно"""
+    if user and STORAGE_BACKEND == "sqlite":
+        return get_user_file_lock(user.id)
+    return contextlib.nullcontext()
+
+
+# Ограничение частоты запросов: у каждого пользователя свои корзины токенов для нажатий и сообщений
+# (user_id, вид) -> (токенов осталось, время последнего обновления)
+throttle_buckets = {}
+# Сколько корзин держать в памяти, прежде чем удалить полностью восстановившиеся
+THROTTLE_MAX_BUCKETS = 10000
+
+throttle_metrics = {
+    "callback": 0,     # Отклонено нажатий кнопок
+    "message": 0       # Отклонено сообщений
+}
+# user_id -> число отклонённых обновлений
+throttled_users = {}
+
+# Решения по альбомам: media_group_id -> (пропущен ли, время первой части)
+throttled_media_groups = {}
+MEDIA_GROUP_TTL = 10
+
+
+def take_throttle_token(key: tuple, burst: int, rate: float) -> bool:
+    """Списывает токен из корзины, возвращает False, если лимит исчерпан"""
+    now = time.monotonic()
+    bucket = throttle_buckets.get(key)
+    tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * rate)
+    allowed = tokens >= 1
+    throttle_buckets[key] = (tokens - 1 if allowed else tokens, now)
+
+    if len(throttle_buckets) > THROTTLE_MAX_BUCKETS:
+        prune_throttle_buckets(now)
+    return allowed
+
+
+def media_group_allowed(media_group_id: str) -> bool | None:
+    """Решение по первой части альбома для остальных частей (None - часть первая)"""
+    now = time.monotonic()
+    if len(throttled_media_groups) > THROTTLE_MAX_BUCKETS:
+        for group_id, (_, seen_at) in list(throttled_media_groups.items()):
+            if now - seen_at > MEDIA_GROUP_TTL:
+                del throttled_media_groups[group_id]
+    decision = throttled_media_groups.get(media_group_id)
+    return decision[0] if decision and now - decision[1] <= MEDIA_GROUP_TTL else None
+
+
+def prune_throttle_buckets(now: float):
+    """Удаляет корзины, которые успели восстановиться полностью"""
+    limits = {
+        "callback": (THROTTLE_CALLBACK_BURST, THROTTLE_CALLBACK_RATE),
+        "message": (THROTTLE_MESSAGE_BURST, THROTTLE_MESSAGE_RATE)
+    }
+    for key, (tokens, updated_at) in list(throttle_buckets.items()):
+        burst, rate = limits[key[1]]
+        if tokens + (now - updated_at) * rate >= burst:
+            del throttle_buckets[key]
+
+
+async def throttling_middleware(handler, event: Update, data: dict):
+    user = data.get("event_from_user")
+    if event.callback_query:
+        kind, burst, rate = "callback", THROTTLE_CALLBACK_BURST, THROTTLE_CALLBACK_RATE
+    elif event.message:
+        kind, burst, rate = "message", THROTTLE_MESSAGE_BURST, THROTTLE_MESSAGE_RATE
+    else:
+        return await handler(event, data)
+
+    # Накопившиеся за время остановки обновления (process_backlog) не ограничиваются: пользователь
+    # отправил их с обычной скоростью, а сообщения диалога из очереди должны дойти до операторов
+    if not user or burst <= 0 or data.get("backlog") or is_admin_or_operator(user.id):
+        return await handler(event, data)
+    
+    # Альбом приходит отдельными сообщениями с общим media_group_id: токен списывается только за первую часть
+    media_group_id = event.message.media_group_id if kind == "message" else None
+    allowed = media_group_allowed(media_group_id) if media_group_id else None
+    if allowed is None:
+        allowed = take_throttle_token((user.id, kind), burst, rate)
+        if media_group_id:
+            throttled_media_groups[media_group_id] = (allowed, time.monotonic())
+    if allowed:
+        return await handler(event, data)
+
+    throttle_metrics[kind] += 1
+    throttled_users[user.id] = throttled_users.get(user.id, 0) + 1
+    # Обновление отбрасывается до очереди и обработчиков: без чтения файлов и новых сообщений
+    if kind == "callback":
+        try:
+            await event.callback_query.answer("⏳ Слишком часто, подождите немного")
+        except Exception:
+            pass
+
+
+def get_throttle_metrics() -> dict:
+    """Возвращает счётчики ограничения частоты запросов"""
+    top_user = max(throttled_users.items(), key=lambda item: item[1], default=(None, 0))
+    return {
+        "callbacks": throttle_metrics["callback"],
+        "messages": throttle_metrics["message"],
+        "users": len(throttled_users),
+        "top_user_id": top_user[0],
+        "top_user_count": top_user[1]
+    }
+
+
+# Состояние FSM читается в FSMContextMiddleware, поэтому очередь должна стоять перед ним.
+# Ограничение частоты стоит первым, чтобы лишние обновления не занимали очередь пользователя.
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(throttling_middleware)
+dp.update.outer_middleware(ordered_updates_middleware)
+dp.update.outer_middleware(dp.fsm)
+
+
+def get_dispatch_metrics() -> dict:
+    """Возвращает метрики очереди обработки обновлений"""
+    processed = dispatch_metrics["processed"]
+    return {
+        "waiting": dispatch_metrics["waiting"],
+        "running": dispatch_metrics["running"],
+        "processed": processed,
+        "users_in_queue": len(user_update_queues),
+        "max_user_depth": dispatch_metrics["max_user_depth"],
+        "wait_avg": dispatch_metrics["wait_total"] / processed if processed else 0.0,
+        "wait_max": dispatch_metrics["wait_max"]
+    }
+
+
+# Отслеживаем входящие сообщения
+@dp.message.outer_middleware()
+async def track_incoming_messages(handler, event: Message, data: dict):
+    remember_chat_message(event.chat.id, event.message_id)
+    return await handler(event, data)
+
 
 # Состояния для админки
 class AdminStates(StatesGroup):
@@ -51,14 +498,44 @@ class OperatorStates(StatesGroup):
     replying_to_dialog = State()  # Оператор отвечает в диалоге
 
 
+# Запись JSON-файла целиком: сначала во временный файл, затем атомарная замена,
+# чтобы параллельное чтение никогда не видело наполовину записанный файл
+async def write_json_file(path: str, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+        await f.write(json.dumps(data, ensure_ascii=False, indent=2))
+    os.replace(tmp_path, path)
+
+
+# Тексты хранятся в памяти разобранным словарём; файл перечитывается только фоновой проверкой
+# изменений (reload_config), поэтому обработчики файлы не читают. Словарь нельзя менять на месте -
+# перед правкой нужно сделать копию и сохранить её через save_texts
+texts_cache = {"mtime": None, "texts": {}, "version": 0}
+# Ключ в texts.json с хешем файла умолчаний, который уже был добавлен
+DEFAULTS_HASH_KEY = "_defaults_hash"
+
+
 # Загрузка данных
-async def load_texts():
+async def load_texts(refresh: bool = False):
+    if texts_cache["mtime"] is not None and not refresh:
+        return texts_cache["texts"]
+    try:
+        mtime = os.stat(TEXTS_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if mtime == texts_cache["mtime"]:
+        return texts_cache["texts"]
+    
     try:
         async with aiofiles.open(TEXTS_FILE, 'r', encoding='utf-8') as f:
             content = await f.read()
-            return json.loads(content)
+            texts = json.loads(content)
     except (FileNotFoundError, json.JSONDecodeError):
         return {}
+    texts_cache["mtime"] = mtime
+    texts_cache["texts"] = texts
+    texts_cache["version"] += 1
+    return texts
 
 
 async def load_buttons():
@@ -72,18 +549,143 @@ async def load_buttons():
 
 # Сохранение данных
 async def save_texts(data):
-    async with aiofiles.open(TEXTS_FILE, 'w', encoding='utf-8') as f:
-        await f.write(json.dumps(data, ensure_ascii=False, indent=2))
+    await write_json_file(TEXTS_FILE, data)
+    texts_cache["mtime"] = os.stat(TEXTS_FILE).st_mtime_ns
+    texts_cache["texts"] = data
+    texts_cache["version"] += 1
+
+
+async def merge_default_texts() -> bool:
+    """Добавляет в texts.json отсутствующие тексты из файла умолчаний, если файл изменился с прошлого запуска"""
+    try:
+        async with aiofiles.open(DEFAULTS_FILE, 'rb') as f:
+            raw = await f.read()
+    except FileNotFoundError:
+        print(f"[TEXTS] Файл текстов по умолчанию не найден: {DEFAULTS_FILE}")
+        return False
+    
+    defaults_hash = hashlib.sha256(raw).hexdigest()
+    texts = await load_texts()
+    if texts.get(DEFAULTS_HASH_KEY) == defaults_hash:
+        return False
+    
+    # Тексты, изменённые через админку, не перезаписываются
+    defaults = json.loads(raw).get("texts", {})
+    await save_texts({**defaults, **texts, DEFAULTS_HASH_KEY: defaults_hash})
+    return True
+
+
+# Языки пользователей: явный выбор через /language или language_code из Telegram.
+# Переводы лежат в texts.json под ключами "ключ.язык" (например, service_rvp.uz), без перевода
+# показывается текст основного языка. Выбор хранится в отдельной записи FSM (её не стирает
+# state.clear()) и кэшируется в памяти на LOCALE_CACHE_TTL секунд: выбор, сделанный в другом процессе,
+# подхватывается после истечения записи. Кэш ограничен LOCALE_CACHE_LIMIT пользователями, давно не писавшие вытесняются
+LOCALE_CACHE_TTL = 60
+LOCALE_CACHE_LIMIT = 10000
+user_locales = {}
+LOCALE_NAMES = {
+    "ru": "🇷🇺 Русский",
+    "uz": "🇺🇿 O‘zbekcha",
+    "tg": "🇹🇯 Тоҷикӣ",
+    "ky": "🇰🇬 Кыргызча"
+}
+DEFAULT_WELCOME_MESSAGE = "👋 Добро пожаловать, {name}!\n\n✨ Мы рады приветствовать вас в нашем сервисе!"
+
+
+def locale_from_language_code(language_code: str) -> str:
+    """Язык интерфейса по коду языка Telegram (uz, ru-RU, ...)"""
+    code = (language_code or "").split("-")[0].lower()
+    return code if code in LOCALES else DEFAULT_LOCALE
+
+
+def locale_storage_key(state: FSMContext) -> StorageKey:
+    return dataclasses.replace(state.key, destiny="locale")
+
+
+async def get_user_locale(user, state: FSMContext) -> str:
+    """Язык пользователя: выбранный явно, иначе по language_code"""
+    locale, cached_at = user_locales.get(user.id, (None, None))
+    if cached_at is None or time.monotonic() - cached_at > LOCALE_CACHE_TTL:
+        data = await state.storage.get_data(locale_storage_key(state))
+        locale, cached_at = data.get("locale"), time.monotonic()
+    remember_user_locale(user.id, locale, cached_at)
+    return locale or locale_from_language_code(user.language_code)
+
+
+def remember_user_locale(user_id: int, locale: str | None, cached_at: float):
+    """Кладёт язык в кэш последним, вытесняя самую старую запись при переполнении"""
+    user_locales.pop(user_id, None)
+    user_locales[user_id] = (locale, cached_at)
+    if len(user_locales) > LOCALE_CACHE_LIMIT:
+        del user_locales[next(iter(user_locales))]
+
+
+async def set_user_locale(user_id: int, state: FSMContext, locale: str):
+    await state.storage.set_data(locale_storage_key(state), {"locale": locale})
+    remember_user_locale(user_id, locale, time.monotonic())
+
+
+def localized(texts: dict, key: str, locale: str, default: str = None) -> str:
+    """Текст на языке пользователя, без перевода - на основном языке"""
+    if locale != DEFAULT_LOCALE:
+        value = texts.get(f"{key}.{locale}")
+        if value is not None:
+            return value
+    return texts.get(key, default)
+
+
+# Разобранные шаблоны по (ключ, язык) для текущей версии текстов; после перезагрузки текстов кэш сбрасывается
+template_cache = {"version": None, "templates": {}}
+
+
+def compile_template(template: str) -> list:
+    """Разбирает шаблон в формате str.format один раз: [(литерал, поле, формат)]"""
+    try:
+        return [(literal, field, spec) for literal, field, spec, _ in string.Formatter().parse(template)]
+    except ValueError:
+        # Непарные фигурные скобки в тексте из админки - показываем текст как есть
+        return [(template, None, "")]
+
+
+def render_text(texts: dict, key: str, locale: str, default: str, **values) -> str:
+    """Текст по ключу на языке пользователя с подстановкой values; неизвестные поля остаются как есть"""
+    if template_cache["version"] != texts_cache["version"]:
+        template_cache["version"] = texts_cache["version"]
+        template_cache["templates"] = {}
+    parts = template_cache["templates"].get((key, locale))
+    if parts is None:
+        parts = compile_template(localized(texts, key, locale, default))
+        template_cache["templates"][(key, locale)] = parts
+    
+    result = []
+    for literal, field, spec in parts:
+        result.append(literal)
+        if field is None:
+            continue
+        placeholder = "{" + field + (":" + spec if spec else "") + "}"
+        if field not in values:
+            result.append(placeholder)
+            continue
+        try:
+            result.append(format(values[field], spec))
+        except (ValueError, TypeError):
+            # Формат из админки не подходит к значению ({name:d}, вложенное {name:{w}}) - оставляем поле как есть
+            result.append(placeholder)
+    return "".join(result)
 
 
 async def save_buttons(data):
-    async with aiofiles.open(BUTTONS_FILE, 'w', encoding='utf-8') as f:
-        await f.write(json.dumps(data, ensure_ascii=False, indent=2))
+    await write_json_file(BUTTONS_FILE, data)
+    # Индекс каталога перестроится при следующем обращении
+    catalog_cache["nodes"] = {}
 
 
 # Загрузка и сохранение номеров телефонов пользователей
 async def load_phones():
     try:
+        if STORAGE_BACKEND == "sqlite":
+            content = await asyncio.to_thread(db_read_document, "phones")
+            return json.loads(content) if content else {}
         async with aiofiles.open(PHONES_FILE, 'r', encoding='utf-8') as f:
             content = await f.read()
             return json.loads(content)
@@ -92,138 +694,539 @@ async def load_phones():
 
 
 async def save_phones(data):
-    async with aiofiles.open(PHONES_FILE, 'w', encoding='utf-8') as f:
-        await f.write(json.dumps(data, ensure_ascii=False, indent=2))
+    if STORAGE_BACKEND == "sqlite":
+        await asyncio.to_thread(db_write_document, "phones", json.dumps(data, ensure_ascii=False))
+        return
+    await write_json_file(PHONES_FILE, data)
 
 
 # Загрузка и сохранение диалогов
 async def load_dialogs():
     try:
+        if STORAGE_BACKEND == "sqlite":
+            content = await asyncio.to_thread(db_read_document, "dialogs")
+            if content:
+                return ensure_dialog_indexes(json.loads(content))
+            raise FileNotFoundError
         async with aiofiles.open(DIALOGS_FILE, 'r', encoding='utf-8') as f:
             content = await f.read()
-            return json.loads(content)
+            return ensure_dialog_indexes(json.loads(content))
     except (FileNotFoundError, json.JSONDecodeError):
         return {
             "dialogs": {},
             "user_active_dialogs": {},
-            "operator_active_dialogs": {}
+            "operator_active_dialogs": {},
+            "pending_dialogs": [],
+            "closed_dialogs": [],
+            "operator_closed_dialogs": {},
+            "operator_offers": {},
+            "dialog_activity": {}
         }
 
 
+def ensure_dialog_indexes(dialogs_data: dict) -> dict:
+    """Строит индексы для списков диалогов, если их ещё нет в файле:
+    pending_dialogs - ожидающие в порядке создания, closed_dialogs и operator_closed_dialogs - закрытые
+    в порядке закрытия (новые в конце, поэтому позиции старых записей не сдвигаются),
+    operator_offers - диалоги, предложенные оператору и ещё не принятые,
+    dialog_activity - принятые диалоги и время их последнего сообщения, давно молчащие первыми"""
+    dialogs_data.setdefault("operator_offers", {})
+    if "dialog_activity" not in dialogs_data:
+        activity = {}
+        for dialog_id, dialog in dialogs_data["dialogs"].items():
+            if dialog["status"] == "active":
+                messages = dialog.get("messages") or []
+                activity[dialog_id] = messages[-1]["timestamp"] if messages else dialog.get("accepted_at", "")
+        dialogs_data["dialog_activity"] = dict(sorted(activity.items(), key=lambda item: item[1]))
+    if "closed_dialogs" in dialogs_data:
+        return dialogs_data
+    
+    dialogs = dialogs_data["dialogs"]
+    dialogs_data["pending_dialogs"] = [dialog_id for dialog_id, dialog in dialogs.items() if dialog["status"] == "pending"]
+    closed = sorted(
+        (dialog_id for dialog_id, dialog in dialogs.items() if dialog["status"] == "closed"),
+        key=lambda dialog_id: dialogs[dialog_id].get("closed_at", "")
+    )
+    dialogs_data["closed_dialogs"] = closed
+    operator_closed = {}
+    for dialog_id in closed:
+        operator_id = dialogs[dialog_id].get("operator_id")
+        if operator_id:
+            operator_closed.setdefault(str(operator_id), []).append(dialog_id)
+    dialogs_data["operator_closed_dialogs"] = operator_closed
+    return dialogs_data
+
+
+def discard_from_index(dialog_ids: list, dialog_id: str):
+    if dialog_id in dialog_ids:
+        dialog_ids.remove(dialog_id)
+
+
+def touch_dialog_activity(dialogs_data: dict, dialog_id: str, timestamp: str):
+    """Переносит диалог в конец индекса активности (словарь хранит порядок вставки)"""
+    activity = dialogs_data["dialog_activity"]
+    activity.pop(dialog_id, None)
+    activity[dialog_id] = timestamp
+
+
 async def save_dialogs(data):
-    async with aiofiles.open(DIALOGS_FILE, 'w', encoding='utf-8') as f:
-        await f.write(json.dumps(data, ensure_ascii=False, indent=2))
+    if STORAGE_BACKEND == "sqlite":
+        await asyncio.to_thread(db_write_document, "dialogs", json.dumps(data, ensure_ascii=False))
+        return
+    await write_json_file(DIALOGS_FILE, data)
+
+
+# Загрузка и сохранение отложенных рассылок
+async def load_scheduled_broadcasts():
+    try:
+        if STORAGE_BACKEND == "sqlite":
+            content = await asyncio.to_thread(db_read_document, "scheduled")
+            return json.loads(content) if content else {}
+        async with aiofiles.open(SCHEDULED_FILE, 'r', encoding='utf-8') as f:
+            content = await f.read()
+            return json.loads(content)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+async def save_scheduled_broadcasts(data):
+    if STORAGE_BACKEND == "sqlite":
+        await asyncio.to_thread(db_write_document, "scheduled", json.dumps(data, ensure_ascii=False))
+        return
+    await write_json_file(SCHEDULED_FILE, data)
+
+
+# Роли пользователей. Множества заменяются целиком при перечитывании .env (reload_roles),
+# поэтому обработчик всегда видит согласованный набор и не читает файлы
+roles = {
+    "admins": frozenset(ADMIN_IDS),
+    "operators": frozenset(OPERATOR_IDS),
+    "skills": OPERATOR_SKILLS
+}
+env_cache = {"mtime": None}
+
+
+def reload_roles(force: bool = False) -> bool:
+    """Перечитывает ADMIN_IDS, OPERATOR_IDS и OPERATOR_SKILLS из .env, если файл изменился. Возвращает True, если роли обновлены"""
+    try:
+        mtime = os.stat(ENV_FILE).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime == env_cache["mtime"] and not force:
+        return False
+    env_cache["mtime"] = mtime
+    
+    # Значения из файла важнее окружения. os.getenv не подходит: load_dotenv записал в окружение значения
+    # из .env на момент запуска, и удалённый из файла ID сохранил бы доступ. Берём окружение до загрузки .env
+    values = dotenv_values(ENV_FILE) if mtime is not None else {}
+    admins = frozenset(parse_ids(values.get("ADMIN_IDS") or PROCESS_ENV.get("ADMIN_IDS", DEFAULT_ADMIN_IDS)))
+    operators = frozenset(parse_ids(values.get("OPERATOR_IDS") or PROCESS_ENV.get("OPERATOR_IDS", DEFAULT_OPERATOR_IDS)))
+    skills = parse_skills(values.get("OPERATOR_SKILLS") or PROCESS_ENV.get("OPERATOR_SKILLS", ""))
+    if admins == roles["admins"] and operators == roles["operators"] and skills == roles["skills"]:
+        return False
+    
+    removed_admins = sorted(roles["admins"] - admins)
+    removed_operators = sorted(roles["operators"] - operators)
+    roles["admins"] = admins
+    roles["operators"] = operators
+    roles["skills"] = skills
+    print(f"[CONFIG] Роли обновлены: админов {len(admins)}, операторов {len(operators)}")
+    if removed_admins or removed_operators:
+        print(f"[CONFIG] Доступ отозван: админы {removed_admins}, операторы {removed_operators}")
+    return True
+
+
+async def reload_config(force: bool = False):
+    """Перечитывает роли, присутствие операторов, тексты и каталог, если их файлы изменились (force - без сравнения времени изменения)"""
+    if force:
+        texts_cache["mtime"] = None
+        catalog_cache["mtime"] = None
+    try:
+        if reload_roles(force):
+            assignment_pool.rebuild(await load_dialogs())
+        apply_presence(await load_presence())
+        await load_texts(refresh=True)
+        await get_catalog_index(refresh=True)
+    except Exception as e:
+        print(f"[CONFIG] Ошибка перезагрузки конфигурации: {e}")
+
+
+async def config_watch_loop():
+    """Периодически проверяет время изменения .env, texts.json и buttons.json"""
+    while True:
+        await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+        await reload_config()
 
 
 # Проверка админа и оператора
 def is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_IDS
+    return user_id in roles["admins"]
 
 def is_operator(user_id: int) -> bool:
-    return user_id in OPERATOR_IDS
+    return user_id in roles["operators"]
 
 def is_admin_or_operator(user_id: int) -> bool:
-    return user_id in ADMIN_IDS or user_id in OPERATOR_IDS
+    return user_id in roles["admins"] or user_id in roles["operators"]
+
+
+# Присутствие операторов. Оператор отмечается командами /online и /away, а без отметки считается
+# на месте, если действовал в боте за последние OPERATOR_ACTIVE_WINDOW секунд. Уведомления о диалогах
+# и назначение получают только операторы на месте, а если таких нет - все операторы.
+# Документ presence общий для процессов: {"status": {id: "online" | "away"}, "seen": {id: время действия}}
+PRESENCE_STATUSES = ("online", "away")
+# Как часто (сек) записывать в документ время последнего действия оператора
+PRESENCE_SAVE_INTERVAL = 60
+
+presence = {"status": {}, "seen": {}, "saved": {}}
+presence_lock = FileLock(os.path.join(LOCKS_DIR, "presence.lock"))
+
+
+async def load_presence() -> dict:
+    try:
+        if STORAGE_BACKEND == "sqlite":
+            content = await asyncio.to_thread(db_read_document, "presence")
+            return json.loads(content) if content else {}
+        async with aiofiles.open(PRESENCE_FILE, 'r', encoding='utf-8') as f:
+            content = await f.read()
+            return json.loads(content)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+async def save_presence(data):
+    if STORAGE_BACKEND == "sqlite":
+        await asyncio.to_thread(db_write_document, "presence", json.dumps(data, ensure_ascii=False))
+        return
+    await write_json_file(PRESENCE_FILE, data)
+
+
+def operator_online(operator_id: int) -> bool:
+    status = presence["status"].get(operator_id)
+    if status:
+        return status == "online"
+    return time.time() - presence["seen"].get(operator_id, 0) < OPERATOR_ACTIVE_WINDOW
+
+
+def present_operators() -> list:
+    """Операторы на месте, а если на месте никого нет - все операторы"""
+    online = [operator_id for operator_id in roles["operators"] if operator_online(operator_id)]
+    return online or list(roles["operators"])
+
+
+def apply_presence(data: dict):
+    """Переносит в память документ presence и переставляет в очереди назначения операторов, чьё присутствие изменилось"""
+    was_online = {operator_id: operator_online(operator_id) for operator_id in roles["operators"]}
+    presence["status"] = {int(key): value for key, value in data.get("status", {}).items() if value in PRESENCE_STATUSES}
+    for key, seen in data.get("seen", {}).items():
+        operator_id = int(key)
+        if seen > presence["seen"].get(operator_id, 0):
+            presence["seen"][operator_id] = seen
+    for operator_id, online in was_online.items():
+        if operator_online(operator_id) != online:
+            assignment_pool.update(operator_id)
+
+
+async def modify_presence(change):
+    """Изменяет общий документ presence под блокировкой и применяет его"""
+    async with presence_lock:
+        data = await load_presence()
+        data.setdefault("status", {})
+        data.setdefault("seen", {})
+        change(data)
+        await save_presence(data)
+    apply_presence(data)
+
+
+async def set_operator_status(operator_id: int, status: str):
+    def change(data):
+        data["status"][str(operator_id)] = status
+    await modify_presence(change)
+
+
+async def mark_operator_seen(operator_id: int):
+    """Запоминает действие оператора; в общий документ время пишется не чаще раза в PRESENCE_SAVE_INTERVAL"""
+    was_online = operator_online(operator_id)
+    now = time.time()
+    presence["seen"][operator_id] = now
+    if not was_online and operator_online(operator_id):
+        assignment_pool.update(operator_id)
+    if now - presence["saved"].get(operator_id, 0) < PRESENCE_SAVE_INTERVAL:
+        return
+    presence["saved"][operator_id] = now
+    
+    def change(data):
+        data["seen"][str(operator_id)] = max(now, data["seen"].get(str(operator_id), 0))
+    await modify_presence(change)
+
+
+@dp.update.outer_middleware()
+async def track_operator_activity(handler, event: Update, data: dict):
+    user = data.get("event_from_user")
+    if user and user.id in roles["operators"]:
+        try:
+            await mark_operator_seen(user.id)
+        except Exception as e:
+            print(f"[PRESENCE] Ошибка сохранения присутствия {user.id}: {e}")
+    return await handler(event, data)
+
+
+# Автоматическое назначение диалогов. Нагрузка оператора - принятые диалоги (operator_active_dialogs)
+# и предложенные ему, но ещё не принятые (operator_offers). Операторы лежат в кучах по навыкам,
+# поэтому выбор оператора - O(log n) без перебора всех операторов
+
+# Как часто (сек) при общем хранилище SQLite пересчитывать нагрузку целиком: другие процессы
+# меняют её без ведома этого процесса
+ASSIGNMENT_RESYNC_INTERVAL = 30
+
+
+def operator_load(dialogs_data: dict, operator_id: int) -> int:
+    operator_id_str = str(operator_id)
+    return (len(dialogs_data["operator_active_dialogs"].get(operator_id_str, []))
+            + len(dialogs_data["operator_offers"].get(operator_id_str, [])))
+
+
+class AssignmentPool:
+    """Кучи операторов по навыкам ("*" - все операторы, "" - операторы без навыков).
+    Оператор без навыков входит в кучи всех навыков. Запись кучи - (приоритет, оператор).
+    При изменении нагрузки добавляется новая запись, а старая остаётся и выбрасывается при выборе,
+    когда она уже не совпадает с последней добавленной (entries)"""
+    
+    def __init__(self):
+        self.loads = {}
+        self.last_assigned = {}
+        self.tags = {}
+        self.heaps = {}
+        self.entries = {}
+        self.counter = 0
+        self.synced_at = 0.0
+    
+    def priority(self, operator_id: int) -> tuple:
+        load = self.loads[operator_id]
+        full = 0 < OPERATOR_CAPACITY <= load
+        # Отошедшие операторы - после всех, кто на месте, заполненные - в конце своей группы:
+        # если вершина на месте, но заполнена, назначить некому
+        away = not operator_online(operator_id)
+        if ASSIGNMENT_POLICY == "round_robin":
+            return (away, full, self.last_assigned[operator_id])
+        return (away, full, load, self.last_assigned[operator_id])
+    
+    def rebuild(self, dialogs_data: dict):
+        """Пересчитывает нагрузку всех операторов и строит кучи заново"""
+        operators = roles["operators"]
+        skills = roles["skills"]
+        all_tags = set().union(*skills.values()) if skills else set()
+        self.loads = {operator_id: operator_load(dialogs_data, operator_id) for operator_id in operators}
+        self.last_assigned = {operator_id: self.last_assigned.get(operator_id, 0) for operator_id in operators}
+        self.tags = {operator_id: ["*", *(skills.get(operator_id) or [*all_tags, ""])] for operator_id in operators}
+        self.entries = {operator_id: self.priority(operator_id) for operator_id in operators}
+        self.heaps = {}
+        for operator_id, tags in self.tags.items():
+            for tag in tags:
+                self.heaps.setdefault(tag, []).append((self.entries[operator_id], operator_id))
+        for heap in self.heaps.values():
+            heapq.heapify(heap)
+        self.synced_at = time.monotonic()
+    
+    def update(self, operator_id: int, load: int | None = None, assigned: bool = False):
+        """Новая запись оператора в кучах (load=None - нагрузка прежняя, например сменилось присутствие)"""
+        if operator_id not in self.loads:
+            return
+        if load is not None:
+            self.loads[operator_id] = load
+        if assigned:
+            self.counter += 1
+            self.last_assigned[operator_id] = self.counter
+        priority = self.entries[operator_id] = self.priority(operator_id)
+        for tag in self.tags[operator_id]:
+            heap = self.heaps[tag]
+            heapq.heappush(heap, (priority, operator_id))
+            # Слишком много устаревших записей - пересобираем кучу навыка
+            if len(heap) > 4 * len(self.loads) + 16:
+                heap[:] = [(self.entries[member], member) for member, tags in self.tags.items() if tag in tags]
+                heapq.heapify(heap)
+    
+    def pick(self, dialogs_data: dict, skill: str = None) -> int | None:
+        """Оператор для нового диалога или None, если все заняты. Операторы на месте выбираются раньше отошедших.
+        Нагрузка кандидата сверяется с документом диалогов, присутствие - с текущим временем.
+        Диалог без навыка получает любой оператор, с навыком, которого нет ни у кого, - операторы без навыков"""
+        if skill is None:
+            tag = "*"
+        else:
+            tag = skill if skill in self.heaps else ("" if "" in self.heaps else "*")
+        heap = self.heaps.get(tag, [])
+        while heap:
+            priority, operator_id = heap[0]
+            if priority != self.entries.get(operator_id):
+                heapq.heappop(heap)
+                continue
+            load = operator_load(dialogs_data, operator_id)
+            # Присутствие по давности действий истекает само, без события - переставляем оператора при выборе
+            if load != self.loads[operator_id] or priority != self.priority(operator_id):
+                self.update(operator_id, load)
+                continue
+            # Вершина отошла - на месте нет никого с этим навыком, назначаем среди всех
+            return None if priority[1] else operator_id
+        return None
+
+
+assignment_pool = AssignmentPool()
+
+# Таймеры передачи непринятого диалога всем операторам: dialog_id -> задача
+offer_timers = {}
+
+
+def refresh_operator_loads(dialogs_data: dict, *operator_ids):
+    for operator_id in operator_ids:
+        if operator_id:
+            assignment_pool.update(operator_id, operator_load(dialogs_data, operator_id))
+
+
+def withdraw_offer(dialogs_data: dict, dialog_id: str) -> int | None:
+    """Снимает предложение диалога с назначенного оператора. Возвращает ID этого оператора"""
+    dialog = dialogs_data["dialogs"][dialog_id]
+    operator_id = dialog.pop("assigned_to", None)
+    if operator_id:
+        discard_from_index(dialogs_data["operator_offers"].get(str(operator_id), []), dialog_id)
+    timer = offer_timers.pop(dialog_id, None)
+    if timer and timer is not asyncio.current_task():
+        timer.cancel()
+    return operator_id
 
 
 # Функции для работы с диалогами
-async def create_dialog(user_id: int, user_name: str, user_phone: str, username: str, button_path: list) -> str:
+async def create_dialog(user_id: int, user_name: str, user_phone: str, username: str, button_path: list, skill: str = None) -> str:
     """Создает новый диалог и возвращает его ID. Если уже есть активный диалог, возвращает его ID."""
-    dialogs_data = await load_dialogs()
-    
-    # Проверяем, есть ли уже активный диалог
-    existing_dialog_id = dialogs_data["user_active_dialogs"].get(str(user_id))
-    if existing_dialog_id:
-        existing_dialog = dialogs_data["dialogs"].get(existing_dialog_id)
-        if existing_dialog and existing_dialog["status"] in ["active", "pending"]:
-            # Возвращаем существующий активный диалог
-            return existing_dialog_id
-    
-    # Создаем новый диалог только если активного нет
-    dialog_id = f"dialog_{user_id}_{int(datetime.now().timestamp())}"
-    
-    dialogs_data["dialogs"][dialog_id] = {
-        "user_id": user_id,
-        "user_name": user_name,
-        "user_phone": user_phone,
-        "username": username,
-        "operator_id": None,
-        "status": "pending",
-        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        "button_path": button_path,
-        "messages": []
-    }
-    
-    dialogs_data["user_active_dialogs"][str(user_id)] = dialog_id
-    
-    await save_dialogs(dialogs_data)
-    return dialog_id
+    async with dialogs_lock:
+        dialogs_data = await load_dialogs()
+        
+        # Проверяем, есть ли уже активный диалог
+        existing_dialog_id = dialogs_data["user_active_dialogs"].get(str(user_id))
+        if existing_dialog_id:
+            existing_dialog = dialogs_data["dialogs"].get(existing_dialog_id)
+            if existing_dialog and existing_dialog["status"] in ["active", "pending"]:
+                # Возвращаем существующий активный диалог
+                return existing_dialog_id
+        
+        # Создаем новый диалог только если активного нет. ID - порядковый номер (d1, d2, ...),
+        # старые диалоги сохраняют ID вида dialog_<user_id>_<время>
+        dialogs_data["last_dialog_number"] = dialogs_data.get("last_dialog_number", 0) + 1
+        dialog_id = format_dialog_id(dialogs_data["last_dialog_number"])
+        
+        dialogs_data["dialogs"][dialog_id] = {
+            "user_id": user_id,
+            "user_name": user_name,
+            "user_phone": user_phone,
+            "username": username,
+            "operator_id": None,
+            "status": "pending",
+            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "button_path": button_path,
+            "messages": []
+        }
+        if skill:
+            dialogs_data["dialogs"][dialog_id]["skill"] = skill
+        
+        dialogs_data["user_active_dialogs"][str(user_id)] = dialog_id
+        dialogs_data["pending_dialogs"].append(dialog_id)
+        
+        await save_dialogs(dialogs_data)
+        await update_search_index([(dialog_id, "profile", search_profile_text(dialogs_data["dialogs"][dialog_id]))])
+        if is_leader:
+            track_sla(dialog_id, dialogs_data["dialogs"][dialog_id])
+        return dialog_id
 
 
 async def accept_dialog(dialog_id: str, operator_id: int):
     """Принимает диалог оператором/админом"""
-    dialogs_data = await load_dialogs()
-    
-    if dialog_id not in dialogs_data["dialogs"]:
-        return False
-    
-    dialog = dialogs_data["dialogs"][dialog_id]
-    
-    # Если диалог уже активен и назначен этому оператору, просто возвращаем True
-    if dialog["status"] == "active" and dialog.get("operator_id") == operator_id:
+    async with dialogs_lock:
+        dialogs_data = await load_dialogs()
+        
+        if dialog_id not in dialogs_data["dialogs"]:
+            return False
+        
+        dialog = dialogs_data["dialogs"][dialog_id]
+        
+        # Если диалог уже активен и назначен этому оператору, просто возвращаем True
+        if dialog["status"] == "active" and dialog.get("operator_id") == operator_id:
+            return True
+        
+        # Если диалог уже активен, но назначен другому оператору, не меняем
+        if dialog["status"] == "active":
+            return False
+        
+        # Если диалог не pending, не принимаем
+        if dialog["status"] != "pending":
+            return False
+        
+        dialog["status"] = "active"
+        dialog["operator_id"] = operator_id
+        dialog["accepted_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        discard_from_index(dialogs_data["pending_dialogs"], dialog_id)
+        offered_to = withdraw_offer(dialogs_data, dialog_id)
+        untrack_sla(dialog_id)
+        touch_dialog_activity(dialogs_data, dialog_id, dialog["accepted_at"])
+        
+        # Добавляем диалог в список активных диалогов оператора
+        if str(operator_id) not in dialogs_data["operator_active_dialogs"]:
+            dialogs_data["operator_active_dialogs"][str(operator_id)] = []
+        
+        if dialog_id not in dialogs_data["operator_active_dialogs"][str(operator_id)]:
+            dialogs_data["operator_active_dialogs"][str(operator_id)].append(dialog_id)
+        
+        await save_dialogs(dialogs_data)
+        refresh_operator_loads(dialogs_data, operator_id, offered_to)
         return True
-    
-    # Если диалог уже активен, но назначен другому оператору, не меняем
-    if dialog["status"] == "active":
-        return False
-    
-    # Если диалог не pending, не принимаем
-    if dialog["status"] != "pending":
-        return False
-    
-    dialog["status"] = "active"
-    dialog["operator_id"] = operator_id
-    dialog["accepted_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    # Добавляем диалог в список активных диалогов оператора
-    if str(operator_id) not in dialogs_data["operator_active_dialogs"]:
-        dialogs_data["operator_active_dialogs"][str(operator_id)] = []
-    
-    if dialog_id not in dialogs_data["operator_active_dialogs"][str(operator_id)]:
-        dialogs_data["operator_active_dialogs"][str(operator_id)].append(dialog_id)
-    
-    await save_dialogs(dialogs_data)
-    return True
 
 
-async def add_message_to_dialog(dialog_id: str, from_user: str, text: str):
+async def add_message_to_dialog(dialog_id: str, from_user: str, text: str, media: dict = None):
     """Добавляет сообщение в диалог"""
-    dialogs_data = await load_dialogs()
-    
-    if dialog_id not in dialogs_data["dialogs"]:
-        return False
-    
-    dialogs_data["dialogs"][dialog_id]["messages"].append({
-        "from": from_user,  # "user" или "operator"
-        "text": text,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    })
-    
-    await save_dialogs(dialogs_data)
-    return True
+    return await add_messages_to_dialog(dialog_id, from_user, [(text, media)])
 
 
-async def close_dialog(dialog_id: str):
-    """Закрывает диалог"""
-    dialogs_data = await load_dialogs()
-    
-    if dialog_id not in dialogs_data["dialogs"]:
-        return False
-    
+async def add_messages_to_dialog(dialog_id: str, from_user: str, entries: list):
+    """Добавляет в диалог сообщения [(текст или подпись, вложение или None)] одним сохранением.
+    Вложение хранится как {"type": тип, "file_id": ...} - сам файл остаётся на серверах Telegram"""
+    async with dialogs_lock:
+        dialogs_data = await load_dialogs()
+        
+        if dialog_id not in dialogs_data["dialogs"]:
+            return False
+        
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for text, media in entries:
+            record = {
+                "from": from_user,  # "user" или "operator"
+                "text": text,
+                "timestamp": timestamp
+            }
+            if media:
+                record["media"] = media
+            dialogs_data["dialogs"][dialog_id]["messages"].append(record)
+        if dialogs_data["dialogs"][dialog_id]["status"] == "active":
+            touch_dialog_activity(dialogs_data, dialog_id, timestamp)
+        
+        await save_dialogs(dialogs_data)
+        rows = [(dialog_id, from_user, text) for text, _ in entries if text]
+        if rows:
+            await update_search_index(rows)
+        return True
+
+
+def close_dialog_record(dialogs_data: dict, dialog_id: str) -> int | None:
+    """Закрывает диалог в загруженном документе и обновляет индексы. Возвращает оператора, которому диалог был предложен"""
     dialog = dialogs_data["dialogs"][dialog_id]
     dialog["status"] = "closed"
     dialog["closed_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
+    # Индексы списков диалогов
+    discard_from_index(dialogs_data["pending_dialogs"], dialog_id)
+    offered_to = withdraw_offer(dialogs_data, dialog_id)
+    untrack_sla(dialog_id)
+    dialogs_data["dialog_activity"].pop(dialog_id, None)
+    dialogs_data["closed_dialogs"].append(dialog_id)
+    if dialog.get("operator_id"):
+        dialogs_data["operator_closed_dialogs"].setdefault(str(dialog["operator_id"]), []).append(dialog_id)
+    
     # Удаляем из активных диалогов пользователя
     user_id_str = str(dialog["user_id"])
     if user_id_str in dialogs_data["user_active_dialogs"]:
@@ -235,9 +1238,28 @@ async def close_dialog(dialog_id: str):
     if operator_id_str and operator_id_str in dialogs_data["operator_active_dialogs"]:
         if dialog_id in dialogs_data["operator_active_dialogs"][operator_id_str]:
             dialogs_data["operator_active_dialogs"][operator_id_str].remove(dialog_id)
-    
-    await save_dialogs(dialogs_data)
-    return True
+    return offered_to
+
+
+async def close_dialog(dialog_id: str):
+    """Закрывает диалог"""
+    async with dialogs_lock:
+        dialogs_data = await load_dialogs()
+        
+        if dialog_id not in dialogs_data["dialogs"]:
+            return False
+        
+        dialog = dialogs_data["dialogs"][dialog_id]
+        
+        # Диалог уже закрыт (например, в другом процессе бота)
+        if dialog["status"] == "closed":
+            return False
+        
+        offered_to = close_dialog_record(dialogs_data, dialog_id)
+        await save_dialogs(dialogs_data)
+        refresh_operator_loads(dialogs_data, dialog.get("operator_id"), offered_to)
+        forget_dialog_relays(dialog_id)
+        return True
 
 
 async def get_user_active_dialog(user_id: int) -> str | None:
@@ -253,140 +1275,508 @@ async def get_user_active_dialog(user_id: int) -> str | None:
     return None
 
 
-async def get_active_dialogs_for_operator(operator_id: int) -> list:
-    """Получает список активных диалогов для оператора/админа"""
+async def assign_dialog(dialog_id: str) -> int | None:
+    """Предлагает ожидающий диалог одному оператору по ASSIGNMENT_POLICY. Возвращает его ID
+    или None, если диалог нужно отправить всем (политика broadcast или все операторы заняты)"""
+    if ASSIGNMENT_POLICY not in ("least_loaded", "round_robin"):
+        return None
+    async with dialogs_lock:
+        dialogs_data = await load_dialogs()
+        dialog = dialogs_data["dialogs"].get(dialog_id)
+        if not dialog or dialog["status"] != "pending":
+            return None
+        if dialog.get("assigned_to"):
+            return dialog["assigned_to"]
+        
+        if STORAGE_BACKEND == "sqlite" and time.monotonic() - assignment_pool.synced_at > ASSIGNMENT_RESYNC_INTERVAL:
+            assignment_pool.rebuild(dialogs_data)
+        operator_id = assignment_pool.pick(dialogs_data, dialog.get("skill"))
+        if operator_id is None:
+            return None
+        
+        dialog["assigned_to"] = operator_id
+        dialog["assigned_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        dialogs_data["operator_offers"].setdefault(str(operator_id), []).append(dialog_id)
+        await save_dialogs(dialogs_data)
+        assignment_pool.update(operator_id, operator_load(dialogs_data, operator_id), assigned=True)
+        return operator_id
+
+
+async def expire_offer(dialog_id: str, operator_id: int, delay: float):
+    """Если назначенный оператор не принял диалог за delay секунд, диалог предлагается всем операторам"""
+    await asyncio.sleep(delay)
+    async with dialogs_lock:
+        dialogs_data = await load_dialogs()
+        dialog = dialogs_data["dialogs"].get(dialog_id)
+        if not dialog or dialog["status"] != "pending" or dialog.get("assigned_to") != operator_id:
+            offer_timers.pop(dialog_id, None)
+            return
+        withdraw_offer(dialogs_data, dialog_id)
+        await save_dialogs(dialogs_data)
+        refresh_operator_loads(dialogs_data, operator_id)
+    
+    print(f"[ASSIGN] Оператор {operator_id} не принял диалог {dialog_id}, отправляем всем операторам")
+    cards = await update_dialog_cards(dialog_id, dialog)
+    await notify_operators(dialog_id, dialog, [op for op in present_operators() if str(op) not in cards])
+
+
+def schedule_offer_timeout(dialog_id: str, operator_id: int, delay: float = ASSIGNMENT_TIMEOUT):
+    timer = offer_timers.pop(dialog_id, None)
+    if timer:
+        timer.cancel()
+    offer_timers[dialog_id] = asyncio.create_task(expire_offer(dialog_id, operator_id, max(0.0, delay)))
+
+
+def restore_offer_timers(dialogs_data: dict):
+    """Восстанавливает таймеры предложений после перезапуска бота"""
+    now = datetime.now()
+    for operator_id_str, dialog_ids in dialogs_data["operator_offers"].items():
+        for dialog_id in dialog_ids:
+            dialog = dialogs_data["dialogs"].get(dialog_id)
+            if not dialog or not dialog.get("assigned_at"):
+                continue
+            elapsed = (now - datetime.strptime(dialog["assigned_at"], "%Y-%m-%d %H:%M:%S")).total_seconds()
+            schedule_offer_timeout(dialog_id, int(operator_id_str), ASSIGNMENT_TIMEOUT - elapsed)
+
+
+# Сроки ответа (SLA) на ожидающие диалоги. Ведущий процесс держит кучу (срок, dialog_id, этап)
+# и просыпается только к ближайшему сроку. Принятие, закрытие и удаление снимают диалог с учёта,
+# а его запись остаётся в куче и выбрасывается при извлечении
+SLA_STAGES = [(stage, timeout) for stage, timeout in ((1, SLA_PENDING_TIMEOUT), (2, SLA_ESCALATE_TIMEOUT)) if timeout > 0]
+
+# Как часто (сек) ведущий процесс при общем хранилище SQLite подхватывает диалоги, созданные другими процессами
+SLA_RESYNC_INTERVAL = 30
+
+sla_heap = []
+# Действующая запись кучи для каждого диалога на учёте: dialog_id -> (срок, этап)
+sla_tracked = {}
+sla_wakeup = asyncio.Event()
+
+
+def track_sla(dialog_id: str, dialog: dict):
+    """Ставит ожидающий диалог на учёт со следующим ещё не наступившим этапом"""
+    done = dialog.get("sla_stage", 0)
+    created = datetime.strptime(dialog["created_at"], "%Y-%m-%d %H:%M:%S").timestamp()
+    for stage, timeout in SLA_STAGES:
+        if stage > done:
+            sla_tracked[dialog_id] = (created + timeout, stage)
+            heapq.heappush(sla_heap, (created + timeout, dialog_id, stage))
+            sla_wakeup.set()
+            return
+    sla_tracked.pop(dialog_id, None)
+
+
+def untrack_sla(dialog_id: str):
+    sla_tracked.pop(dialog_id, None)
+
+
+def format_wait(seconds: float) -> str:
+    return f"{int(seconds // 60)} мин" if seconds >= 60 else f"{int(seconds)} сек"
+
+
+def sla_breach_threshold() -> str:
+    """created_at, начиная с которого (и раньше) ожидающий диалог просрочен"""
+    return datetime.fromtimestamp(time.time() - SLA_PENDING_TIMEOUT).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def count_sla_breached(dialogs_data: dict) -> int:
+    """Число ожидающих дольше SLA_PENDING_TIMEOUT. Индекс ожидающих упорядочен по созданию - двоичный поиск"""
+    if SLA_PENDING_TIMEOUT <= 0:
+        return 0
+    dialogs = dialogs_data["dialogs"]
+    return bisect.bisect_right(
+        dialogs_data["pending_dialogs"], sla_breach_threshold(),
+        key=lambda dialog_id: dialogs[dialog_id]["created_at"] if dialog_id in dialogs else ""
+    )
+
+
+async def resync_sla():
+    """Ставит на учёт ожидающие диалоги, которых ещё нет в куче (созданные до запуска или другими процессами)"""
     dialogs_data = await load_dialogs()
-    dialog_ids = dialogs_data["operator_active_dialogs"].get(str(operator_id), [])
+    for dialog_id in dialogs_data["pending_dialogs"]:
+        if dialog_id not in sla_tracked and dialog_id in dialogs_data["dialogs"]:
+            track_sla(dialog_id, dialogs_data["dialogs"][dialog_id])
+
+
+async def notify_sla(dialog_id: str, dialog: dict, stage: int):
+    """Напоминание операторам (этап 1) или сообщение админам (этап 2) о непринятом диалоге"""
+    created = datetime.strptime(dialog["created_at"], "%Y-%m-%d %H:%M:%S")
+    waited = format_wait((datetime.now() - created).total_seconds())
+    if stage == 1:
+        text, recipients = f"⏰ <b>Диалог ждёт ответа {waited}</b>\n\n", present_operators()
+    else:
+        text, recipients = f"🚨 <b>Диалог без ответа {waited}</b>\n\n", roles["admins"]
+    username_text = f"@{dialog['username']}" if dialog.get("username") else "Не указан"
+    text += f"👤 <b>Имя:</b> {html.escape(str(dialog.get('user_name', 'Не указано')))}\n"
+    text += f"📱 <b>Номер телефона:</b> {html.escape(format_phone_number(dialog.get('user_phone', 'Не указан')))}\n"
+    text += f"🔗 <b>Username:</b> {html.escape(username_text)}\n"
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Принять диалог", callback_data=pack_callback("accept_dialog", dialog_id))]
+    ])
+    for chat_id in recipients:
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode="HTML", reply_markup=keyboard)
+        except Exception as e:
+            print(f"[SLA] Ошибка отправки {chat_id}: {e}")
+
+
+async def process_due_sla():
+    """Обрабатывает наступившие сроки: отмечает этап в диалоге одним сохранением и рассылает уведомления"""
+    now = time.time()
+    due = []
+    while sla_heap and sla_heap[0][0] <= now:
+        deadline, dialog_id, stage = heapq.heappop(sla_heap)
+        if sla_tracked.get(dialog_id) == (deadline, stage):
+            due.append((dialog_id, stage))
+    if not due:
+        return
     
-    active_dialogs = []
-    for dialog_id in dialog_ids:
-        dialog = dialogs_data["dialogs"].get(dialog_id)
-        if dialog and dialog["status"] == "active":
-            active_dialogs.append((dialog_id, dialog))
+    fired = []
+    async with dialogs_lock:
+        dialogs_data = await load_dialogs()
+        for dialog_id, stage in due:
+            dialog = dialogs_data["dialogs"].get(dialog_id)
+            if not dialog or dialog["status"] != "pending":
+                untrack_sla(dialog_id)
+                continue
+            if dialog.get("sla_stage", 0) < stage:
+                dialog["sla_stage"] = stage
+                fired.append((dialog_id, dialog, stage))
+            track_sla(dialog_id, dialog)
+        if fired:
+            await save_dialogs(dialogs_data)
+    
+    for dialog_id, dialog, stage in fired:
+        print(f"[SLA] Диалог {dialog_id} не принят вовремя, этап {stage}")
+        await notify_sla(dialog_id, dialog, stage)
+
+
+async def sla_watch_loop():
+    """Фоновая задача ведущего процесса: спит до ближайшего срока SLA или до постановки нового диалога на учёт"""
+    if not SLA_STAGES:
+        return
+    await resync_sla()
+    resynced_at = time.monotonic()
+    while True:
+        sla_wakeup.clear()
+        timeout = max(0.0, sla_heap[0][0] - time.time()) if sla_heap else None
+        if STORAGE_BACKEND == "sqlite":
+            timeout = SLA_RESYNC_INTERVAL if timeout is None else min(timeout, SLA_RESYNC_INTERVAL)
+        try:
+            await asyncio.wait_for(sla_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        
+        try:
+            if STORAGE_BACKEND == "sqlite" and time.monotonic() - resynced_at >= SLA_RESYNC_INTERVAL:
+                await resync_sla()
+                resynced_at = time.monotonic()
+            await process_due_sla()
+        except Exception as e:
+            print(f"[SLA] Ошибка проверки сроков: {e}")
+
+
+# Автоматическое закрытие молчащих диалогов. Индекс dialog_activity упорядочен по последнему
+# сообщению, поэтому просроченные диалоги лежат в его начале, а срок первого из оставшихся -
+# самый ранний возможный: до него ведущему процессу можно не просыпаться
+
+# Сколько диалогов закрывать за одно сохранение
+IDLE_CLOSE_BATCH = 100
+
+
+async def reset_dialog_state(chat_id: int, dialog_id: str, dialog_state: State):
+    """Снимает с пользователя состояние диалога, если оно относится к этому диалогу"""
+    context = dp.fsm.get_context(bot=bot, chat_id=chat_id, user_id=chat_id)
+    if await context.get_state() == dialog_state.state and (await context.get_data()).get("dialog_id") == dialog_id:
+        await context.set_state(None)
+        await context.update_data(dialog_id=None)
+
+
+async def close_idle_dialogs() -> float | None:
+    """Закрывает диалоги без сообщений дольше DIALOG_IDLE_TIMEOUT пачкой с одним сохранением.
+    Возвращает время (timestamp), когда истечёт следующий диалог, или None, если принятых диалогов нет"""
+    cutoff = (datetime.now() - timedelta(seconds=DIALOG_IDLE_TIMEOUT)).strftime("%Y-%m-%d %H:%M:%S")
+    closed = []
+    async with dialogs_lock:
+        dialogs_data = await load_dialogs()
+        activity = dialogs_data["dialog_activity"]
+        expired = []
+        for dialog_id, last_activity in activity.items():
+            if last_activity > cutoff or len(expired) >= IDLE_CLOSE_BATCH:
+                break
+            expired.append(dialog_id)
+        
+        for dialog_id in expired:
+            dialog = dialogs_data["dialogs"].get(dialog_id)
+            if not dialog or dialog["status"] != "active":
+                activity.pop(dialog_id, None)
+                continue
+            close_dialog_record(dialogs_data, dialog_id)
+            closed.append((dialog_id, dialog))
+        if expired:
+            await save_dialogs(dialogs_data)
+            refresh_operator_loads(dialogs_data, *{dialog.get("operator_id") for _, dialog in closed})
+        next_activity = next(iter(activity.values()), None)
+    
+    for dialog_id, dialog in closed:
+        print(f"[IDLE] Диалог {dialog_id} закрыт автоматически")
+        forget_dialog_relays(dialog_id)
+        await update_dialog_cards(dialog_id, dialog)
+        try:
+            await reset_dialog_state(dialog["user_id"], dialog_id, UserStates.in_dialog)
+            await bot.send_message(
+                chat_id=dialog["user_id"],
+                text="ℹ️ Диалог с оператором закрыт, так как в нём давно не было сообщений. Если у вас остались вопросы, вы можете создать новый диалог."
+            )
+        except Exception as e:
+            print(f"[IDLE] Не удалось уведомить пользователя {dialog['user_id']}: {e}")
+        if dialog.get("operator_id"):
+            try:
+                await reset_dialog_state(dialog["operator_id"], dialog_id, OperatorStates.replying_to_dialog)
+                await bot.send_message(
+                    chat_id=dialog["operator_id"],
+                    text=f"ℹ️ Диалог с {dialog.get('user_name', 'пользователем')} закрыт автоматически: нет сообщений {format_wait(DIALOG_IDLE_TIMEOUT)}."
+                )
+            except Exception as e:
+                print(f"[IDLE] Не удалось уведомить оператора {dialog['operator_id']}: {e}")
     
-    return active_dialogs
+    if len(expired) >= IDLE_CLOSE_BATCH:
+        return time.time()
+    if next_activity is None:
+        return None
+    return datetime.strptime(next_activity, "%Y-%m-%d %H:%M:%S").timestamp() + DIALOG_IDLE_TIMEOUT
+
+
+async def idle_sweep_loop():
+    """Фоновая задача ведущего процесса: закрывает молчащие диалоги и спит до следующего срока"""
+    if DIALOG_IDLE_TIMEOUT <= 0:
+        return
+    while True:
+        try:
+            next_expiry = await close_idle_dialogs()
+            delay = DIALOG_IDLE_TIMEOUT if next_expiry is None else next_expiry - time.time()
+        except Exception as e:
+            print(f"[IDLE] Ошибка автоматического закрытия диалогов: {e}")
+            delay = 60
+        # Новые диалоги попадают в конец индекса, поэтому раньше следующего срока ничего не истечёт
+        await asyncio.sleep(min(max(delay, 0.0), DIALOG_IDLE_TIMEOUT))
+
+
+# Вкладки панели диалогов: (заголовок, значок записи, новые сверху)
+DASHBOARD_TABS = {
+    "pending": ("⏳ Ожидающие", "🔔", False),
+    "active": ("📞 Активные", "👤", False),
+    "closed": ("📁 Закрытые", "🔒", True)
+}
+
+
+def get_dashboard_index(dialogs_data: dict, tab: str, operator_id: int) -> list:
+    """Индекс диалогов вкладки: ожидающие - общие, активные - свои, закрытые - свои (админу - все)"""
+    if tab == "pending":
+        return dialogs_data["pending_dialogs"]
+    if tab == "active":
+        return dialogs_data["operator_active_dialogs"].get(str(operator_id), [])
+    if is_admin(operator_id):
+        return dialogs_data["closed_dialogs"]
+    return dialogs_data["operator_closed_dialogs"].get(str(operator_id), [])
+
+
+def query_dialog_page(dialogs_data: dict, dialog_ids: list, cursor: int | None, newest_first: bool) -> dict:
+    """Страница индекса по курсору - позиции в индексе, с которой начинается страница
+    (для вкладки "новые сверху" - позиции, перед которой она заканчивается). Читает только записи страницы"""
+    size = len(dialog_ids)
+    if newest_first:
+        end = size if cursor is None else max(0, min(cursor, size))
+        start = max(0, end - DASHBOARD_PAGE_SIZE)
+        positions = range(end - 1, start - 1, -1)
+        next_cursor = start if start > 0 else None
+        prev_cursor = min(size, end + DASHBOARD_PAGE_SIZE) if end < size else None
+        page_number = -(-(size - end) // DASHBOARD_PAGE_SIZE) + 1
+    else:
+        start = 0 if cursor is None else max(0, min(cursor, size))
+        end = min(size, start + DASHBOARD_PAGE_SIZE)
+        positions = range(start, end)
+        next_cursor = end if end < size else None
+        prev_cursor = max(0, start - DASHBOARD_PAGE_SIZE) if start > 0 else None
+        page_number = -(-start // DASHBOARD_PAGE_SIZE) + 1
+    
+    items = []
+    for position in positions:
+        dialog = dialogs_data["dialogs"].get(dialog_ids[position])
+        if dialog:
+            items.append((dialog_ids[position], dialog))
+    return {
+        "items": items,
+        "cursor": end if newest_first else start,
+        "next": next_cursor,
+        "prev": prev_cursor,
+        "page": page_number,
+        "pages": max(1, -(-size // DASHBOARD_PAGE_SIZE)),
+        "total": size
+    }
+
+
+async def delete_dialog(dialog_id: str) -> bool:
+    """Полностью удаляет диалог из истории"""
+    async with dialogs_lock:
+        dialogs_data = await load_dialogs()
+        
+        if dialog_id not in dialogs_data["dialogs"]:
+            return False
+        
+        dialog = dialogs_data["dialogs"][dialog_id]
+        
+        # Удаляем из активных диалогов пользователя (если есть)
+        user_id_str = str(dialog["user_id"])
+        if user_id_str in dialogs_data["user_active_dialogs"]:
+            if dialogs_data["user_active_dialogs"][user_id_str] == dialog_id:
+                del dialogs_data["user_active_dialogs"][user_id_str]
+        
+        # Удаляем из активных диалогов оператора (если есть)
+        operator_id_str = str(dialog.get("operator_id", ""))
+        if operator_id_str and operator_id_str in dialogs_data["operator_active_dialogs"]:
+            if dialog_id in dialogs_data["operator_active_dialogs"][operator_id_str]:
+                dialogs_data["operator_active_dialogs"][operator_id_str].remove(dialog_id)
+        
+        # Удаляем из индексов списков диалогов
+        discard_from_index(dialogs_data["pending_dialogs"], dialog_id)
+        discard_from_index(dialogs_data["closed_dialogs"], dialog_id)
+        discard_from_index(dialogs_data["operator_closed_dialogs"].get(operator_id_str, []), dialog_id)
+        offered_to = withdraw_offer(dialogs_data, dialog_id)
+        untrack_sla(dialog_id)
+        dialogs_data["dialog_activity"].pop(dialog_id, None)
+        
+        # Удаляем сам диалог
+        del dialogs_data["dialogs"][dialog_id]
+        
+        await save_dialogs(dialogs_data)
+        refresh_operator_loads(dialogs_data, dialog.get("operator_id"), offered_to)
+        await update_search_index(delete_dialog_id=dialog_id)
+        forget_dialog_relays(dialog_id)
+        return True
+
+
+# Полнотекстовый поиск по диалогам (SQLite FTS5, общий для всех процессов бота): строка на каждое
+# сообщение и строка-карточка с именем, username и телефоном. Индекс пополняется вместе с диалогами,
+# существующие диалоги индексируются один раз при первом запуске
+SEARCH_SNIPPET_START = "\x02"
+SEARCH_SNIPPET_END = "\x03"
+
+
+def get_search_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(SEARCH_FILE, timeout=30)
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+def search_profile_text(dialog: dict) -> str:
+    """Текст карточки для поиска: имя, username и телефон целиком и цифрами (с кодом страны и без)"""
+    phone = dialog.get("user_phone") or ""
+    digits = re.sub(r"\D", "", phone)
+    parts = [dialog.get("user_name") or "", dialog.get("username") or "", phone, digits]
+    if len(digits) == 11:
+        parts.append(digits[1:])
+    return " ".join(part for part in parts if part and part != "Не указан")
+
 
+def init_search_index(dialogs_data: dict):
+    """Создает индекс поиска и заполняет его существующими диалогами, если это ещё не сделано"""
+    conn = get_search_connection()
+    conn.isolation_level = None
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS dialog_search USING fts5("
+            "dialog_id UNINDEXED, kind UNINDEXED, content, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS search_meta (name TEXT PRIMARY KEY, value TEXT)")
+        
+        # Заполнение под блокировкой записи, чтобы несколько процессов не проиндексировали диалоги дважды
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM search_meta WHERE name = 'built'").fetchone():
+                conn.execute("COMMIT")
+                return
+            rows = []
+            for dialog_id, dialog in dialogs_data["dialogs"].items():
+                rows.append((dialog_id, "profile", search_profile_text(dialog)))
+                for message in dialog.get("messages", []):
+                    if message.get("text"):
+                        rows.append((dialog_id, message.get("from", ""), message["text"]))
+            conn.executemany("INSERT INTO dialog_search (dialog_id, kind, content) VALUES (?, ?, ?)", rows)
+            conn.execute("INSERT INTO search_meta (name, value) VALUES ('built', ?)", (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),))
+            conn.execute("COMMIT")
+            print(f"[SEARCH] Проиндексировано записей: {len(rows)}")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
 
-async def get_pending_dialogs() -> list:
-    """Получает список ожидающих диалогов"""
-    dialogs_data = await load_dialogs()
-    pending = []
-    
-    for dialog_id, dialog in dialogs_data["dialogs"].items():
-        if dialog["status"] == "pending":
-            pending.append((dialog_id, dialog))
-    
-    return pending
 
+def db_update_search_index(rows: list, delete_dialog_id: str = None):
+    conn = get_search_connection()
+    try:
+        if delete_dialog_id:
+            conn.execute("DELETE FROM dialog_search WHERE dialog_id = ?", (delete_dialog_id,))
+        if rows:
+            conn.executemany("INSERT INTO dialog_search (dialog_id, kind, content) VALUES (?, ?, ?)", rows)
+        conn.commit()
+    finally:
+        conn.close()
 
-async def get_closed_dialogs_for_operator(operator_id: int) -> list:
-    """Получает список закрытых диалогов для оператора/админа"""
-    dialogs_data = await load_dialogs()
-    closed_dialogs = []
-    
-    for dialog_id, dialog in dialogs_data["dialogs"].items():
-        if dialog["status"] == "closed":
-            # Показываем все закрытые диалоги админу, или только свои оператору
-            if is_admin(operator_id) or dialog.get("operator_id") == operator_id:
-                closed_dialogs.append((dialog_id, dialog))
-    
-    # Сортируем по дате закрытия (новые первые)
-    closed_dialogs.sort(key=lambda x: x[1].get("closed_at", ""), reverse=True)
-    
-    return closed_dialogs
 
+async def update_search_index(rows: list = None, delete_dialog_id: str = None):
+    """Добавляет строки (dialog_id, вид, текст) в индекс поиска или удаляет из него диалог"""
+    try:
+        await asyncio.to_thread(db_update_search_index, rows or [], delete_dialog_id)
+    except sqlite3.Error as e:
+        # Ошибка индекса не должна мешать переписке
+        print(f"[SEARCH] Не удалось обновить индекс поиска: {e}")
 
-async def delete_dialog(dialog_id: str) -> bool:
-    """Полностью удаляет диалог из истории"""
-    dialogs_data = await load_dialogs()
-    
-    if dialog_id not in dialogs_data["dialogs"]:
-        return False
-    
-    dialog = dialogs_data["dialogs"][dialog_id]
-    
-    # Удаляем из активных диалогов пользователя (если есть)
-    user_id_str = str(dialog["user_id"])
-    if user_id_str in dialogs_data["user_active_dialogs"]:
-        if dialogs_data["user_active_dialogs"][user_id_str] == dialog_id:
-            del dialogs_data["user_active_dialogs"][user_id_str]
-    
-    # Удаляем из активных диалогов оператора (если есть)
-    operator_id_str = str(dialog.get("operator_id", ""))
-    if operator_id_str and operator_id_str in dialogs_data["operator_active_dialogs"]:
-        if dialog_id in dialogs_data["operator_active_dialogs"][operator_id_str]:
-            dialogs_data["operator_active_dialogs"][operator_id_str].remove(dialog_id)
-    
-    # Удаляем сам диалог
-    del dialogs_data["dialogs"][dialog_id]
-    
-    await save_dialogs(dialogs_data)
-    return True
 
+def build_search_query(query: str) -> str | None:
+    """Запрос FTS5 из слов пользователя: все слова обязательны, слова от 3 символов ищутся как префикс"""
+    words = re.findall(r"\w+", query.lower())
+    if not words:
+        return None
+    # Короткий префикс раскрывается в тысячи терминов, поэтому такие слова ищутся целиком
+    return " ".join(f'"{word}"*' if len(word) >= 3 else f'"{word}"' for word in words[:10])
 
-async def delete_dialog(dialog_id: str) -> bool:
-    """Полностью удаляет диалог из истории"""
-    dialogs_data = await load_dialogs()
-    
-    if dialog_id not in dialogs_data["dialogs"]:
-        return False
-    
-    dialog = dialogs_data["dialogs"][dialog_id]
-    
-    # Удаляем из активных диалогов пользователя (если есть)
-    user_id_str = str(dialog["user_id"])
-    if user_id_str in dialogs_data["user_active_dialogs"]:
-        if dialogs_data["user_active_dialogs"][user_id_str] == dialog_id:
-            del dialogs_data["user_active_dialogs"][user_id_str]
-    
-    # Удаляем из активных диалогов оператора (если есть)
-    operator_id_str = str(dialog.get("operator_id", ""))
-    if operator_id_str and operator_id_str in dialogs_data["operator_active_dialogs"]:
-        if dialog_id in dialogs_data["operator_active_dialogs"][operator_id_str]:
-            dialogs_data["operator_active_dialogs"][operator_id_str].remove(dialog_id)
-    
-    # Удаляем сам диалог
-    del dialogs_data["dialogs"][dialog_id]
-    
-    await save_dialogs(dialogs_data)
-    return True
 
+def db_search_dialogs(match: str, count: int) -> list:
+    """Первые count диалогов по релевантности (bm25 лучшего совпадения) с фрагментом найденного текста"""
+    conn = get_search_connection()
+    try:
+        rows_limit = count * 4
+        while True:
+            rows = conn.execute(
+                "SELECT dialog_id, snippet(dialog_search, 2, ?, ?, '…', 12) "
+                "FROM dialog_search WHERE dialog_search MATCH ? ORDER BY rank LIMIT ?",
+                (SEARCH_SNIPPET_START, SEARCH_SNIPPET_END, match, rows_limit)
+            ).fetchall()
+            # Строки идут по убыванию релевантности - для диалога остаётся первое (лучшее) совпадение
+            results = {}
+            for dialog_id, snippet in rows:
+                results.setdefault(dialog_id, snippet)
+            if len(results) >= count or len(rows) < rows_limit:
+                return list(results.items())[:count]
+            rows_limit *= 4
+    finally:
+        conn.close()
 
-# Функция для получения текста кнопки из callback_data
-def get_button_text_from_callback(callback_data: str) -> str:
-    """Получает читаемый текст кнопки из callback_data"""
-    # Убираем префикс service_
-    if callback_data.startswith("service_"):
-        callback_data = callback_data.replace("service_", "")
-    
-    # Маппинг для основных услуг
-    mapping = {
-        "rvp": "РВП",
-        "vnzh": "ВНЖ",
-        "citizenship": "Гражданство",
-        "registration": "Регистрация",
-        "migration_account": "Миграционный учёт",
-        "declaration_3ndfl": "Декларация (3-НДФЛ)",
-        "translation": "Перевод документов",
-        "contracts": "Договоры",
-        "notifications": "Уведомления",
-        "contacts": "Контакты",
-        "migration_account_main": "Миграционный учёт",
-        "migration_account_marriage": "Продление миграционного учёта по браку",
-        "migration_account_parents": "Оформление на основании отца / матери",
-        "contracts_gph": "Гражданско-правовой договор (ГПХ) / трудовой договор",
-        "contracts_rent": "Договор найма / безвозмездного пользования жилым помещением",
-        "contracts_car": "Договор купли-продажи автомобиля / договор аренды",
-        "notifications_residence": "Уведомление о проживании",
-        "notifications_gph_conclusion": "Уведомление о заключении договора ГПХ",
-        "notifications_gph_termination": "Уведомление о расторжении договора ГПХ",
-        "back_to_menu": "Назад (в главное меню)",
-        "back_to_migration_account": "Назад (в Миграционный учёт)",
-        "back_to_contracts": "Назад (в Договоры)",
-        "back_to_notifications": "Назад (в Уведомления)"
-    }
-    
-    return mapping.get(callback_data, callback_data.replace("_", " ").title())
+
+async def search_dialogs(query: str, offset: int = 0, limit: int = DASHBOARD_PAGE_SIZE) -> tuple:
+    """Возвращает ([(dialog_id, фрагмент)], есть ли следующая страница)"""
+    match = build_search_query(query)
+    if not match:
+        return [], False
+    try:
+        results = await asyncio.to_thread(db_search_dialogs, match, offset + limit + 1)
+    except sqlite3.Error as e:
+        print(f"[SEARCH] Ошибка поиска: {e}")
+        return [], False
+    return results[offset:offset + limit], len(results) > offset + limit
 
 
 # Функция для форматирования номера телефона с гиперссылкой
@@ -420,39 +1810,35 @@ async def send_dialog_notification(dialog_id: str, user_info: dict, button_path:
     """Отправляет уведомление о новом диалоге админу, оператору и в канал"""
     try:
         message_text = "🔔 <b>Новое обращение к оператору</b>\n\n"
-        message_text += f"👤 <b>Имя:</b> {user_info.get('name', 'Не указано')}\n"
-        phone_formatted = format_phone_number(user_info.get('phone', 'Не указан'))
+        message_text += f"👤 <b>Имя:</b> {html.escape(str(user_info.get('name', 'Не указано')))}\n"
+        phone_formatted = html.escape(format_phone_number(user_info.get('phone', 'Не указан')))
         message_text += f"📱 <b>Номер телефона:</b> {phone_formatted}\n"
         
         if user_info.get('username'):
-            message_text += f"🔗 <b>Username:</b> @{user_info['username']}\n"
+            message_text += f"🔗 <b>Username:</b> @{html.escape(user_info['username'])}\n"
         else:
             message_text += f"🔗 <b>Username:</b> Не указан\n"
         
         if button_path:
             message_text += f"\n📍 <b>Путь нажатых кнопок:</b>\n"
             for i, button in enumerate(button_path, 1):
-                message_text += f"{i}. {button}\n"
+                message_text += f"{i}. {html.escape(str(button))}\n"
         else:
             message_text += "\n📍 <b>Путь нажатых кнопок:</b> Главное меню\n"
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Принять диалог", callback_data=f"accept_dialog_{dialog_id}")]
-        ])
-        
         # Формируем текст для канала (без ID пользователя)
         channel_text = "🔔 <b>Новое обращение к оператору</b>\n\n"
-        channel_text += f"👤 <b>Имя:</b> {user_info.get('name', 'Не указано')}\n"
-        phone_formatted = format_phone_number(user_info.get('phone', 'Не указан'))
+        channel_text += f"👤 <b>Имя:</b> {html.escape(str(user_info.get('name', 'Не указано')))}\n"
+        phone_formatted = html.escape(format_phone_number(user_info.get('phone', 'Не указан')))
         channel_text += f"📱 <b>Номер телефона:</b> {phone_formatted}\n"
         
         if user_info.get('username'):
-            channel_text += f"🔗 <b>Username:</b> @{user_info['username']}\n"
+            channel_text += f"🔗 <b>Username:</b> @{html.escape(user_info['username'])}\n"
         
         if button_path:
             channel_text += f"\n📍 <b>Путь нажатых кнопок:</b>\n"
             for i, button in enumerate(button_path, 1):
-                channel_text += f"{i}. {button}\n"
+                channel_text += f"{i}. {html.escape(str(button))}\n"
         else:
             channel_text += "\n📍 <b>Путь нажатых кнопок:</b> Главное меню\n"
         
@@ -467,18 +1853,14 @@ async def send_dialog_notification(dialog_id: str, user_info: dict, button_path:
         except Exception as e:
             print(f"[NOTIFICATION] Ошибка отправки в канал: {e}")
         
-        # Отправляем всем операторам
-        for operator_id in OPERATOR_IDS:
-            try:
-                await bot.send_message(
-                    chat_id=operator_id,
-                    text=message_text,
-                    parse_mode="HTML",
-                    reply_markup=keyboard
-                )
-                print(f"[NOTIFICATION] Уведомление отправлено оператору {operator_id}")
-            except Exception as e:
-                print(f"[NOTIFICATION] Ошибка отправки оператору {operator_id}: {e}")
+        # Карточку диалога получает назначенный оператор, а если назначить некому - операторы на месте
+        operator_id = await assign_dialog(dialog_id)
+        dialogs_data = await load_dialogs()
+        dialog = dialogs_data["dialogs"].get(dialog_id)
+        if operator_id:
+            print(f"[ASSIGN] Диалог {dialog_id} назначен оператору {operator_id}")
+            schedule_offer_timeout(dialog_id, operator_id)
+        await notify_operators(dialog_id, dialog, [operator_id] if operator_id else present_operators(), message_text)
         
         print(f"[NOTIFICATION] Уведомления о диалоге {dialog_id} отправлены")
         
@@ -488,6 +1870,302 @@ async def send_dialog_notification(dialog_id: str, user_info: dict, button_path:
         traceback.print_exc()
 
 
+async def notify_operators(dialog_id: str, dialog: dict | None, operator_ids, fallback_text: str = None):
+    """Отправляет операторам карточку диалога и запоминает её для обновления на месте"""
+    cards = {}
+    for operator_id in operator_ids:
+        try:
+            if dialog:
+                card_text, card_keyboard = render_dialog_card(dialog_id, dialog, operator_id)
+            else:
+                card_text, card_keyboard = fallback_text, InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="✅ Принять диалог", callback_data=pack_callback("accept_dialog", dialog_id))]
+                ])
+            sent = await bot.send_message(
+                chat_id=operator_id,
+                text=card_text,
+                parse_mode="HTML",
+                reply_markup=card_keyboard
+            )
+            cards[str(operator_id)] = sent.message_id
+            print(f"[NOTIFICATION] Уведомление отправлено оператору {operator_id}")
+        except Exception as e:
+            print(f"[NOTIFICATION] Ошибка отправки оператору {operator_id}: {e}")
+    
+    if cards:
+        await register_dialog_cards(dialog_id, cards)
+
+
+# Сколько последних сообщений пользователя показывать в карточке диалога
+DIALOG_CARD_MESSAGES = 5
+
+
+def render_dialog_card(dialog_id: str, dialog: dict, operator_id: int):
+    """Формирует текст и клавиатуру карточки диалога для конкретного оператора"""
+    # Всё, что ввёл пользователь, экранируется: иначе один "<" ломает отправку и обновление карточки
+    username_text = f"@{dialog['username']}" if dialog.get("username") else "Не указан"
+    phone_formatted = format_phone_number(dialog.get('user_phone', 'Не указан'))
+    info_text = f"👤 <b>Имя:</b> {html.escape(str(dialog.get('user_name', 'Не указано')))}\n"
+    info_text += f"📱 <b>Номер телефона:</b> {html.escape(phone_formatted)}\n"
+    info_text += f"🔗 <b>Username:</b> {html.escape(username_text)}\n"
+    
+    status = dialog.get("status")
+    keyboard = None
+    
+    if status == "pending":
+        text = "🔔 <b>Новое обращение к оператору</b>\n\n"
+        if dialog.get("assigned_to") == operator_id:
+            text += "🎯 <b>Назначено вам</b>\n\n"
+        text += info_text
+        button_path = dialog.get("button_path") or []
+        if button_path:
+            text += f"\n📍 <b>Путь нажатых кнопок:</b>\n"
+            for i, button in enumerate(button_path, 1):
+                text += f"{i}. {html.escape(str(button))}\n"
+        else:
+            text += "\n📍 <b>Путь нажатых кнопок:</b> Главное меню\n"
+        
+        # Последние сообщения пользователя, пока диалог никто не принял
+        user_messages = [message_label(m) for m in dialog.get("messages", []) if m.get("from") == "user"]
+        if user_messages:
+            text += f"\n💬 <b>Сообщения ({len(user_messages)}):</b>\n"
+            for message_text in user_messages[-DIALOG_CARD_MESSAGES:]:
+                if len(message_text) > 300:
+                    message_text = message_text[:300] + "..."
+                text += f"• {html.escape(message_text)}\n"
+        
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Принять диалог", callback_data=pack_callback("accept_dialog", dialog_id))]
+        ])
+    elif status == "active":
+        if dialog.get("operator_id") == operator_id:
+            text = "📞 <b>Диалог принят вами</b>\n\n" + info_text
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="💬 Ответить", callback_data=pack_callback("reply_dialog", dialog_id))],
+                [InlineKeyboardButton(text="❌ Закрыть", callback_data=pack_callback("close_dialog", dialog_id))]
+            ])
+        else:
+            text = "✅ <b>Диалог принят другим оператором</b>\n\n" + info_text
+        text += f"⏰ Принят: {dialog.get('accepted_at', 'N/A')}\n"
+    else:
+        text = "❌ <b>Диалог закрыт</b>\n\n" + info_text
+        text += f"⏰ Закрыт: {dialog.get('closed_at', 'N/A')}\n"
+    
+    return text, keyboard
+
+
+async def register_dialog_cards(dialog_id: str, cards: dict):
+    """Сохраняет message_id карточек диалога в чатах операторов"""
+    async with dialogs_lock:
+        dialogs_data = await load_dialogs()
+        dialog = dialogs_data["dialogs"].get(dialog_id)
+        if not dialog:
+            return
+        
+        dialog.setdefault("notification_messages", {}).update(cards)
+        await save_dialogs(dialogs_data)
+
+
+async def update_dialog_cards(dialog_id: str, dialog: dict | None = None) -> dict:
+    """Обновляет на месте все карточки диалога у операторов. Возвращает карточки {chat_id: message_id}"""
+    if dialog is None:
+        dialogs_data = await load_dialogs()
+        dialog = dialogs_data["dialogs"].get(dialog_id)
+        if not dialog:
+            return {}
+    
+    cards = dialog.get("notification_messages") or {}
+    for chat_id, message_id in cards.items():
+        text, keyboard = render_dialog_card(dialog_id, dialog, int(chat_id))
+        try:
+            await bot.edit_message_text(
+                chat_id=int(chat_id),
+                message_id=message_id,
+                text=text,
+                parse_mode="HTML",
+                reply_markup=keyboard
+            )
+        except Exception as e:
+            if "message is not modified" not in str(e):
+                print(f"[NOTIFICATION] Не удалось обновить карточку диалога {dialog_id} у {chat_id}: {e}")
+    
+    return cards
+
+
+def is_dialog_card(dialog: dict, message: Message) -> bool:
+    """Проверяет, является ли сообщение карточкой этого диалога"""
+    cards = dialog.get("notification_messages") or {}
+    return cards.get(str(message.chat.id)) == message.message_id
+
+
+# Вложения в диалогах пересылаются копированием (copy_message/copy_messages) по message_id:
+# файлы не скачиваются, в истории остаются только тип, file_id и подпись
+MEDIA_LABELS = {
+    "photo": "📷 Фото",
+    "document": "📄 Документ",
+    "video": "🎬 Видео",
+    "animation": "🎞 GIF",
+    "audio": "🎵 Аудио",
+    "voice": "🎤 Голосовое сообщение",
+    "video_note": "📹 Видеосообщение",
+    "sticker": "🏷 Стикер"
+}
+
+# Сколько секунд ждать следующую часть альбома, прежде чем переслать его целиком
+MEDIA_GROUP_DELAY = 1.0
+
+# Собираемые альбомы: (chat_id, media_group_id) -> {"messages": [...], "task": задача пересылки}
+media_group_buffers = {}
+
+
+def message_media(message: Message) -> dict:
+    """Вложение сообщения для истории диалога: тип и file_id (у фото - самого большого размера)"""
+    content_type = getattr(message.content_type, "value", message.content_type)
+    content = getattr(message, content_type, None)
+    if content_type == "photo":
+        content = content[-1]
+    media = {"type": content_type}
+    if getattr(content, "file_id", None):
+        media["file_id"] = content.file_id
+    return media
+
+
+def message_label(message: dict) -> str:
+    """Текст сообщения из истории, для вложения - его тип и подпись"""
+    text = message.get("text") or ""
+    media = message.get("media")
+    if not media:
+        return text
+    label = MEDIA_LABELS.get(media["type"], "📎 Вложение")
+    return f"{label}: {text}" if text else label
+
+
+def collect_media_group(message: Message, on_complete):
+    """Копит части альбома; on_complete(сообщения) вызывается, когда новых частей нет MEDIA_GROUP_DELAY секунд"""
+    key = (message.chat.id, message.media_group_id)
+    buffer = media_group_buffers.setdefault(key, {"messages": [], "task": None})
+    buffer["messages"].append(message)
+    if buffer["task"]:
+        buffer["task"].cancel()
+    buffer["task"] = asyncio.create_task(flush_media_group(key, on_complete))
+
+
+async def flush_media_group(key: tuple, on_complete):
+    await asyncio.sleep(MEDIA_GROUP_DELAY)
+    buffer = media_group_buffers.pop(key)
+    try:
+        await on_complete(sorted(buffer["messages"], key=lambda message: message.message_id))
+    except Exception:
+        import traceback
+        print(f"[MEDIA] Ошибка пересылки альбома {key[1]}:")
+        traceback.print_exc()
+
+
+def relay_targets(dialog_id: str, dialog: dict) -> tuple:
+    """Получатели сообщений пользователя и клавиатура под пересылкой"""
+    if dialog["status"] == "pending":
+        # Диалог ожидает - отправляем назначенному оператору, а если его нет - операторам на месте
+        recipients = [dialog["assigned_to"]] if dialog.get("assigned_to") else present_operators()
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="💬 Ответить", callback_data=pack_callback("reply_dialog", dialog_id))]
+        ])
+    else:
+        # Диалог активен - отправляем назначенному оператору
+        recipients = [dialog["operator_id"]]
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="💬 Ответить", callback_data=pack_callback("reply_dialog", dialog_id))],
+            [InlineKeyboardButton(text="❌ Закрыть", callback_data=pack_callback("close_dialog", dialog_id))]
+        ])
+    return recipients, keyboard
+
+
+def relay_header(dialog: dict) -> str:
+    username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
+    phone_formatted = format_phone_number(dialog.get('user_phone', 'Не указан'))
+    header = f"💬 <b>Сообщение от {html.escape(str(dialog['user_name']))}</b> ({html.escape(username_text)})\n\n"
+    header += f"📱 {html.escape(phone_formatted)}\n\n"
+    return header
+
+
+async def relay_user_media(dialog_id: str, messages: list):
+    """Сохраняет вложения пользователя в истории и копирует их операторам: альбом - одним вызовом copy_messages"""
+    await add_messages_to_dialog(dialog_id, "user", [(message.caption or "", message_media(message)) for message in messages])
+    dialogs_data = await load_dialogs()
+    dialog = dialogs_data["dialogs"].get(dialog_id)
+    if not dialog or dialog["status"] not in ["active", "pending"]:
+        return
+    if dialog["status"] == "pending" and dialog.get("notification_messages"):
+        await update_dialog_cards(dialog_id, dialog)
+    
+    recipients, keyboard = relay_targets(dialog_id, dialog)
+    labels = [message_label({"text": "", "media": message_media(message)}) for message in messages]
+    summary = labels[0] if len(labels) == 1 else f"📎 Вложений: {len(labels)}"
+    for operator_id in recipients:
+        try:
+            await bot.send_message(chat_id=operator_id, text=relay_header(dialog) + html.escape(summary), parse_mode="HTML", reply_markup=keyboard)
+            await bot.copy_messages(
+                chat_id=operator_id,
+                from_chat_id=messages[0].chat.id,
+                message_ids=[message.message_id for message in messages]
+            )
+        except Exception as e:
+            print(f"[DIALOG ERROR] Ошибка пересылки вложений оператору {operator_id}: {e}")
+
+
+# Пересылка сообщения пользователя операторам с объединением серии сообщений
+async def relay_user_message(dialog_id: str, dialog: dict, text: str):
+    """Отправляет сообщение пользователя операторам.
+
+    Если предыдущая пересылка в чат оператора была недавно (RELAY_MERGE_WINDOW)
+    и всё ещё является последним сообщением в чате, новое сообщение дописывается
+    в неё редактированием вместо отправки нового сообщения."""
+    header = relay_header(dialog)
+    recipients, keyboard = relay_targets(dialog_id, dialog)
+    text = html.escape(text)
+    
+    now = time.monotonic()
+    for operator_id in recipients:
+        relay = dialog_relays.get((dialog_id, operator_id))
+        
+        # Пробуем дописать сообщение в предыдущую пересылку
+        if (relay and RELAY_MERGE_WINDOW > 0
+                and now - relay["updated_at"] <= RELAY_MERGE_WINDOW
+                and relay["status"] == dialog["status"]
+                and chat_last_message_id.get(operator_id) == relay["message_id"]):
+            merged_texts = relay["texts"] + [text]
+            merged_text = header + "\n\n".join(merged_texts)
+            if len(merged_text) <= 4096:
+                try:
+                    await bot.edit_message_text(
+                        chat_id=operator_id,
+                        message_id=relay["message_id"],
+                        text=merged_text,
+                        parse_mode="HTML",
+                        reply_markup=keyboard
+                    )
+                    relay["texts"] = merged_texts
+                    relay["updated_at"] = now
+                    continue
+                except Exception as e:
+                    print(f"[DIALOG] Не удалось дополнить сообщение оператору {operator_id}: {e}")
+        
+        try:
+            sent = await bot.send_message(
+                chat_id=operator_id,
+                text=header + text,
+                parse_mode="HTML",
+                reply_markup=keyboard
+            )
+            dialog_relays[(dialog_id, operator_id)] = {
+                "message_id": sent.message_id,
+                "texts": [text],
+                "status": dialog["status"],
+                "updated_at": now
+            }
+        except Exception as e:
+            print(f"[DIALOG ERROR] Ошибка отправки оператору {operator_id}: {e}")
+
+
 # Функция для создания безопасного callback_data из текста кнопки
 def button_to_callback(button_text: str) -> str:
     """Преобразует текст кнопки в безопасный callback_data"""
@@ -507,42 +2185,355 @@ def button_to_callback(button_text: str) -> str:
     return mapping.get(button_text, button_text.lower().replace(" ", "_").replace("(", "").replace(")", "").replace("-", "_"))
 
 
-# Маппинг для восстановления исходного названия из callback_data
-CALLBACK_TO_BUTTON = {
-    "rvp": "РВП",
-    "vnzh": "ВНЖ",
-    "citizenship": "Гражданство",
-    "registration": "Регистрация",
-    "migration_account": "Миграционный учёт",
-    "declaration_3ndfl": "Декларация (3-НДФЛ)",
-    "translation": "Перевод документов",
-    "contracts": "Договоры",
-    "notifications": "Уведомления",
-    "contacts": "Контакты"
+# ==========================================
+# Каталог услуг
+# ==========================================
+
+# Каталог хранится в buttons.json под ключом "catalog": идентификатор узла -> описание узла.
+# title - название услуги, text_key - ключ текста в texts.json, button_key - ключ своей подписи кнопки,
+# children - строки кнопок с идентификаторами дочерних узлов. Корень каталога - главное меню.
+CATALOG_ROOT = "root"
+
+# Максимальная длина идентификатора узла, чтобы влезть в "edit_button_text:<id>"
+CATALOG_ID_MAX_BYTES = 40
+
+DEFAULT_CATALOG = {
+    CATALOG_ROOT: {"children": [
+        ["rvp", "vnzh", "citizenship"],
+        ["registration", "migration_account"],
+        ["declaration_3ndfl", "translation"],
+        ["contracts", "notifications"],
+        ["contacts"]
+    ]},
+    "rvp": {"title": "РВП", "text_key": "service_rvp", "button_key": "button_text_main_rvp"},
+    "vnzh": {"title": "ВНЖ", "text_key": "service_vnzh", "button_key": "button_text_main_vnzh"},
+    "citizenship": {"title": "Гражданство", "text_key": "service_citizenship", "button_key": "button_text_main_citizenship"},
+    "registration": {"title": "Регистрация", "text_key": "service_registration", "button_key": "button_text_main_registration"},
+    "migration_account": {
+        "title": "Миграционный учёт", "text_key": "service_migration_account", "button_key": "button_text_main_migration_account",
+        "children": [["migration_account_main"], ["migration_account_marriage"], ["migration_account_parents"]]
+    },
+    "migration_account_main": {"title": "Миграционный учёт", "text_key": "service_migration_account_main", "button_key": "button_text_migration_sub_1"},
+    "migration_account_marriage": {"title": "Продление миграционного учёта по браку", "text_key": "service_migration_account_marriage", "button_key": "button_text_migration_sub_2"},
+    "migration_account_parents": {"title": "Оформление на основании отца / матери", "text_key": "service_migration_account_parents", "button_key": "button_text_migration_sub_3"},
+    "declaration_3ndfl": {"title": "Декларация (3-НДФЛ)", "text_key": "service_declaration_3ndfl", "button_key": "button_text_main_declaration_3ndfl"},
+    "translation": {"title": "Перевод документов", "text_key": "service_translation", "button_key": "button_text_main_translation"},
+    "contracts": {
+        "title": "Договоры", "text_key": "service_contracts", "button_key": "button_text_main_contracts",
+        "children": [["contracts_gph"], ["contracts_rent"], ["contracts_car"]]
+    },
+    "contracts_gph": {"title": "Гражданско-правовой договор (ГПХ) / трудовой договор", "text_key": "service_contracts_gph", "button_key": "button_text_contracts_sub_1"},
+    "contracts_rent": {"title": "Договор найма / безвозмездного пользования жилым помещением", "text_key": "service_contracts_rent", "button_key": "button_text_contracts_sub_2"},
+    "contracts_car": {"title": "Договор купли-продажи автомобиля / договор аренды", "text_key": "service_contracts_car", "button_key": "button_text_contracts_sub_3"},
+    "notifications": {
+        "title": "Уведомления", "text_key": "service_notifications", "button_key": "button_text_main_notifications",
+        "children": [["notifications_residence"], ["notifications_gph_conclusion"], ["notifications_gph_termination"]]
+    },
+    "notifications_residence": {"title": "Уведомление о проживании", "text_key": "service_notifications_residence", "button_key": "button_text_notifications_sub_1"},
+    "notifications_gph_conclusion": {"title": "Уведомление о заключении договора ГПХ", "text_key": "service_notifications_gph_conclusion", "button_key": "button_text_notifications_sub_2"},
+    "notifications_gph_termination": {"title": "Уведомление о расторжении договора ГПХ", "text_key": "service_notifications_gph_termination", "button_key": "button_text_notifications_sub_3"},
+    "contacts": {"title": "Контакты", "text_key": "service_contacts", "button_key": "button_text_main_contacts"}
 }
 
+# Индекс узлов каталога в памяти; перестраивается, когда меняется buttons.json
+catalog_cache = {"mtime": None, "nodes": {}, "version": 0}
 
-# Функция для создания главного меню
-async def get_main_menu_keyboard():
-    buttons_data = await load_buttons()
-    texts = await load_texts()
-    menu_buttons = buttons_data.get("main_menu", [])
+
+def valid_catalog_id(node_id: str) -> bool:
+    """Идентификатор узла влезает в callback_data кнопок каталога"""
+    return node_id.isascii() and ":" not in node_id and len(node_id.encode()) <= CATALOG_ID_MAX_BYTES
+
+
+def catalog_node_id(button_text: str) -> str:
+    """Идентификатор узла для кнопки из старого формата main_menu"""
+    key = button_to_callback(button_text)
+    if valid_catalog_id(key):
+        return key
+    # Длинный или не латинский текст кнопки заменяем контрольной суммой
+    return f"n{zlib.crc32(button_text.encode()):08x}"
+
+
+def catalog_from_main_menu(main_menu) -> dict:
+    """Строит каталог из старого списка кнопок главного меню, сохраняя ключи текстов"""
+    catalog = json.loads(json.dumps(DEFAULT_CATALOG))
+    if main_menu is None:
+        return catalog
     
-    keyboard_buttons = []
-    for row in menu_buttons:
-        row_buttons = []
+    root_rows = []
+    for row in main_menu:
+        row_ids = []
         for btn in row:
-            callback_data_value = button_to_callback(btn)
-            full_callback = f"service_{callback_data_value}"
-            # Проверяем, есть ли сохраненный текст кнопки
-            button_text_key = f"button_text_main_{callback_data_value}"
-            button_text = texts.get(button_text_key, btn)
-            row_buttons.append(InlineKeyboardButton(text=button_text, callback_data=full_callback))
-        keyboard_buttons.append(row_buttons)
+            key = button_to_callback(btn)
+            node_id = key if key in DEFAULT_CATALOG else catalog_node_id(btn)
+            if node_id not in catalog:
+                catalog[node_id] = {"title": btn, "text_key": f"service_{key}", "button_key": f"button_text_main_{key}"}
+            row_ids.append(node_id)
+        root_rows.append(row_ids)
+    catalog[CATALOG_ROOT] = {"children": root_rows}
+    return catalog
+
+
+def build_catalog_index(catalog: dict) -> dict:
+    """Строит индекс узлов с указателями на родителя"""
+    # Идентификаторы, которые не влезут в callback_data, заменяем контрольной суммой, как в catalog_node_id
+    ids = {}
+    for node_id in catalog:
+        ids[node_id] = node_id if valid_catalog_id(node_id) else f"n{zlib.crc32(node_id.encode()):08x}"
+        if ids[node_id] != node_id:
+            print(f"[CATALOG] Идентификатор узла {node_id!r} длиннее {CATALOG_ID_MAX_BYTES} байт или не латинский, используется {ids[node_id]}")
+    nodes = {}
+    for node_id, node in catalog.items():
+        nodes[ids[node_id]] = {
+            "id": ids[node_id],
+            "title": node.get("title", node_id),
+            "text_key": node.get("text_key", f"service_{node_id}"),
+            "button_key": node.get("button_key", f"button_text_{node_id}"),
+            "skill": node.get("skill"),
+            "children": [[ids[child_id] for child_id in row if child_id in catalog] for row in node.get("children", [])],
+            "parent": None
+        }
+    nodes.setdefault(CATALOG_ROOT, {"id": CATALOG_ROOT, "title": "", "text_key": "welcome_message", "button_key": "", "skill": None, "children": [], "parent": None})
+    for node in nodes.values():
+        for row in node["children"]:
+            for child_id in row:
+                nodes[child_id]["parent"] = node["id"]
+    return nodes
+
+
+async def get_catalog_index(refresh: bool = False) -> dict:
+    """Возвращает индекс каталога из памяти; с refresh перечитывает buttons.json, если файл изменился"""
+    if catalog_cache["nodes"] and not refresh:
+        return catalog_cache["nodes"]
+    try:
+        mtime = os.stat(BUTTONS_FILE).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if mtime != catalog_cache["mtime"] or not catalog_cache["nodes"]:
+        buttons = await load_buttons()
+        catalog = buttons.get("catalog") or catalog_from_main_menu(buttons.get("main_menu"))
+        catalog_cache["nodes"] = build_catalog_index(catalog)
+        catalog_cache["mtime"] = mtime
+        catalog_cache["version"] += 1
+    return catalog_cache["nodes"]
+
+
+def catalog_label(node: dict, texts: dict, locale: str = DEFAULT_LOCALE) -> str:
+    """Подпись кнопки узла: своя из texts.json или название услуги"""
+    return localized(texts, node["button_key"], locale, node["title"])
+
+
+def catalog_path(nodes: dict, node_id: str) -> list:
+    """Узлы от главного меню до указанного (без корня)"""
+    path = []
+    node = nodes.get(node_id)
+    while node and node["id"] != CATALOG_ROOT and len(path) < len(nodes):
+        path.append(node)
+        node = nodes.get(node["parent"])
+    path.reverse()
+    return path
+
+
+def catalog_skill(nodes: dict, node_id: str) -> str | None:
+    """Навык для диалога из раздела: ближайшее поле "skill" на пути к разделу или id раздела верхнего уровня"""
+    path = catalog_path(nodes, node_id)
+    for node in reversed(path):
+        if node["skill"]:
+            return node["skill"]
+    return path[0]["id"] if path else None
+
+
+def iter_catalog(nodes: dict, node_id: str = CATALOG_ROOT, depth: int = 0, seen=None):
+    """Обходит каталог в порядке отображения, возвращая (узел, глубина)"""
+    seen = seen if seen is not None else {node_id}
+    for row in nodes.get(node_id, {}).get("children", []):
+        for child_id in row:
+            if child_id in seen:
+                continue
+            seen.add(child_id)
+            yield nodes[child_id], depth
+            yield from iter_catalog(nodes, child_id, depth + 1, seen)
+
+
+# ==========================================
+# Маршрутизация callback-запросов
+# ==========================================
+
+# callback_data имеет вид "действие" или "действие:аргумент", действие - ключ в таблице маршрутов
+CALLBACK_ROUTES = {}
+
+# Лимит Telegram на длину callback_data
+CALLBACK_DATA_MAX_BYTES = 64
+
+# Кнопки в старом формате "действие_аргумент", отправленные до перехода на новый формат
+LEGACY_CALLBACK_ACTIONS = ("accept_dialog", "reply_dialog", "close_dialog", "delete_dialog", "cancel_user_dialog", "service")
+
+
+def callback_route(*actions):
+    """Регистрирует обработчик для перечисленных действий"""
+    def decorator(handler):
+        for action in actions:
+            CALLBACK_ROUTES[action] = handler
+        return handler
+    return decorator
+
+
+def pack_callback(action: str, arg=None) -> str:
+    """Собирает callback_data из действия и аргумента"""
+    data = action if arg is None else f"{action}:{arg}"
+    if len(data.encode()) > CALLBACK_DATA_MAX_BYTES:
+        raise ValueError(f"callback_data длиннее {CALLBACK_DATA_MAX_BYTES} байт: {data}")
+    return data
+
+
+def unpack_callback(data: str) -> tuple[str, str]:
+    """Разбирает callback_data на действие и аргумент"""
+    action, _, arg = data.partition(":")
+    if not arg and action not in CALLBACK_ROUTES:
+        for legacy_action in LEGACY_CALLBACK_ACTIONS:
+            if action.startswith(legacy_action + "_"):
+                return legacy_action, action[len(legacy_action) + 1:]
+    return action, arg
+
+
+# Недавние нажатия кнопок: (user_id, callback_data, сообщение) -> время нажатия.
+# Записи добавляются по времени, поэтому устаревшие всегда в начале словаря.
+recent_callbacks = {}
+
+# Действия, повтор которых что-то меняет: диалоги, рассылки, выгрузка. Навигация (меню, панель, поиск)
+# редактирует сообщение на месте, и те же кнопки в нём нажимаются снова, поэтому её не отсеиваем
+DEDUP_CALLBACK_ACTIONS = frozenset((
+    "chat_operator", "accept_dialog", "reply_dialog", "close_dialog", "delete_dialog", "cancel_user_dialog",
+    "export", "confirm_broadcast", "confirm_schedule"
+))
+
+
+def callback_dedup_key(callback: CallbackQuery) -> tuple:
+    message_id = callback.message.message_id if callback.message else callback.inline_message_id
+    return (callback.from_user.id, callback.data, message_id)
+
+
+def is_duplicate_callback(key: tuple) -> bool:
+    """Проверяет, нажималась ли та же кнопка недавно, и запоминает нажатие"""
+    now = time.monotonic()
+    while recent_callbacks:
+        oldest_key = next(iter(recent_callbacks))
+        if now - recent_callbacks[oldest_key] < CALLBACK_DEDUP_TTL:
+            break
+        del recent_callbacks[oldest_key]
+
+    if key in recent_callbacks:
+        return True
+    recent_callbacks[key] = now
+    return False
+
+
+# Единственный обработчик callback-запросов: выбор обработчика - один поиск в словаре
+@dp.callback_query()
+async def route_callback(callback: CallbackQuery, state: FSMContext):
+    action, _ = unpack_callback(callback.data or "")
+    handler = CALLBACK_ROUTES.get(action)
+    if handler is None:
+        await callback.answer()
+        return
+
+    # Двойное нажатие (например, «Принять» или «Закрыть») отвечаем сразу, не выполняя обработчик повторно
+    dedup_key = callback_dedup_key(callback)
+    if CALLBACK_DEDUP_TTL > 0 and action in DEDUP_CALLBACK_ACTIONS and is_duplicate_callback(dedup_key):
+        await callback.answer()
+        return
+
+    try:
+        await handler(callback, state)
+    except Exception:
+        # Нажатие, которое не удалось обработать, можно повторить сразу
+        recent_callbacks.pop(dedup_key, None)
+        raise
+
+
+# Готовые клавиатуры каталога по (узел, язык); сбрасываются при изменении текстов или каталога
+keyboard_cache = {"version": None, "keyboards": {}}
+
+
+# Клавиатура узла каталога: дочерние узлы и "Назад" или "Чат с оператором" и "Назад" для услуги
+def get_catalog_keyboard(nodes: dict, node: dict, texts: dict, locale: str = DEFAULT_LOCALE) -> InlineKeyboardMarkup:
+    version = (texts_cache["version"], catalog_cache["version"])
+    if keyboard_cache["version"] != version:
+        keyboard_cache["version"] = version
+        keyboard_cache["keyboards"] = {}
+    keyboard = keyboard_cache["keyboards"].get((node["id"], locale))
+    if keyboard is None:
+        keyboard = build_catalog_keyboard(nodes, node, texts, locale)
+        keyboard_cache["keyboards"][(node["id"], locale)] = keyboard
+    return keyboard
+
+
+def build_catalog_keyboard(nodes: dict, node: dict, texts: dict, locale: str) -> InlineKeyboardMarkup:
+    keyboard_buttons = []
+    for row in node["children"]:
+        keyboard_buttons.append([
+            InlineKeyboardButton(text=catalog_label(nodes[child_id], texts, locale), callback_data=pack_callback("service", child_id))
+            for child_id in row
+        ])
+    
+    if node["id"] == CATALOG_ROOT:
+        return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
     
+    if not node["children"]:
+        chat_text = localized(texts, "button_chat_operator", locale, "💬 Чат с оператором")
+        keyboard_buttons.append([InlineKeyboardButton(text=chat_text, callback_data="chat_operator")])
+    if node["parent"] in (None, CATALOG_ROOT):
+        back_callback = "back_to_menu"
+    else:
+        back_callback = pack_callback("back", node["parent"])
+    back_text = localized(texts, "button_back", locale, "🔙 Назад")
+    keyboard_buttons.append([InlineKeyboardButton(text=back_text, callback_data=back_callback)])
     return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
 
 
+# Функция для создания главного меню
+async def get_main_menu_keyboard(locale: str = DEFAULT_LOCALE):
+    nodes = await get_catalog_index()
+    texts = await load_texts()
+    return get_catalog_keyboard(nodes, nodes[CATALOG_ROOT], texts, locale)
+
+
+# Навигация по меню: сообщение с меню редактируется на месте, новое отправляется только если правка не удалась
+navigation_metrics = {
+    "sent": 0,         # Меню отправлено новым сообщением
+    "edited": 0,       # Меню отредактировано на месте
+    "skipped": 0       # Меню не изменилось, запрос к API не нужен
+}
+
+
+async def show_menu(callback: CallbackQuery, state: FSMContext, text: str, keyboard: InlineKeyboardMarkup,
+                    new_message: bool = False, parse_mode: str = None, **data):
+    """Показывает меню в сообщении с нажатой кнопкой и сохраняет data в состояние вместе со счётчиками сессии"""
+    message = callback.message
+    if new_message or not isinstance(message, Message):
+        kind = "sent"
+    elif message.text == text and message.reply_markup and \
+            message.reply_markup.model_dump(exclude_none=True) == keyboard.model_dump(exclude_none=True):
+        # Сравниваем содержимое: объекты из обновления привязаны к экземпляру бота и напрямую не равны
+        kind = "skipped"
+    else:
+        try:
+            await message.edit_text(text, parse_mode=parse_mode, reply_markup=keyboard)
+            kind = "edited"
+        except TelegramBadRequest as e:
+            # Сообщение удалено, слишком старое или без текста - отправляем меню заново
+            kind = "skipped" if "message is not modified" in str(e) else "sent"
+    
+    if kind == "sent":
+        chat_id = message.chat.id if message else callback.from_user.id
+        await bot.send_message(chat_id, text, parse_mode=parse_mode, reply_markup=keyboard)
+    
+    navigation_metrics[kind] += 1
+    # Счётчики текущей сессии пользователя (сбрасываются по /start вместе с состоянием)
+    session = dict((await state.get_data()).get("navigation") or {})
+    session[kind] = session.get(kind, 0) + 1
+    await state.update_data(navigation=session, **data)
+
+
 # Приветственное сообщение - запрос номера телефона
 @dp.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
@@ -557,13 +2548,9 @@ async def cmd_start(message: Message, state: FSMContext):
         # Номер уже есть - сразу показываем меню
         user_name = message.from_user.first_name or "Пользователь"
         texts = await load_texts()
-        
-        welcome_text = texts.get("welcome_message", 
-            "👋 Добро пожаловать, {name}!\n\n✨ Мы рады приветствовать вас в нашем сервисе!")
-        
-        welcome_text = welcome_text.format(name=user_name)
-        
-        keyboard = await get_main_menu_keyboard()
+        locale = await get_user_locale(message.from_user, state)
+        welcome_text = render_text(texts, "welcome_message", locale, DEFAULT_WELCOME_MESSAGE, name=user_name)
+        keyboard = await get_main_menu_keyboard(locale)
         
         # Удаляем Reply клавиатуру (кнопку телефона), если она есть
         msg = await message.answer("...", reply_markup=ReplyKeyboardRemove())
@@ -598,14 +2585,15 @@ async def handle_contact(message: Message, state: FSMContext):
     user_id = str(message.from_user.id)
     
     # Сохраняем номер телефона в файл
-    phones = await load_phones()
-    phones[user_id] = {
-        "phone": contact.phone_number,
-        "first_name": contact.first_name or message.from_user.first_name,
-        "last_name": contact.last_name or message.from_user.last_name,
-        "username": message.from_user.username
-    }
-    await save_phones(phones)
+    async with phones_lock:
+        phones = await load_phones()
+        phones[user_id] = {
+            "phone": contact.phone_number,
+            "first_name": contact.first_name or message.from_user.first_name,
+            "last_name": contact.last_name or message.from_user.last_name,
+            "username": message.from_user.username
+        }
+        await save_phones(phones)
     
     # Удаляем клавиатуру с кнопкой отправки номера
     await message.answer("✅ Номер телефона сохранён.", reply_markup=ReplyKeyboardRemove())
@@ -613,16 +2601,12 @@ async def handle_contact(message: Message, state: FSMContext):
     # Сразу показываем приветственное сообщение и меню
     user_name = message.from_user.first_name or "Пользователь"
     texts = await load_texts()
-    
-    welcome_text = texts.get("welcome_message", 
-        "👋 Добро пожаловать, {name}!\n\n✨ Мы рады приветствовать вас в нашем сервисе!")
-    
-    welcome_text = welcome_text.format(name=user_name)
-    
-    keyboard = await get_main_menu_keyboard()
+    locale = await get_user_locale(message.from_user, state)
+    welcome_text = render_text(texts, "welcome_message", locale, DEFAULT_WELCOME_MESSAGE, name=user_name)
+    keyboard = await get_main_menu_keyboard(locale)
     
     # Инициализируем путь кнопок для пользователя
-    await state.update_data(button_path=[])
+    await state.update_data(button_path=[], service_node=None)
     
     # Показываем приветствие с inline меню
     await message.answer(welcome_text, reply_markup=keyboard)
@@ -648,16 +2632,8 @@ async def handle_text_instead_of_contact(message: Message):
 # Админка - команда /admin (не требует номер телефона, только для админа)
 @dp.message(Command("admin"))
 async def cmd_admin(message: Message, state: FSMContext):
-    # Перезагружаем конфигурацию для актуальных значений
-    from dotenv import load_dotenv
-    import importlib
-    import config
-    load_dotenv()
-    importlib.reload(config)
-    from config import ADMIN_IDS
-    
-    # Проверяем права доступа с обновленными значениями
-    if message.from_user.id not in ADMIN_IDS:
+    # Роли актуальны: .env перечитывается фоновой проверкой и по SIGHUP
+    if not is_admin(message.from_user.id):
         await message.answer("❌ У вас нет доступа к админ-панели.")
         return
     
@@ -676,6 +2652,103 @@ async def cmd_admin(message: Message, state: FSMContext):
     await message.answer("🔧 Админ-панель", reply_markup=keyboard)
 
 
+# Панель диалогов: одно сообщение с вкладками и страницами, переключение редактирует его на месте
+DASHBOARD_REFRESH_TEXT = "🔄"
+
+
+def render_dashboard(dialogs_data: dict, operator_id: int, tab: str, cursor: int | None = None):
+    """Текст и клавиатура одной страницы вкладки панели диалогов"""
+    title, icon, newest_first = DASHBOARD_TABS[tab]
+    page = query_dialog_page(dialogs_data, get_dashboard_index(dialogs_data, tab, operator_id), cursor, newest_first)
+    
+    text = f"💬 <b>Диалоги</b> — {title}"
+    if page["total"] > DASHBOARD_PAGE_SIZE:
+        text += f" (стр. {page['page']}/{page['pages']})"
+    text += "\n"
+    breached = count_sla_breached(dialogs_data)
+    if breached:
+        text += f"⚠️ Ожидают дольше {format_wait(SLA_PENDING_TIMEOUT)}: <b>{breached}</b>\n"
+    online = sum(1 for member in roles["operators"] if operator_online(member))
+    text += f"🟢 Операторов на месте: {online} из {len(roles['operators'])}\n"
+    breach_threshold = sla_breach_threshold()
+    if not page["items"]:
+        text += "\n📭 Диалогов нет.\n"
+    
+    keyboard_buttons = []
+    for number, (dialog_id, dialog) in enumerate(page["items"], 1):
+        username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
+        phone_formatted = format_phone_number(dialog.get('user_phone', 'Не указан'))
+        text += f"\n{number}. {icon} <b>{html.escape(str(dialog.get('user_name', 'Не указано')))}</b>\n"
+        text += f"📱 {html.escape(phone_formatted)} · 🔗 {html.escape(username_text)}\n"
+        
+        if tab == "pending":
+            overdue = " ⚠️" if SLA_PENDING_TIMEOUT > 0 and dialog["created_at"] <= breach_threshold else ""
+            text += f"⏰ {dialog['created_at']}{overdue}\n"
+            row = [InlineKeyboardButton(text=f"✅ {number}", callback_data=pack_callback("accept_dialog", dialog_id))]
+            # Ожидающий диалог ещё ничей, удалить его может только админ
+            if is_admin(operator_id):
+                row.append(InlineKeyboardButton(text=f"🗑 {number}", callback_data=pack_callback("delete_dialog", dialog_id)))
+        elif tab == "active":
+            text += f"⏰ Принят: {dialog.get('accepted_at', 'N/A')}\n"
+            row = [
+                InlineKeyboardButton(text=f"💬 {number}", callback_data=pack_callback("reply_dialog", dialog_id)),
+                InlineKeyboardButton(text=f"❌ {number}", callback_data=pack_callback("close_dialog", dialog_id)),
+                InlineKeyboardButton(text=f"🗑 {number}", callback_data=pack_callback("delete_dialog", dialog_id))
+            ]
+        else:
+            text += f"⏰ Закрыт: {dialog.get('closed_at', 'N/A')}\n"
+            row = [InlineKeyboardButton(text=f"🗑 {number}", callback_data=pack_callback("delete_dialog", dialog_id))]
+        keyboard_buttons.append(row)
+    
+    # Вкладки с количеством диалогов, текущая отмечена точкой
+    tabs_row = []
+    for tab_code, (tab_title, _, _) in DASHBOARD_TABS.items():
+        label = f"{tab_title.split()[0]} {len(get_dashboard_index(dialogs_data, tab_code, operator_id))}"
+        if tab_code == tab:
+            label = f"• {label}"
+        tabs_row.append(InlineKeyboardButton(text=label, callback_data=pack_callback("dash", tab_code)))
+    keyboard_buttons.append(tabs_row)
+    
+    nav_row = []
+    if page["prev"] is not None:
+        nav_row.append(InlineKeyboardButton(text="◀️", callback_data=pack_callback("dash", f"{tab}:{page['prev']}")))
+    nav_row.append(InlineKeyboardButton(text=DASHBOARD_REFRESH_TEXT, callback_data=pack_callback("dash", f"{tab}:{page['cursor']}")))
+    if page["next"] is not None:
+        nav_row.append(InlineKeyboardButton(text="▶️", callback_data=pack_callback("dash", f"{tab}:{page['next']}")))
+    keyboard_buttons.append(nav_row)
+    
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+
+async def send_dashboard(chat_id: int, operator_id: int):
+    """Отправляет панель диалогов, открывая первую непустую вкладку"""
+    dialogs_data = await load_dialogs()
+    tab = next((code for code in DASHBOARD_TABS if get_dashboard_index(dialogs_data, code, operator_id)), "pending")
+    text, keyboard = render_dashboard(dialogs_data, operator_id, tab)
+    await bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=keyboard)
+
+
+def get_dashboard_page(message) -> tuple | None:
+    """Вкладка и курсор страницы, если сообщение - панель диалогов"""
+    markup = getattr(message, "reply_markup", None)
+    if not markup:
+        return None
+    for row in markup.inline_keyboard:
+        for button in row:
+            if button.text == DASHBOARD_REFRESH_TEXT and button.callback_data:
+                action, arg = unpack_callback(button.callback_data)
+                if action == "dash":
+                    tab, _, cursor = (arg or "").partition(":")
+                    return tab, int(cursor) if cursor.isdigit() else None
+    return None
+
+
+async def refresh_dashboard(callback: CallbackQuery, state: FSMContext, tab: str, cursor: int | None):
+    dialogs_data = await load_dialogs()
+    text, keyboard = render_dashboard(dialogs_data, callback.from_user.id, tab, cursor)
+    await show_menu(callback, state, text, keyboard, parse_mode="HTML")
+
+
 # Команда /dialogs для операторов и админов
 @dp.message(Command("dialogs"))
 async def cmd_dialogs(message: Message, state: FSMContext):
@@ -683,228 +2756,191 @@ async def cmd_dialogs(message: Message, state: FSMContext):
         await message.answer("❌ У вас нет доступа к этой команде.")
         return
     
-    operator_id = message.from_user.id
     await state.clear()
+    await send_dashboard(message.chat.id, message.from_user.id)
+
+
+# Отметка присутствия: /online - на месте, /away - отошёл (уведомления о новых диалогах не приходят)
+@dp.message(Command("online", "away"))
+async def cmd_presence(message: Message):
+    if not is_operator(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
     
-    # Получаем активные диалоги оператора
-    active_dialogs = await get_active_dialogs_for_operator(operator_id)
-    
-    # Получаем ожидающие диалоги (если есть)
-    pending_dialogs = await get_pending_dialogs()
+    status = message.text.split(maxsplit=1)[0].lstrip("/").split("@")[0].lower()
+    await set_operator_status(message.from_user.id, status)
+    if status == "online":
+        await message.answer("🟢 Вы на месте: уведомления о новых диалогах включены.")
+    else:
+        await message.answer("⏸ Вы отошли: уведомления о новых диалогах приходят, только если на месте никого нет. Вернуться - /online")
+
+
+# Поиск по истории диалогов: /search <запрос>, страницы переключаются кнопками "search:<смещение>"
+async def render_search_page(query: str, offset: int):
+    results, has_next = await search_dialogs(query, offset)
+    dialogs_data = await load_dialogs()
+    status_icons = {"pending": "🔔", "active": "👤", "closed": "🔒"}
     
-    # Получаем закрытые диалоги для оператора
-    closed_dialogs = await get_closed_dialogs_for_operator(operator_id)
+    text = f"🔎 <b>Поиск:</b> {html.escape(query)}"
+    if offset:
+        text += f" (стр. {offset // DASHBOARD_PAGE_SIZE + 1})"
+    text += "\n"
+    if not results:
+        text += "\n📭 Ничего не найдено.\n"
     
-    if not active_dialogs and not pending_dialogs and not closed_dialogs:
-        await message.answer("📭 Диалогов нет.")
+    for number, (dialog_id, snippet) in enumerate(results, offset + 1):
+        dialog = dialogs_data["dialogs"].get(dialog_id)
+        if not dialog:
+            continue
+        username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
+        phone_formatted = format_phone_number(dialog.get('user_phone', 'Не указан'))
+        snippet = html.escape(snippet).replace(SEARCH_SNIPPET_START, "<b>").replace(SEARCH_SNIPPET_END, "</b>")
+        text += f"\n{number}. {status_icons.get(dialog['status'], '💬')} <b>{html.escape(str(dialog.get('user_name', 'Не указано')))}</b>"
+        text += f" · 🔗 {html.escape(username_text)}\n"
+        text += f"📱 {html.escape(phone_formatted)} · ⏰ {dialog.get('created_at', 'N/A')}\n"
+        text += f"💬 {snippet}\n"
+    
+    nav_row = []
+    if offset:
+        nav_row.append(InlineKeyboardButton(text="◀️", callback_data=pack_callback("search", str(max(0, offset - DASHBOARD_PAGE_SIZE)))))
+    if has_next:
+        nav_row.append(InlineKeyboardButton(text="▶️", callback_data=pack_callback("search", str(offset + DASHBOARD_PAGE_SIZE))))
+    return text, InlineKeyboardMarkup(inline_keyboard=[nav_row] if nav_row else [])
+
+
+@dp.message(Command("search"))
+async def cmd_search(message: Message, state: FSMContext):
+    if not is_admin_or_operator(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
         return
     
-    response_text = "💬 <b>Список диалогов</b>\n\n"
+    query = (message.text or "").split(maxsplit=1)[1:]
+    if not query or not build_search_query(query[0]):
+        await message.answer("ℹ️ Использование: /search <запрос>\n\nИщет по сообщениям, именам, username и телефонам.")
+        return
     
-    if pending_dialogs:
-        response_text += "⏳ <b>Ожидающие диалоги:</b>\n"
-        for dialog_id, dialog in pending_dialogs:
-            username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
-            phone_formatted = format_phone_number(dialog.get('user_phone', 'Не указан'))
-            response_text += f"\n🔔 <b>{dialog['user_name']}</b>\n"
-            response_text += f"📱 {phone_formatted}\n"
-            response_text += f"🔗 {username_text}\n"
-            response_text += f"⏰ {dialog['created_at']}\n"
-            
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="✅ Принять диалог", callback_data=f"accept_dialog_{dialog_id}")],
-                [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_dialog_{dialog_id}")]
-            ])
-            await message.answer(response_text, parse_mode="HTML", reply_markup=keyboard)
-            response_text = ""  # Очищаем для следующего диалога
-    
-    if active_dialogs:
-        if response_text:
-            response_text += "\n"
-        response_text += "📞 <b>Активные диалоги:</b>\n"
-        for dialog_id, dialog in active_dialogs:
-            username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
-            phone_formatted = format_phone_number(dialog.get('user_phone', 'Не указан'))
-            response_text += f"\n👤 <b>{dialog['user_name']}</b>\n"
-            response_text += f"📱 {phone_formatted}\n"
-            response_text += f"🔗 {username_text}\n"
-            response_text += f"⏰ Принят: {dialog.get('accepted_at', 'N/A')}\n"
-            
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💬 Ответить", callback_data=f"reply_dialog_{dialog_id}")],
-                [InlineKeyboardButton(text="❌ Закрыть", callback_data=f"close_dialog_{dialog_id}")],
-                [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_dialog_{dialog_id}")]
-            ])
-            await message.answer(response_text, parse_mode="HTML", reply_markup=keyboard)
-            response_text = ""  # Очищаем для следующего диалога
-    
-    if closed_dialogs:
-        if response_text:
-            response_text += "\n"
-        response_text += "📁 <b>Закрытые диалоги:</b> (последние 10)\n"
-        for dialog_id, dialog in closed_dialogs[:10]:  # Показываем только последние 10
-            username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
-            phone_formatted = format_phone_number(dialog.get('user_phone', 'Не указан'))
-            response_text += f"\n🔒 <b>{dialog['user_name']}</b>\n"
-            response_text += f"📱 {phone_formatted}\n"
-            response_text += f"🔗 {username_text}\n"
-            response_text += f"⏰ Закрыт: {dialog.get('closed_at', 'N/A')}\n"
-            
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🗑 Удалить из истории", callback_data=f"delete_dialog_{dialog_id}")]
-            ])
-            await message.answer(response_text, parse_mode="HTML", reply_markup=keyboard)
-            response_text = ""  # Очищаем для следующего диалога
-
+    # Запрос запоминается для переключения страниц (в callback_data он может не поместиться)
+    await state.update_data(search_query=query[0])
+    text, keyboard = await render_search_page(query[0], 0)
+    await message.answer(text, parse_mode="HTML", reply_markup=keyboard)
 
-# Обработка callback админки
-@dp.callback_query(F.data.startswith("admin_"))
-async def admin_callback(callback: CallbackQuery, state: FSMContext):
-    # Исключение для кнопки отмены/назад, если пользователь случайно попал сюда
-    if not is_admin(callback.from_user.id):
-        # Если это не кнопка возврата, то запрещаем
-        if callback.data not in ["back_to_admin", "back_to_menu"]:
-             await callback.answer("❌ Нет доступа", show_alert=True)
-             return
-    
-    action = callback.data
-    # Обработка кнопки "Отмена" при рассылке
-    if callback.data == "back_to_admin" or callback.data == "back_to_menu":
-        # Сначала отвечаем на callback, чтобы убрать часики загрузки
-        try:
-            await callback.answer()
-        except:
-            pass
-            
-        await state.clear()
-        if callback.data == "back_to_menu":
-            await callback.message.delete()
-            await cmd_start(callback.message, state)
-        else:
-            await cmd_admin(callback.message, state)
-        return
 
-    # Обработка новых функций ПЕРЕД await callback.answer()
-    if action == "admin_broadcast":
-        # Сначала отвечаем на callback
-        try:
-            await callback.answer()
-        except:
-            pass
-        await start_broadcast(callback, state)
+@callback_route("search")
+async def handle_search_page(callback: CallbackQuery, state: FSMContext):
+    if not is_admin_or_operator(callback.from_user.id):
+        await callback.answer("❌ Нет доступа", show_alert=True)
         return
-    elif action == "admin_scheduled_broadcast":
-        try:
-            await callback.answer()
-        except:
-            pass
-        await start_scheduled_broadcast(callback, state)
+    
+    _, offset = unpack_callback(callback.data)
+    query = (await state.get_data()).get("search_query")
+    if not query:
+        await callback.answer("ℹ️ Повторите поиск: /search <запрос>", show_alert=True)
         return
-    elif action == "admin_statistics":
-        try:
-            await callback.answer()
-        except:
-            pass
-        await admin_statistics(callback)
+    await callback.answer()
+    text, keyboard = await render_search_page(query, int(offset) if offset and offset.isdigit() else 0)
+    await show_menu(callback, state, text, keyboard, parse_mode="HTML")
+
+
+# Переключение вкладок и страниц панели диалогов: "dash:<вкладка>[:<курсор>]"
+@callback_route("dash")
+async def handle_dashboard(callback: CallbackQuery, state: FSMContext):
+    if not is_admin_or_operator(callback.from_user.id):
+        await callback.answer("❌ Нет доступа", show_alert=True)
         return
+    
+    _, arg = unpack_callback(callback.data)
+    tab, _, cursor = (arg or "").partition(":")
+    if tab not in DASHBOARD_TABS:
+        tab = "pending"
+    await callback.answer()
+    await refresh_dashboard(callback, state, tab, int(cursor) if cursor.isdigit() else None)
 
+
+# Обработка callback админки
+async def check_admin_callback(callback: CallbackQuery) -> bool:
+    """Проверяет права админа и отвечает на callback, чтобы убрать часики загрузки"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("❌ Нет доступа", show_alert=True)
+        return False
     try:
         await callback.answer()
     except:
         pass
+    return True
+
+
+@callback_route("admin_edit_texts")
+async def admin_edit_texts(callback: CallbackQuery, state: FSMContext):
+    if not await check_admin_callback(callback):
+        return
     
-    if action == "admin_edit_texts":
-        # Группируем услуги по категориям
-        buttons_list = [
-            [InlineKeyboardButton(text="📝 Приветственное сообщение", callback_data="edit_text_welcome_message")],
-            [InlineKeyboardButton(text="━━━ Основные услуги ━━━", callback_data="admin_noop")],
-            [InlineKeyboardButton(text="✏️ РВП", callback_data="edit_text_service_rvp")],
-            [InlineKeyboardButton(text="✏️ ВНЖ", callback_data="edit_text_service_vnzh")],
-            [InlineKeyboardButton(text="✏️ Гражданство", callback_data="edit_text_service_citizenship")],
-            [InlineKeyboardButton(text="✏️ Регистрация", callback_data="edit_text_service_registration")],
-            [InlineKeyboardButton(text="✏️ Миграционный учёт", callback_data="edit_text_service_migration_account")],
-            [InlineKeyboardButton(text="  └─ Миграционный учёт (основной)", callback_data="edit_text_service_migration_account_main")],
-            [InlineKeyboardButton(text="  └─ По браку", callback_data="edit_text_service_migration_account_marriage")],
-            [InlineKeyboardButton(text="  └─ По отцу/матери", callback_data="edit_text_service_migration_account_parents")],
-            [InlineKeyboardButton(text="━━━ Дополнительные услуги ━━━", callback_data="admin_noop")],
-            [InlineKeyboardButton(text="✏️ Декларация (3-НДФЛ)", callback_data="edit_text_service_declaration_3ndfl")],
-            [InlineKeyboardButton(text="✏️ Перевод документов", callback_data="edit_text_service_translation")],
-            [InlineKeyboardButton(text="━━━ Договоры ━━━", callback_data="admin_noop")],
-            [InlineKeyboardButton(text="✏️ Договоры (меню)", callback_data="edit_text_service_contracts")],
-            [InlineKeyboardButton(text="  └─ ГПХ / Трудовой договор", callback_data="edit_text_service_contracts_gph")],
-            [InlineKeyboardButton(text="  └─ Найм жилья", callback_data="edit_text_service_contracts_rent")],
-            [InlineKeyboardButton(text="  └─ Автомобиль", callback_data="edit_text_service_contracts_car")],
-            [InlineKeyboardButton(text="━━━ Уведомления ━━━", callback_data="admin_noop")],
-            [InlineKeyboardButton(text="✏️ Уведомления (меню)", callback_data="edit_text_service_notifications")],
-            [InlineKeyboardButton(text="  └─ О проживании", callback_data="edit_text_service_notifications_residence")],
-            [InlineKeyboardButton(text="  └─ О заключении ГПХ", callback_data="edit_text_service_notifications_gph_conclusion")],
-            [InlineKeyboardButton(text="  └─ О расторжении ГПХ", callback_data="edit_text_service_notifications_gph_termination")],
-            [InlineKeyboardButton(text="━━━ Контакты ━━━", callback_data="admin_noop")],
-            [InlineKeyboardButton(text="✏️ Контакты", callback_data="edit_text_service_contacts")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-        ]
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons_list)
-        await callback.message.edit_text("📝 Выберите текст для редактирования:", reply_markup=keyboard)
-    
-    elif action == "admin_edit_buttons":
-        # Редактирование текстов кнопок главного меню
-        buttons_data = await load_buttons()
-        main_menu = buttons_data.get("main_menu", [])
-        
-        buttons_list = [
-            [InlineKeyboardButton(text="━━━ Главное меню ━━━", callback_data="admin_noop")]
-        ]
-        
-        for row in main_menu:
-            for btn_text in row:
-                buttons_list.append([
-                    InlineKeyboardButton(text=f"✏️ {btn_text}", callback_data=f"edit_button_text_{btn_text}")
-                ])
-        
-        buttons_list.extend([
-            [InlineKeyboardButton(text="━━━ Подуслуги ━━━", callback_data="admin_noop")],
-            [InlineKeyboardButton(text="✏️ Миграционный учёт", callback_data="edit_button_text_migration_sub_1")],
-            [InlineKeyboardButton(text="✏️ Продление по браку", callback_data="edit_button_text_migration_sub_2")],
-            [InlineKeyboardButton(text="✏️ По отцу/матери", callback_data="edit_button_text_migration_sub_3")],
-            [InlineKeyboardButton(text="✏️ ГПХ/Трудовой договор", callback_data="edit_button_text_contracts_sub_1")],
-            [InlineKeyboardButton(text="✏️ Найм жилья", callback_data="edit_button_text_contracts_sub_2")],
-            [InlineKeyboardButton(text="✏️ Автомобиль", callback_data="edit_button_text_contracts_sub_3")],
-            [InlineKeyboardButton(text="✏️ Уведомление о проживании", callback_data="edit_button_text_notifications_sub_1")],
-            [InlineKeyboardButton(text="✏️ Уведомление о заключении ГПХ", callback_data="edit_button_text_notifications_sub_2")],
-            [InlineKeyboardButton(text="✏️ Уведомление о расторжении ГПХ", callback_data="edit_button_text_notifications_sub_3")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
-        ])
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons_list)
-        await callback.message.edit_text("🔘 Выберите кнопку для редактирования текста:", reply_markup=keyboard)
+    # Тексты услуг в порядке каталога, вложенные услуги с отступом
+    nodes = await get_catalog_index()
+    buttons_list = [
+        [InlineKeyboardButton(text="📝 Приветственное сообщение", callback_data=pack_callback("edit_text", "welcome_message"))]
+    ]
+    for node, depth in iter_catalog(nodes):
+        prefix = "  └─ " if depth else "✏️ "
+        buttons_list.append([InlineKeyboardButton(text=f"{prefix}{node['title']}", callback_data=pack_callback("edit_text", node["id"]))])
+    buttons_list.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")])
+    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons_list)
+    await show_menu(callback, state, "📝 Выберите текст для редактирования:", keyboard)
+
+
+@callback_route("admin_edit_buttons")
+async def admin_edit_buttons(callback: CallbackQuery, state: FSMContext):
+    if not await check_admin_callback(callback):
+        return
     
-    elif action == "admin_back":
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📝 Редактировать текст", callback_data="admin_edit_texts")],
-            [InlineKeyboardButton(text="🔘 Редактировать кнопки", callback_data="admin_edit_buttons")],
-            [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
-            [InlineKeyboardButton(text="⏳ Отложенная рассылка", callback_data="admin_scheduled_broadcast")],
-            [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_statistics")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
+    # Редактирование подписей кнопок каталога
+    nodes = await get_catalog_index()
+    texts = await load_texts()
+    buttons_list = []
+    for node, depth in iter_catalog(nodes):
+        prefix = "  └─ " if depth else "✏️ "
+        buttons_list.append([
+            InlineKeyboardButton(text=f"{prefix}{catalog_label(node, texts)}", callback_data=pack_callback("edit_button_text", node["id"]))
         ])
-        await callback.message.edit_text("🔧 Админ-панель", reply_markup=keyboard)
+    buttons_list.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")])
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons_list)
+    await show_menu(callback, state, "🔘 Выберите кнопку для редактирования текста:", keyboard)
+
+
+@callback_route("admin_back")
+async def admin_back(callback: CallbackQuery, state: FSMContext):
+    if not await check_admin_callback(callback):
+        return
     
-    elif action == "admin_noop":
-        # Пустая операция для неактивных кнопок (заголовки)
-        await callback.answer("ℹ️ Это заголовок раздела", show_alert=False)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📝 Редактировать текст", callback_data="admin_edit_texts")],
+        [InlineKeyboardButton(text="🔘 Редактировать кнопки", callback_data="admin_edit_buttons")],
+        [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton(text="⏳ Отложенная рассылка", callback_data="admin_scheduled_broadcast")],
+        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_statistics")],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
+    ])
+    await show_menu(callback, state, "🔧 Админ-панель", keyboard)
+
+
+# Пустая операция для неактивных кнопок (заголовки)
+@callback_route("admin_noop")
+async def admin_noop(callback: CallbackQuery, state: FSMContext):
+    await callback.answer("ℹ️ Это заголовок раздела", show_alert=False)
 
 
 # Редактирование текста услуги
-@dp.callback_query(F.data.startswith("edit_text_"))
+@callback_route("edit_text")
 async def edit_text_handler(callback: CallbackQuery, state: FSMContext):
     if not is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
-    text_key = callback.data.replace("edit_text_", "")
-    # Если это welcome_message, используем его напрямую, иначе добавляем service_
-    if text_key == "welcome_message":
-        actual_key = "welcome_message"
+    _, text_key = unpack_callback(callback.data)
+    # Для узла каталога берём ключ его текста, иначе это сам ключ (например, welcome_message)
+    nodes = await get_catalog_index()
+    if text_key in nodes and text_key != CATALOG_ROOT:
+        actual_key = nodes[text_key]["text_key"]
     else:
         actual_key = text_key
     
@@ -931,7 +2967,7 @@ async def edit_text_handler(callback: CallbackQuery, state: FSMContext):
 
 
 # Добавление нового текста
-@dp.callback_query(F.data == "add_new_text")
+@callback_route("add_new_text")
 async def add_new_text_handler(callback: CallbackQuery, state: FSMContext):
     if not is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
@@ -962,7 +2998,7 @@ async def save_text_handler(message: Message, state: FSMContext):
         return
     
     data = await state.get_data()
-    texts = await load_texts()
+    texts = dict(await load_texts())
     
     if data.get("text_key"):
         # Редактирование существующего
@@ -991,57 +3027,25 @@ async def save_text_handler(message: Message, state: FSMContext):
     await message.answer("🔧 Админ-панель", reply_markup=keyboard)
 
 
-# Маппинг для редактирования текста кнопок подуслуг
-BUTTON_TEXT_MAPPING = {
-    "migration_sub_1": ("Миграционный учёт", "service_migration_account_main"),
-    "migration_sub_2": ("Продление миграционного учёта по браку", "service_migration_account_marriage"),
-    "migration_sub_3": ("Оформление на основании отца / матери", "service_migration_account_parents"),
-    "contracts_sub_1": ("Гражданско-правовой договор (ГПХ) / трудовой договор", "service_contracts_gph"),
-    "contracts_sub_2": ("Договор найма / безвозмездного пользования жилым помещением", "service_contracts_rent"),
-    "contracts_sub_3": ("Договор купли-продажи автомобиля / договор аренды", "service_contracts_car"),
-    "notifications_sub_1": ("Уведомление о проживании", "service_notifications_residence"),
-    "notifications_sub_2": ("Уведомление о заключении договора ГПХ", "service_notifications_gph_conclusion"),
-    "notifications_sub_3": ("Уведомление о расторжении договора ГПХ", "service_notifications_gph_termination"),
-}
-
-
 # Редактирование текста кнопки
-@dp.callback_query(F.data.startswith("edit_button_text_"))
+@callback_route("edit_button_text")
 async def edit_button_text_handler(callback: CallbackQuery, state: FSMContext):
     if not is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
-    button_id = callback.data.replace("edit_button_text_", "")
-    buttons_data = await load_buttons()
+    _, button_id = unpack_callback(callback.data)
+    nodes = await get_catalog_index()
+    node = nodes.get(button_id)
     
     # Получаем текущий текст кнопки
-    current_text = None
-    button_text_key = None
-    
-    if button_id.startswith("migration_sub_") or button_id.startswith("contracts_sub_") or button_id.startswith("notifications_sub_"):
-        # Это подуслуга - текст берется из маппинга
-        if button_id in BUTTON_TEXT_MAPPING:
-            current_text, service_key = BUTTON_TEXT_MAPPING[button_id]
-            button_text_key = f"button_text_{button_id}"
-            # Проверяем, есть ли сохраненный текст кнопки
-            texts = await load_texts()
-            saved_text = texts.get(button_text_key, current_text)
-            current_text = saved_text
+    if node and button_id != CATALOG_ROOT:
+        texts = await load_texts()
+        current_text = catalog_label(node, texts)
+        button_text_key = node["button_key"]
     else:
-        # Это кнопка главного меню - берем из buttons.json
-        main_menu = buttons_data.get("main_menu", [])
-        for row in main_menu:
-            for btn in row:
-                if button_to_callback(btn) == button_id or btn == button_id:
-                    current_text = btn
-                    button_text_key = f"button_text_main_{button_to_callback(btn)}"
-                    break
-            if current_text:
-                break
-        
-        if not current_text:
-            current_text = button_id
+        current_text = button_id
+        button_text_key = None
     
     await state.update_data(button_text_key=button_text_key, button_id=button_id)
     await state.set_state(AdminStates.waiting_button_text)
@@ -1061,13 +3065,13 @@ async def edit_button_text_handler(callback: CallbackQuery, state: FSMContext):
 
 
 # Редактирование кнопок (структура меню)
-@dp.callback_query(F.data.startswith("edit_button_") & ~F.data.startswith("edit_button_text_"))
+@callback_route("edit_button")
 async def edit_button_structure_handler(callback: CallbackQuery, state: FSMContext):
     if not is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
-    button_key = callback.data.replace("edit_button_", "")
+    _, button_key = unpack_callback(callback.data)
     buttons = await load_buttons()
     current_buttons = buttons.get(button_key, [])
     
@@ -1090,7 +3094,7 @@ async def edit_button_structure_handler(callback: CallbackQuery, state: FSMConte
 
 
 # Добавление новых кнопок
-@dp.callback_query(F.data == "add_new_buttons")
+@callback_route("add_new_buttons")
 async def add_new_buttons_handler(callback: CallbackQuery, state: FSMContext):
     if not is_admin(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
@@ -1107,7 +3111,7 @@ async def add_new_buttons_handler(callback: CallbackQuery, state: FSMContext):
         "➕ Добавление новых кнопок\n\n"
         "Отправьте сообщение в формате:\n"
         "<code>ключ_кнопок|[[\"Кнопка1\", \"Кнопка2\"], [\"Кнопка3\"]]</code>\n\n"
-        "Пример: main_menu|[[\"РВП\", \"ВНЖ\"], [\"Контакты\"]]",
+        "Пример: catalog|{\"root\": {\"children\": [[\"rvp\"]]}, \"rvp\": {\"title\": \"РВП\"}}",
         reply_markup=keyboard,
         parse_mode="HTML"
     )
@@ -1130,29 +3134,10 @@ async def save_button_text_handler(message: Message, state: FSMContext):
         return
     
     # Сохраняем текст кнопки в texts.json
-    texts = await load_texts()
+    texts = dict(await load_texts())
     texts[button_text_key] = message.text
     await save_texts(texts)
     
-    # Если это кнопка главного меню, обновляем buttons.json
-    buttons = await load_buttons()
-    main_menu = buttons.get("main_menu", [])
-    updated = False
-    
-    for row_idx, row in enumerate(main_menu):
-        for btn_idx, btn in enumerate(row):
-            callback_val = button_to_callback(btn)
-            if f"button_text_main_{callback_val}" == button_text_key:
-                main_menu[row_idx][btn_idx] = message.text
-                updated = True
-                break
-        if updated:
-            break
-    
-    if updated:
-        buttons["main_menu"] = main_menu
-        await save_buttons(buttons)
-    
     await message.answer(f"✅ Текст кнопки успешно обновлён!")
     await state.clear()
     
@@ -1193,393 +3178,69 @@ async def save_button_structure_handler(message: Message, state: FSMContext):
                 await message.answer("❌ Неверный формат. Используйте: ключ|JSON")
     except json.JSONDecodeError:
         await message.answer("❌ Ошибка парсинга JSON. Проверьте формат.")
-    
-    await state.clear()
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📝 Редактировать текст", callback_data="admin_edit_texts")],
-        [InlineKeyboardButton(text="🔘 Редактировать кнопки", callback_data="admin_edit_buttons")]
-    ])
-    await message.answer("🔧 Админ-панель", reply_markup=keyboard)
-
-
-# Обработка подуслуг "Уведомления" - ДОЛЖЕН БЫТЬ ПЕРЕД общим обработчиком service_
-@dp.callback_query(F.data.in_(["service_notifications_residence", "service_notifications_gph_conclusion", "service_notifications_gph_termination"]))
-async def handle_notifications_subservices(callback: CallbackQuery, state: FSMContext):
-    try:
-        await callback.answer()
-        
-        # Обновляем путь кнопок
-        data = await state.get_data()
-        button_path = data.get("button_path", [])
-        if "Уведомления" not in button_path:
-            button_path.append("Уведомления")
-        button_name = get_button_text_from_callback(callback.data)
-        button_path.append(button_name)
-        await state.update_data(button_path=button_path)
-        
-        texts = await load_texts()
-        callback_data = callback.data
-        
-        # Определяем текст в зависимости от выбранной подуслуги
-        if callback_data == "service_notifications_residence":
-            service_text = texts.get("service_notifications_residence", 
-                "📌 Уведомление о проживании\nежегодная отметка по ВНЖ или РВП\n\nДля оформления потребуется:\n\n1️⃣ Документы:\n• Паспорт + ВНЖ или РВП\n\n2️⃣ Регистрация:\n• Регистрация по месту жительства\nили миграционный учёт\n\n3️⃣ Доход (для ВНЖ):\n• Размер дохода\n• При официальной работе —\nсправка о доходах, должность, адрес организации\n\n4️⃣ Выезды за границу:\n• Информация обо всех периодах выезда и въезда\nза отчётный год")
-        elif callback_data == "service_notifications_gph_conclusion":
-            service_text = texts.get("service_notifications_gph_conclusion", 
-                "📌 Уведомление о заключении договора ГПХ\n\nДля оформления потребуется:\n\n👤 От заказчика:\n• Паспорта обеих сторон\n(или паспортные данные)\n• ИНН заказчика\n• Номер телефона заказчика\n• Профессия исполнителя\n• Адрес места работы\n• Патент исполнителя\n\n👷 От исполнителя (с патентом):\n• Паспорт (паспортные данные)\n• Патент\n• Медицинский полис\n(страховка)\n• ИНН (если не указан в патенте)\n• Номер телефона\n• Адрес места работы")
-        elif callback_data == "service_notifications_gph_termination":
-            service_text = texts.get("service_notifications_gph_termination", 
-                "📌 Уведомление о расторжении договора ГПХ\n\nДля оформления потребуется:\n• Паспорта обеих сторон\n(или паспортные данные)\n• ИНН заказчика\n• Номер телефона заказчика\n• Профессия исполнителя\n• Адрес места работы\n• Патент исполнителя\n• Дата расторжения договора")
-        else:
-            service_text = "ℹ️ Функционал находится в разработке."
-        
-        # Создаём кнопки
-        buttons = [
-            [InlineKeyboardButton(text="💬 Чат с оператором", callback_data="chat_operator")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_notifications")]
-        ]
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        
-        # Пытаемся отредактировать сообщение, если не получается - отправляем новое
-        try:
-            await callback.message.edit_text(service_text, reply_markup=keyboard)
-        except:
-            await callback.message.answer(service_text, reply_markup=keyboard)
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        try:
-            await callback.answer("❌ Произошла ошибка. Попробуйте позже.", show_alert=True)
-        except:
-            pass
-
-
-# Обработка кнопки "Назад" (возврат к меню "Уведомления") - ДОЛЖЕН БЫТЬ ПЕРЕД back_to_menu
-@dp.callback_query(F.data == "back_to_notifications")
-async def handle_back_to_notifications(callback: CallbackQuery, state: FSMContext):
-    try:
-        await callback.answer()
-        
-        # Удаляем последние кнопки из пути до "Уведомления"
-        data = await state.get_data()
-        button_path = data.get("button_path", [])
-        if "Уведомления" in button_path:
-            idx = button_path.index("Уведомления")
-            button_path = button_path[:idx+1]
-        await state.update_data(button_path=button_path)
-        
-        texts = await load_texts()
-        service_text = texts.get("service_notifications", 
-            "📋 Ниже представлен полный перечень услуг, которые мы предоставляем:\n\n📌 Уведомление о проживании\n📌 Уведомление о заключении договора ГПХ\n📌 Уведомление о расторжении договора ГПХ\n\n💼 Для получения подробной информации выберите интересующую услугу из меню ниже.")
-        
-        btn1_text = texts.get("button_text_notifications_sub_1", "Уведомление о проживании")
-        btn2_text = texts.get("button_text_notifications_sub_2", "Уведомление о заключении договора ГПХ")
-        btn3_text = texts.get("button_text_notifications_sub_3", "Уведомление о расторжении договора ГПХ")
-        buttons = [
-            [InlineKeyboardButton(text=btn1_text, callback_data="service_notifications_residence")],
-            [InlineKeyboardButton(text=btn2_text, callback_data="service_notifications_gph_conclusion")],
-            [InlineKeyboardButton(text=btn3_text, callback_data="service_notifications_gph_termination")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
-        ]
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        
-        # Пытаемся отредактировать текущее сообщение
-        try:
-            await callback.message.edit_text(service_text, reply_markup=keyboard)
-        except Exception as edit_error:
-            # Если не получается отредактировать, отправляем новое сообщение
-            try:
-                await callback.message.delete()
-            except:
-                pass
-            await callback.message.answer(service_text, reply_markup=keyboard)
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        try:
-            await callback.answer("❌ Произошла ошибка. Попробуйте позже.", show_alert=True)
-        except:
-            pass
-
-
-# Обработка подуслуг "Договоры" - ДОЛЖЕН БЫТЬ ПЕРЕД общим обработчиком service_
-@dp.callback_query(F.data.in_(["service_contracts_gph", "service_contracts_rent", "service_contracts_car"]))
-async def handle_contracts_subservices(callback: CallbackQuery, state: FSMContext):
-    try:
-        await callback.answer()
-        
-        # Обновляем путь кнопок
-        data = await state.get_data()
-        button_path = data.get("button_path", [])
-        if "Договоры" not in button_path:
-            button_path.append("Договоры")
-        button_name = get_button_text_from_callback(callback.data)
-        button_path.append(button_name)
-        await state.update_data(button_path=button_path)
-        
-        texts = await load_texts()
-        callback_data = callback.data
-        
-        # Определяем текст в зависимости от выбранной подуслуги
-        if callback_data == "service_contracts_gph":
-            service_text = texts.get("service_contracts_gph", 
-                "📌 Гражданско-правовой договор (ГПХ) / трудовой договор\n\nЗаключение договора включает:\n• Подготовку договора\n• Уведомления в госорганы\n• Описи документов\n• Конверты — 2 пакета документов\n\nДля оформления необходимо предоставить:\n\n👤 От заказчика:\n• Паспорт РФ + регистрация (прописка)\n• ИНН\n• Адрес места работы\n• Срок действия договора\n(дата окончания или бессрочно)\n• Размер вознаграждения:\n— почасовая оплата (XXX ₽/час)\n— или ежемесячная оплата (XXXXX ₽/мес)\n\n👷 От исполнителя (работника):\n• Паспорт\n• Патент\n• ИНН (если не указан в патенте)\n• Регистрация\n(прописка или миграционный учёт)\n• Медицинская страховка\n(полис ДМС)")
-        elif callback_data == "service_contracts_rent":
-            service_text = texts.get("service_contracts_rent", 
-                "📌 Договор найма / безвозмездного пользования жилым помещением\n\nДля подготовки договора потребуется:\n• Паспорта обеих сторон\n(или паспортные данные)\n• Выписка из ЕГРН\n• Номера телефонов сторон")
-        elif callback_data == "service_contracts_car":
-            service_text = texts.get("service_contracts_car", 
-                "📌 Договор купли-продажи автомобиля / договор аренды\n\nВ услугу входит:\n• Подготовка договора\n• Заявление в ГИБДД\n(на постановку или снятие с учёта)\n\nДля оформления потребуется:\n• СТС\n• ПТС\n• Паспорта обеих сторон\n(или паспортные данные)\n• Номера телефонов сторон")
-        else:
-            service_text = "ℹ️ Функционал находится в разработке."
-        
-        # Создаём кнопки
-        buttons = [
-            [InlineKeyboardButton(text="💬 Чат с оператором", callback_data="chat_operator")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_contracts")]
-        ]
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        
-        # Пытаемся отредактировать сообщение, если не получается - отправляем новое
-        try:
-            await callback.message.edit_text(service_text, reply_markup=keyboard)
-        except:
-            await callback.message.answer(service_text, reply_markup=keyboard)
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        try:
-            await callback.answer("❌ Произошла ошибка. Попробуйте позже.", show_alert=True)
-        except:
-            pass
-
-
-# Обработка кнопки "Назад" (возврат к меню "Договоры") - ДОЛЖЕН БЫТЬ ПЕРЕД back_to_menu
-@dp.callback_query(F.data == "back_to_contracts")
-async def handle_back_to_contracts(callback: CallbackQuery, state: FSMContext):
-    try:
-        await callback.answer()
-        
-        # Удаляем последние кнопки из пути до "Договоры"
-        data = await state.get_data()
-        button_path = data.get("button_path", [])
-        if "Договоры" in button_path:
-            idx = button_path.index("Договоры")
-            button_path = button_path[:idx+1]
-        await state.update_data(button_path=button_path)
-        
-        texts = await load_texts()
-        service_text = texts.get("service_contracts", 
-            "📋 Ниже представлен полный перечень услуг, которые мы предоставляем:\n\n📌 Гражданско-правовой договор (ГПХ) / трудовой договор\n📌 Договор найма / безвозмездного пользования жилым помещением\n📌 Договор купли-продажи автомобиля / договор аренды\n\n💼 Для получения подробной информации выберите интересующую услугу из меню ниже.")
-        
-        btn1_text = texts.get("button_text_contracts_sub_1", "Гражданско-правовой договор (ГПХ) / трудовой договор")
-        btn2_text = texts.get("button_text_contracts_sub_2", "Договор найма / безвозмездного пользования жилым помещением")
-        btn3_text = texts.get("button_text_contracts_sub_3", "Договор купли-продажи автомобиля / договор аренды")
-        buttons = [
-            [InlineKeyboardButton(text=btn1_text, callback_data="service_contracts_gph")],
-            [InlineKeyboardButton(text=btn2_text, callback_data="service_contracts_rent")],
-            [InlineKeyboardButton(text=btn3_text, callback_data="service_contracts_car")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
-        ]
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        
-        # Пытаемся отредактировать текущее сообщение
-        try:
-            await callback.message.edit_text(service_text, reply_markup=keyboard)
-        except Exception as edit_error:
-            # Если не получается отредактировать, отправляем новое сообщение
-            try:
-                await callback.message.delete()
-            except:
-                pass
-            await callback.message.answer(service_text, reply_markup=keyboard)
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        try:
-            await callback.answer("❌ Произошла ошибка. Попробуйте позже.", show_alert=True)
-        except:
-            pass
-
-
-# Обработка подуслуг "Миграционный учёт" - ДОЛЖЕН БЫТЬ ПЕРЕД общим обработчиком service_
-@dp.callback_query(F.data.in_(["service_migration_account_main", "service_migration_account_marriage", "service_migration_account_parents"]))
-async def handle_migration_account_subservices(callback: CallbackQuery, state: FSMContext):
-    try:
-        await callback.answer()
-        
-        # Обновляем путь кнопок
-        data = await state.get_data()
-        button_path = data.get("button_path", [])
-        if "Миграционный учёт" not in button_path:
-            button_path.append("Миграционный учёт")
-        button_name = get_button_text_from_callback(callback.data)
-        button_path.append(button_name)
-        await state.update_data(button_path=button_path)
-        
-        texts = await load_texts()
-        callback_data = callback.data
-        
-        # Определяем текст в зависимости от выбранной подуслуги
-        if callback_data == "service_migration_account_main":
-            service_text = texts.get("service_migration_account_main", 
-                "📌 Миграционный учёт\n\nДля постановки на миграционный учёт потребуется:\n\n🧑‍💼 От собственника жилья (принимающей стороны):\n• Паспорт с регистрацией\n(паспортные данные: ФИО, серия и номер, кем и когда выдан, адрес прописки)\n• Документ на недвижимость\n(выписка из ЕГРН)\n• Номер телефона\n\n🌍 От иностранного гражданина:\n• Паспорт — все страницы с отметками\n• Место рождения\n(страна, населённый пункт)\n• Номер телефона\n• Миграционная карта — с двух сторон\n• Патент — с двух сторон\n(или трудовой договор)\n• Все чеки по патенту\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)")
-        elif callback_data == "service_migration_account_marriage":
-            service_text = texts.get("service_migration_account_marriage", 
-                "📌 Продление миграционного учёта по браку\n\nДля оформления потребуется:\n\n🌍 От иностранного гражданина:\n• Паспорт\n• Место рождения\n(страна, населённый пункт)\n• Номер телефона\n• Миграционная карта — с двух сторон\n• Свидетельство о браке\n• Медицинские справки и сопутствующие документы\n(для всех старше 6 лет)\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)\n\n👫 От супруга / супруги:\n• Паспорт РФ или ВНЖ\n• Регистрация по месту жительства")
-        elif callback_data == "service_migration_account_parents":
-            service_text = texts.get("service_migration_account_parents", 
-                "📌 Оформление на основании отца / матери\nдля ребёнка (сына или дочери)\n\nДля оформления потребуется:\n\n👶 От ребёнка:\n• Паспорт\n• Номер телефона\n• Миграционная карта\n• Свидетельство о рождении\n• Медицинские справки и сопутствующие документы\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)\n\n👨‍👩‍👧 От отца / матери:\n• Паспорт РФ или ВНЖ\n• Регистрация по месту жительства\n• Номер телефона\n• Миграционная карта\n\nЕсли у отца / матери есть патент, дополнительно:\n• Патент\n• Все чеки по патенту\n\nТакже потребуется:\n• Место рождения\n(страна, населённый пункт)\n• Медицинские справки и сопутствующие документы\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)")
-        else:
-            service_text = "ℹ️ Функционал находится в разработке."
-        
-        # Создаём кнопки
-        buttons = [
-            [InlineKeyboardButton(text="💬 Чат с оператором", callback_data="chat_operator")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_migration_account")]
-        ]
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        
-        # Пытаемся отредактировать сообщение, если не получается - отправляем новое
-        try:
-            await callback.message.edit_text(service_text, reply_markup=keyboard)
-        except:
-            await callback.message.answer(service_text, reply_markup=keyboard)
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        try:
-            await callback.answer("❌ Произошла ошибка. Попробуйте позже.", show_alert=True)
-        except:
-            pass
-
-
-# Обработка кнопки "Назад" (возврат к меню "Миграционный учёт") - ДОЛЖЕН БЫТЬ ПЕРЕД back_to_menu
-@dp.callback_query(F.data == "back_to_migration_account")
-async def handle_back_to_migration_account(callback: CallbackQuery, state: FSMContext):
-    try:
-        await callback.answer()
-        
-        # Удаляем последние кнопки из пути до "Миграционный учёт"
-        data = await state.get_data()
-        button_path = data.get("button_path", [])
-        if "Миграционный учёт" in button_path:
-            idx = button_path.index("Миграционный учёт")
-            button_path = button_path[:idx+1]
-        await state.update_data(button_path=button_path)
-        
-        texts = await load_texts()
-        service_text = texts.get("service_migration_account", 
-            "📋 Ниже представлен полный перечень услуг, которые мы предоставляем:\n\n📌 Миграционный учёт\n📌 Продление миграционного учёта по браку\n📌 Оформление на основании отца / матери\n\n💼 Для получения подробной информации выберите интересующую услугу из меню ниже.")
-        
-        btn1_text = texts.get("button_text_migration_sub_1", "Миграционный учёт")
-        btn2_text = texts.get("button_text_migration_sub_2", "Продление миграционного учёта по браку")
-        btn3_text = texts.get("button_text_migration_sub_3", "Оформление на основании отца / матери")
-        buttons = [
-            [InlineKeyboardButton(text=btn1_text, callback_data="service_migration_account_main")],
-            [InlineKeyboardButton(text=btn2_text, callback_data="service_migration_account_marriage")],
-            [InlineKeyboardButton(text=btn3_text, callback_data="service_migration_account_parents")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
-        ]
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        
-        # Пытаемся отредактировать текущее сообщение
-        try:
-            await callback.message.edit_text(service_text, reply_markup=keyboard)
-        except Exception as edit_error:
-            # Если не получается отредактировать, отправляем новое сообщение
-            try:
-                await callback.message.delete()
-            except:
-                pass
-            await callback.message.answer(service_text, reply_markup=keyboard)
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        try:
-            await callback.answer("❌ Произошла ошибка. Попробуйте позже.", show_alert=True)
-        except:
-            pass
+    
+    await state.clear()
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📝 Редактировать текст", callback_data="admin_edit_texts")],
+        [InlineKeyboardButton(text="🔘 Редактировать кнопки", callback_data="admin_edit_buttons")]
+    ])
+    await message.answer("🔧 Админ-панель", reply_markup=keyboard)
+
+
+# Выбор языка интерфейса
+@dp.message(Command("language"))
+async def cmd_language(message: Message, state: FSMContext):
+    texts = await load_texts()
+    locale = await get_user_locale(message.from_user, state)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=LOCALE_NAMES.get(code, code), callback_data=pack_callback("locale", code))]
+        for code in LOCALES
+    ])
+    await message.answer(localized(texts, "choose_language", locale, "🌐 Выберите язык:"), reply_markup=keyboard)
+
+
+@callback_route("locale")
+async def handle_locale(callback: CallbackQuery, state: FSMContext):
+    _, locale = unpack_callback(callback.data)
+    if locale not in LOCALES:
+        await callback.answer("ℹ️ Этот язык больше недоступен", show_alert=True)
+        return
+    await callback.answer(LOCALE_NAMES.get(locale, locale))
+    await set_user_locale(callback.from_user.id, state, locale)
+    
+    user_name = callback.from_user.first_name or "Пользователь"
+    texts = await load_texts()
+    welcome_text = render_text(texts, "welcome_message", locale, DEFAULT_WELCOME_MESSAGE, name=user_name)
+    keyboard = await get_main_menu_keyboard(locale)
+    await show_menu(callback, state, welcome_text, keyboard, button_path=[], service_node=None)
 
 
-# Обработка инлайн-кнопок услуг
-@dp.callback_query(F.data.startswith("service_"))
-async def handle_service(callback: CallbackQuery, state: FSMContext):
+# Обработка пунктов каталога услуг: "service:<id>" открывает узел, "back:<id>" возвращает к нему
+@callback_route("service", "back")
+async def handle_catalog_node(callback: CallbackQuery, state: FSMContext):
     try:
-        # Пропускаем обработку подуслуг "Миграционный учёт", "Договоры" и "Уведомления" - они обрабатываются отдельными обработчиками
-        if callback.data in ["service_migration_account_main", "service_migration_account_marriage", "service_migration_account_parents",
-                             "service_contracts_gph", "service_contracts_rent", "service_contracts_car",
-                             "service_notifications_residence", "service_notifications_gph_conclusion", "service_notifications_gph_termination"]:
+        action, node_id = unpack_callback(callback.data)
+        nodes = await get_catalog_index()
+        node = nodes.get(node_id)
+        if node is None or node_id == CATALOG_ROOT:
+            await callback.answer("ℹ️ Этот раздел больше недоступен. Откройте меню заново: /start")
             return
         
-        callback_data = callback.data.replace("service_", "")
-        service_name = CALLBACK_TO_BUTTON.get(callback_data, callback_data.replace("_", " ").title())
-        
-        # Обновляем путь кнопок
-        data = await state.get_data()
-        button_path = data.get("button_path", [])
-        button_path.append(service_name)
-        await state.update_data(button_path=button_path)
-        
         await callback.answer()
-        
-        # Загружаем тексты услуг
         texts = await load_texts()
-        service_key = f"service_{callback_data}"
-        
-        # Если есть специальный текст для услуги, используем его
-        service_text = texts.get(service_key, f"ℹ️ Вы выбрали: {service_name}\n\nФункционал находится в разработке.")
-        
-        # Создаём кнопки
-        buttons = []
-        
-        # Специальная обработка для "Миграционный учёт" - показываем подуслуги
-        if callback_data == "migration_account":
-            # Используем сохраненные тексты кнопок, если они есть
-            btn1_text = texts.get("button_text_migration_sub_1", "Миграционный учёт")
-            btn2_text = texts.get("button_text_migration_sub_2", "Продление миграционного учёта по браку")
-            btn3_text = texts.get("button_text_migration_sub_3", "Оформление на основании отца / матери")
-            buttons.append([InlineKeyboardButton(text=btn1_text, callback_data="service_migration_account_main")])
-            buttons.append([InlineKeyboardButton(text=btn2_text, callback_data="service_migration_account_marriage")])
-            buttons.append([InlineKeyboardButton(text=btn3_text, callback_data="service_migration_account_parents")])
-            buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
-        elif callback_data == "contracts":
-            # Специальная обработка для "Договоры" - показываем подуслуги
-            btn1_text = texts.get("button_text_contracts_sub_1", "Гражданско-правовой договор (ГПХ) / трудовой договор")
-            btn2_text = texts.get("button_text_contracts_sub_2", "Договор найма / безвозмездного пользования жилым помещением")
-            btn3_text = texts.get("button_text_contracts_sub_3", "Договор купли-продажи автомобиля / договор аренды")
-            buttons.append([InlineKeyboardButton(text=btn1_text, callback_data="service_contracts_gph")])
-            buttons.append([InlineKeyboardButton(text=btn2_text, callback_data="service_contracts_rent")])
-            buttons.append([InlineKeyboardButton(text=btn3_text, callback_data="service_contracts_car")])
-            buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
-        elif callback_data == "notifications":
-            # Специальная обработка для "Уведомления" - показываем подуслуги
-            btn1_text = texts.get("button_text_notifications_sub_1", "Уведомление о проживании")
-            btn2_text = texts.get("button_text_notifications_sub_2", "Уведомление о заключении договора ГПХ")
-            btn3_text = texts.get("button_text_notifications_sub_3", "Уведомление о расторжении договора ГПХ")
-            buttons.append([InlineKeyboardButton(text=btn1_text, callback_data="service_notifications_residence")])
-            buttons.append([InlineKeyboardButton(text=btn2_text, callback_data="service_notifications_gph_conclusion")])
-            buttons.append([InlineKeyboardButton(text=btn3_text, callback_data="service_notifications_gph_termination")])
-            buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
-        elif callback_data == "contacts":
-            # Специальная обработка для "Контакты" - кнопка "Чат с оператором" и "Назад"
-            buttons.append([InlineKeyboardButton(text="💬 Чат с оператором", callback_data="chat_operator")])
-            buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
-        else:
-            # Для остальных услуг - стандартные кнопки
-            buttons.append([InlineKeyboardButton(text="💬 Чат с оператором", callback_data="chat_operator")])
-            buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")])
+        locale = await get_user_locale(callback.from_user, state)
+        path = catalog_path(nodes, node_id)
         
-        keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+        service_name = catalog_label(node, texts, locale)
+        service_text = localized(texts, node["text_key"], locale, f"ℹ️ Вы выбрали: {service_name}\n\nФункционал находится в разработке.")
+        keyboard = get_catalog_keyboard(nodes, node, texts, locale)
         
-        await callback.message.answer(service_text, reply_markup=keyboard)
+        # Без MENU_EDIT_IN_PLACE раздел главного меню открывается новым сообщением, меню остаётся выше
+        new_message = not MENU_EDIT_IN_PLACE and action == "service" and node["parent"] == CATALOG_ROOT
+        # Путь кнопок - подписи узлов от главного меню до текущего (на основном языке, его читают операторы)
+        await show_menu(callback, state, service_text, keyboard, new_message=new_message,
+                        button_path=[catalog_label(path_node, texts) for path_node in path], service_node=node_id)
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -1590,7 +3251,7 @@ async def handle_service(callback: CallbackQuery, state: FSMContext):
 
 
 # Обработка кнопки "Чат с оператором"
-@dp.callback_query(F.data == "chat_operator")
+@callback_route("chat_operator")
 async def handle_chat_operator(callback: CallbackQuery, state: FSMContext):
     print(f"[CHAT_OPERATOR] Обработчик вызван для пользователя {callback.from_user.id}")
     await callback.answer()
@@ -1611,7 +3272,7 @@ async def handle_chat_operator(callback: CallbackQuery, state: FSMContext):
                 f"Или отмените диалог, если хотите создать новый.",
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                     [InlineKeyboardButton(text="💬 Продолжить диалог", callback_data="continue_dialog")],
-                    [InlineKeyboardButton(text="❌ Отменить диалог", callback_data=f"cancel_user_dialog_{active_dialog_id}")],
+                    [InlineKeyboardButton(text="❌ Отменить диалог", callback_data=pack_callback("cancel_user_dialog", active_dialog_id))],
                     [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
                 ])
             )
@@ -1630,8 +3291,9 @@ async def handle_chat_operator(callback: CallbackQuery, state: FSMContext):
         button_path = data.get("button_path", [])
         button_path.append("💬 Чат с оператором")
         
-        # Создаем диалог
-        dialog_id = await create_dialog(user_id, user_name, phone, username, button_path)
+        # Создаем диалог; навык для назначения оператора определяется по разделу каталога
+        skill = catalog_skill(await get_catalog_index(), data["service_node"]) if data.get("service_node") else None
+        dialog_id = await create_dialog(user_id, user_name, phone, username, button_path, skill)
         print(f"[CHAT_OPERATOR] Создан диалог {dialog_id}")
         
         # Формируем информацию о пользователе
@@ -1650,7 +3312,7 @@ async def handle_chat_operator(callback: CallbackQuery, state: FSMContext):
         await state.update_data(dialog_id=dialog_id)
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Отменить диалог", callback_data=f"cancel_user_dialog_{dialog_id}")],
+            [InlineKeyboardButton(text="❌ Отменить диалог", callback_data=pack_callback("cancel_user_dialog", dialog_id))],
             [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_menu")]
         ])
         
@@ -1669,7 +3331,7 @@ async def handle_chat_operator(callback: CallbackQuery, state: FSMContext):
 
 
 # Обработка кнопки "Назад" (возврат в главное меню)
-@dp.callback_query(F.data == "back_to_menu")
+@callback_route("back_to_menu")
 async def handle_back_to_menu(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     
@@ -1682,34 +3344,24 @@ async def handle_back_to_menu(callback: CallbackQuery, state: FSMContext):
         await state.set_state(None)
         await state.update_data(dialog_id=None)
     
-    # Очищаем путь кнопок (возврат в главное меню)
-    await state.update_data(button_path=[])
-    
     user_name = callback.from_user.first_name or "Пользователь"
     texts = await load_texts()
+    locale = await get_user_locale(callback.from_user, state)
+    welcome_text = render_text(texts, "welcome_message", locale, DEFAULT_WELCOME_MESSAGE, name=user_name)
+    keyboard = await get_main_menu_keyboard(locale)
     
-    welcome_text = texts.get("welcome_message", 
-        "👋 Добро пожаловать, {name}!\n\n✨ Мы рады приветствовать вас в нашем сервисе!")
-    
-    welcome_text = welcome_text.format(name=user_name)
-    
-    keyboard = await get_main_menu_keyboard()
-    
-    # Пытаемся отредактировать сообщение, если не получается - отправляем новое
-    try:
-        await callback.message.edit_text(welcome_text, reply_markup=keyboard)
-    except:
-        await callback.message.answer(welcome_text, reply_markup=keyboard)
+    # Очищаем путь кнопок (возврат в главное меню)
+    await show_menu(callback, state, welcome_text, keyboard, button_path=[], service_node=None)
 
 
 # Обработка принятия диалога
-@dp.callback_query(F.data.startswith("accept_dialog_"))
+@callback_route("accept_dialog")
 async def handle_accept_dialog(callback: CallbackQuery, state: FSMContext):
     if not is_admin_or_operator(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
-    dialog_id = callback.data.replace("accept_dialog_", "")
+    _, dialog_id = unpack_callback(callback.data)
     operator_id = callback.from_user.id
     
     success = await accept_dialog(dialog_id, operator_id)
@@ -1718,18 +3370,29 @@ async def handle_accept_dialog(callback: CallbackQuery, state: FSMContext):
         dialogs_data = await load_dialogs()
         dialog = dialogs_data["dialogs"][dialog_id]
         
+        # Обновляем карточки диалога у всех операторов
+        await update_dialog_cards(dialog_id, dialog)
+        if is_dialog_card(dialog, callback.message):
+            await callback.answer()
+            return
+        dashboard_page = get_dashboard_page(callback.message)
+        if dashboard_page:
+            await callback.answer("✅ Диалог принят")
+            await refresh_dashboard(callback, state, *dashboard_page)
+            return
+        
         # Просто обновляем сообщение без лишних уведомлений
         username_text = f"@{dialog['username']}" if dialog.get("username") else "Нет username"
         phone_formatted = format_phone_number(dialog.get('user_phone', 'Не указан'))
         
         await callback.message.edit_text(
-            f"👤 <b>{dialog['user_name']}</b>\n"
-            f"📱 {phone_formatted}\n"
-            f"🔗 {username_text}",
+            f"👤 <b>{html.escape(str(dialog['user_name']))}</b>\n"
+            f"📱 {html.escape(phone_formatted)}\n"
+            f"🔗 {html.escape(username_text)}",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💬 Ответить", callback_data=f"reply_dialog_{dialog_id}")],
-                [InlineKeyboardButton(text="❌ Закрыть", callback_data=f"close_dialog_{dialog_id}")]
+                [InlineKeyboardButton(text="💬 Ответить", callback_data=pack_callback("reply_dialog", dialog_id))],
+                [InlineKeyboardButton(text="❌ Закрыть", callback_data=pack_callback("close_dialog", dialog_id))]
             ])
         )
         await callback.answer()
@@ -1738,13 +3401,13 @@ async def handle_accept_dialog(callback: CallbackQuery, state: FSMContext):
 
 
 # Обработка ответа в диалог
-@dp.callback_query(F.data.startswith("reply_dialog_"))
+@callback_route("reply_dialog")
 async def handle_reply_dialog(callback: CallbackQuery, state: FSMContext):
     if not is_admin_or_operator(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
-    dialog_id = callback.data.replace("reply_dialog_", "")
+    _, dialog_id = unpack_callback(callback.data)
     
     # Проверяем, не отвечает ли оператор уже в этом диалоге
     current_state = await state.get_state()
@@ -1768,6 +3431,7 @@ async def handle_reply_dialog(callback: CallbackQuery, state: FSMContext):
         await accept_dialog(dialog_id, callback.from_user.id)
         dialogs_data = await load_dialogs()
         dialog = dialogs_data["dialogs"].get(dialog_id)
+        await update_dialog_cards(dialog_id, dialog)
     
     # Проверяем права доступа
     if dialog["operator_id"] != callback.from_user.id and not is_admin(callback.from_user.id):
@@ -1789,100 +3453,32 @@ async def handle_reply_dialog(callback: CallbackQuery, state: FSMContext):
     username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
     
     await callback.message.answer(
-        f"💬 Отправьте ответ для диалога с <b>{dialog['user_name']}</b> ({username_text}):",
+        f"💬 Отправьте ответ для диалога с <b>{html.escape(str(dialog['user_name']))}</b> ({html.escape(username_text)}):",
         parse_mode="HTML"
     )
     await callback.answer()
 
 
 # Обработка кнопки "Список диалогов" для оператора
-@dp.callback_query(F.data == "operator_dialogs")
+@callback_route("operator_dialogs")
 async def handle_operator_dialogs(callback: CallbackQuery, state: FSMContext):
     if not is_admin_or_operator(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
     await callback.answer()
-    
-    operator_id = callback.from_user.id
     await state.clear()
-    
-    # Получаем активные диалоги оператора
-    active_dialogs = await get_active_dialogs_for_operator(operator_id)
-    
-    # Получаем ожидающие диалоги (если есть)
-    pending_dialogs = await get_pending_dialogs()
-    
-    # Получаем закрытые диалоги для оператора
-    closed_dialogs = await get_closed_dialogs_for_operator(operator_id)
-    
-    if not active_dialogs and not pending_dialogs and not closed_dialogs:
-        await callback.message.answer("📭 Диалогов нет.")
-        return
-    
-    response_text = "💬 <b>Список диалогов</b>\n\n"
-    
-    if pending_dialogs:
-        response_text += "⏳ <b>Ожидающие диалоги:</b>\n"
-        for dialog_id, dialog in pending_dialogs:
-            username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
-            response_text += f"\n🔔 <b>{dialog['user_name']}</b>\n"
-            response_text += f"📱 {dialog['user_phone']}\n"
-            response_text += f"🔗 {username_text}\n"
-            response_text += f"⏰ {dialog['created_at']}\n"
-            
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="✅ Принять диалог", callback_data=f"accept_dialog_{dialog_id}")],
-                [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_dialog_{dialog_id}")]
-            ])
-            await callback.message.answer(response_text, parse_mode="HTML", reply_markup=keyboard)
-            response_text = ""  # Очищаем для следующего диалога
-    
-    if active_dialogs:
-        if response_text:
-            response_text += "\n"
-        response_text += "📞 <b>Активные диалоги:</b>\n"
-        for dialog_id, dialog in active_dialogs:
-            username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
-            response_text += f"\n👤 <b>{dialog['user_name']}</b>\n"
-            response_text += f"📱 {dialog['user_phone']}\n"
-            response_text += f"🔗 {username_text}\n"
-            response_text += f"⏰ Принят: {dialog.get('accepted_at', 'N/A')}\n"
-            
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💬 Ответить", callback_data=f"reply_dialog_{dialog_id}")],
-                [InlineKeyboardButton(text="❌ Закрыть", callback_data=f"close_dialog_{dialog_id}")],
-                [InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delete_dialog_{dialog_id}")]
-            ])
-            await callback.message.answer(response_text, parse_mode="HTML", reply_markup=keyboard)
-            response_text = ""  # Очищаем для следующего диалога
-    
-    if closed_dialogs:
-        if response_text:
-            response_text += "\n"
-        response_text += "📁 <b>Закрытые диалоги:</b> (последние 10)\n"
-        for dialog_id, dialog in closed_dialogs[:10]:  # Показываем только последние 10
-            username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
-            response_text += f"\n🔒 <b>{dialog['user_name']}</b>\n"
-            response_text += f"📱 {dialog['user_phone']}\n"
-            response_text += f"🔗 {username_text}\n"
-            response_text += f"⏰ Закрыт: {dialog.get('closed_at', 'N/A')}\n"
-            
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🗑 Удалить из истории", callback_data=f"delete_dialog_{dialog_id}")]
-            ])
-            await callback.message.answer(response_text, parse_mode="HTML", reply_markup=keyboard)
-            response_text = ""  # Очищаем для следующего диалога
+    # Панель открывается новым сообщением, карточка с кнопкой остаётся
+    await send_dashboard(callback.message.chat.id, callback.from_user.id)
 
 
-# Обработка закрытия диалога
-@dp.callback_query(F.data.startswith("close_dialog_"))
+@callback_route("close_dialog")
 async def handle_close_dialog(callback: CallbackQuery, state: FSMContext):
     if not is_admin_or_operator(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
-    dialog_id = callback.data.replace("close_dialog_", "")
+    _, dialog_id = unpack_callback(callback.data)
     
     # Проверяем, что диалог активен
     dialogs_data = await load_dialogs()
@@ -1901,12 +3497,24 @@ async def handle_close_dialog(callback: CallbackQuery, state: FSMContext):
     if success:
         user_id = dialog["user_id"]
         
+        # Обновляем карточки диалога у операторов
+        await update_dialog_cards(dialog_id)
+        
         # Уведомляем пользователя
         await bot.send_message(
             chat_id=user_id,
             text="ℹ️ Диалог с оператором завершён. Если у вас возникнут дополнительные вопросы, вы можете создать новый диалог."
         )
         
+        if is_dialog_card(dialog, callback.message):
+            await callback.answer("✅ Диалог закрыт")
+            return
+        dashboard_page = get_dashboard_page(callback.message)
+        if dashboard_page:
+            await callback.answer("✅ Диалог закрыт")
+            await refresh_dashboard(callback, state, *dashboard_page)
+            return
+        
         await callback.message.edit_text(
             f"❌ Диалог закрыт\n\n"
             f"👤 Пользователь: {dialog['user_name']}\n"
@@ -1918,13 +3526,13 @@ async def handle_close_dialog(callback: CallbackQuery, state: FSMContext):
 
 
 # Обработка удаления диалога из истории
-@dp.callback_query(F.data.startswith("delete_dialog_"))
+@callback_route("delete_dialog")
 async def handle_delete_dialog(callback: CallbackQuery, state: FSMContext):
     if not is_admin_or_operator(callback.from_user.id):
         await callback.answer("❌ Нет доступа", show_alert=True)
         return
     
-    dialog_id = callback.data.replace("delete_dialog_", "")
+    _, dialog_id = unpack_callback(callback.data)
     
     # Проверяем, что диалог существует
     dialogs_data = await load_dialogs()
@@ -1943,6 +3551,11 @@ async def handle_delete_dialog(callback: CallbackQuery, state: FSMContext):
     success = await delete_dialog(dialog_id)
     
     if success:
+        dashboard_page = get_dashboard_page(callback.message)
+        if dashboard_page:
+            await callback.answer("✅ Диалог удалён из истории")
+            await refresh_dashboard(callback, state, *dashboard_page)
+            return
         await callback.message.edit_text(
             f"🗑 Диалог удалён из истории\n\n"
             f"👤 Пользователь: {dialog['user_name']}\n"
@@ -1985,7 +3598,7 @@ async def cmd_reply(message: Message, state: FSMContext):
     try:
         await bot.send_message(
             chat_id=user_id,
-            text=f"💬 <b>Ответ от оператора:</b>\n\n{reply_text}",
+            text=f"💬 <b>Ответ от оператора:</b>\n\n{html.escape(reply_text)}",
             parse_mode="HTML"
         )
         
@@ -2026,6 +3639,7 @@ async def cmd_close(message: Message, state: FSMContext):
     
     if success:
         user_id = dialog["user_id"]
+        await update_dialog_cards(dialog_id)
         await bot.send_message(
             chat_id=user_id,
             text="ℹ️ Диалог с оператором завершён. Если у вас возникнут дополнительные вопросы, вы можете создать новый диалог."
@@ -2060,6 +3674,7 @@ async def handle_operator_reply(message: Message, state: FSMContext):
         await accept_dialog(dialog_id, message.from_user.id)
         dialogs_data = await load_dialogs()
         dialog = dialogs_data["dialogs"].get(dialog_id)
+        await update_dialog_cards(dialog_id, dialog)
     
     # Проверяем права доступа
     if dialog["operator_id"] != message.from_user.id and not is_admin(message.from_user.id):
@@ -2067,23 +3682,39 @@ async def handle_operator_reply(message: Message, state: FSMContext):
         await state.clear()
         return
     
-    # Отправляем ответ пользователю
-    user_id = dialog["user_id"]
+    # Части альбома отправляются пользователю одной пересылкой
+    if message.text is None and message.media_group_id:
+        collect_media_group(message, lambda messages: deliver_operator_reply(dialog_id, dialog["user_id"], messages, state))
+        return
+    await deliver_operator_reply(dialog_id, dialog["user_id"], [message], state)
+
+
+async def deliver_operator_reply(dialog_id: str, user_id: int, messages: list, state: FSMContext):
+    """Отправляет пользователю ответ оператора: текст - сообщением, вложения - копированием"""
+    message = messages[-1]
     try:
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"💬 <b>Ответ от оператора:</b>\n\n{message.text}",
-            parse_mode="HTML"
-        )
-        
-        # Добавляем сообщение в диалог
-        await add_message_to_dialog(dialog_id, "operator", message.text)
+        if message.text is not None:
+            await bot.send_message(
+                chat_id=user_id,
+                text=f"💬 <b>Ответ от оператора:</b>\n\n{html.escape(message.text)}",
+                parse_mode="HTML"
+            )
+            # Добавляем сообщение в диалог
+            await add_message_to_dialog(dialog_id, "operator", message.text)
+        else:
+            await bot.send_message(chat_id=user_id, text="💬 <b>Ответ от оператора:</b>", parse_mode="HTML")
+            await bot.copy_messages(
+                chat_id=user_id,
+                from_chat_id=message.chat.id,
+                message_ids=[part.message_id for part in messages]
+            )
+            await add_messages_to_dialog(dialog_id, "operator", [(part.caption or "", message_media(part)) for part in messages])
         
         # Добавляем кнопки для продолжения диалога
         try:
             await message.edit_reply_markup(
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="💬 Ответить снова", callback_data=f"reply_dialog_{dialog_id}")],
+                    [InlineKeyboardButton(text="💬 Ответить снова", callback_data=pack_callback("reply_dialog", dialog_id))],
                     [InlineKeyboardButton(text="📋 Список диалогов", callback_data="operator_dialogs")]
                 ])
             )
@@ -2092,7 +3723,7 @@ async def handle_operator_reply(message: Message, state: FSMContext):
             await message.answer(
                 "💬",
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="💬 Ответить снова", callback_data=f"reply_dialog_{dialog_id}")],
+                    [InlineKeyboardButton(text="💬 Ответить снова", callback_data=pack_callback("reply_dialog", dialog_id))],
                     [InlineKeyboardButton(text="📋 Список диалогов", callback_data="operator_dialogs")]
                 ])
             )
@@ -2136,59 +3767,26 @@ async def handle_user_message_in_dialog(message: Message, state: FSMContext):
         await message.answer("❌ Диалог не найден.", reply_markup=keyboard)
         return
     
+    # Вложения копируются операторам, части альбома - одной пересылкой
+    if message.text is None:
+        if message.media_group_id:
+            collect_media_group(message, lambda messages: relay_user_media(dialog_id, messages))
+        else:
+            await relay_user_media(dialog_id, [message])
+        return
+    
     # Добавляем сообщение в диалог
     await add_message_to_dialog(dialog_id, "user", message.text)
     
-    # Если диалог pending, отправляем оператору
-    if dialog["status"] == "pending":
-        username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
-        phone_formatted = format_phone_number(dialog.get('user_phone', 'Не указан'))
-        message_text = f"💬 <b>Сообщение от {dialog['user_name']}</b> ({username_text})\n\n"
-        message_text += f"📱 {phone_formatted}\n\n"
-        message_text += f"{message.text}"
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💬 Ответить", callback_data=f"reply_dialog_{dialog_id}")]
-        ])
-        
-        # Отправляем всем операторам
-        for operator_id in OPERATOR_IDS:
-            try:
-                await bot.send_message(
-                    chat_id=operator_id,
-                    text=message_text,
-                    parse_mode="HTML",
-                    reply_markup=keyboard
-                )
-            except Exception as e:
-                print(f"[DIALOG ERROR] Ошибка отправки оператору {operator_id}: {e}")
+    # Пока диалог ожидает, обновляем карточки у операторов, иначе пересылаем сообщение
+    if dialog["status"] == "pending" and dialog.get("notification_messages"):
+        await update_dialog_cards(dialog_id)
     else:
-        # Диалог активен, отправляем назначенному оператору
-        operator_id = dialog["operator_id"]
-        try:
-            username_text = f"@{dialog['username']}" if dialog.get("username") else "нет"
-            phone_formatted = format_phone_number(dialog.get('user_phone', 'Не указан'))
-            message_text = f"💬 <b>Сообщение от {dialog['user_name']}</b> ({username_text})\n\n"
-            message_text += f"📱 {phone_formatted}\n\n"
-            message_text += f"{message.text}"
-            
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="💬 Ответить", callback_data=f"reply_dialog_{dialog_id}")],
-                [InlineKeyboardButton(text="❌ Закрыть", callback_data=f"close_dialog_{dialog_id}")]
-            ])
-            
-            await bot.send_message(
-                chat_id=operator_id,
-                text=message_text,
-                parse_mode="HTML",
-                reply_markup=keyboard
-            )
-        except Exception as e:
-            print(f"[DIALOG ERROR] Ошибка при отправке сообщения оператору: {e}")
+        await relay_user_message(dialog_id, dialog, message.text)
 
 
 # Обработка кнопки "Продолжить диалог"
-@dp.callback_query(F.data == "continue_dialog")
+@callback_route("continue_dialog")
 async def handle_continue_dialog(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     
@@ -2208,7 +3806,7 @@ async def handle_continue_dialog(callback: CallbackQuery, state: FSMContext):
     status_text = "активен" if dialog and dialog.get("status") == "active" else "ожидает ответа"
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ Отменить диалог", callback_data=f"cancel_user_dialog_{active_dialog_id}")],
+        [InlineKeyboardButton(text="❌ Отменить диалог", callback_data=pack_callback("cancel_user_dialog", active_dialog_id))],
         [InlineKeyboardButton(text="🔙 Главное меню", callback_data="back_to_menu")]
     ])
     
@@ -2220,11 +3818,11 @@ async def handle_continue_dialog(callback: CallbackQuery, state: FSMContext):
 
 
 # Обработка отмены диалога пользователем
-@dp.callback_query(F.data.startswith("cancel_user_dialog_"))
+@callback_route("cancel_user_dialog")
 async def handle_cancel_user_dialog(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     
-    dialog_id = callback.data.replace("cancel_user_dialog_", "")
+    _, dialog_id = unpack_callback(callback.data)
     
     dialogs_data = await load_dialogs()
     dialog = dialogs_data["dialogs"].get(dialog_id)
@@ -2241,6 +3839,7 @@ async def handle_cancel_user_dialog(callback: CallbackQuery, state: FSMContext):
     success = await close_dialog(dialog_id)
     
     if success:
+        await update_dialog_cards(dialog_id)
         await state.set_state(None)
         await state.update_data(dialog_id=None)
         
@@ -2262,11 +3861,12 @@ async def handle_cancel_user_dialog(callback: CallbackQuery, state: FSMContext):
 # ==========================================
 
 # 1. Статистика
-@dp.callback_query(F.data == "admin_statistics")
-async def admin_statistics(callback: CallbackQuery):
+@callback_route("admin_statistics")
+async def admin_statistics(callback: CallbackQuery, state: FSMContext):
     if not is_admin(callback.from_user.id):
         await callback.answer("Только для админов", show_alert=True)
         return
+    await callback.answer()
 
     phones = await load_phones()
     total_users = len(phones)
@@ -2274,67 +3874,158 @@ async def admin_statistics(callback: CallbackQuery):
     response = f"📊 <b>Статистика бота</b>\n\n"
     response += f"👥 Всего пользователей: <b>{total_users}</b>\n\n"
     
-    # Показываем всех пользователей
-    all_users = list(phones.items())
-    all_users.reverse() # Самые новые сверху
-    
-    # Если пользователей очень много, сообщение может не влезть в лимит Telegram (4096 символов)
-    # Поэтому будем отправлять частями
-    
-    current_message = response
-    
-    # Отправляем первое сообщение с заголовком
-    # await callback.message.edit_text(response, parse_mode="HTML") # Нельзя редактировать на несколько сообщений сразу
-    
-    # Формируем полный список
-    user_list_text = ""
-    for user_id, data in all_users:
-        name = f"{data.get('first_name', '')} {data.get('last_name', '')}".strip() or "Без имени"
-        phone = format_phone_number(data.get('phone', 'Не указан'))
-        username = f"@{data.get('username')}" if data.get('username') else "Не указан"
-        
-        user_entry = f"👤 Имя: {name}\n"
-        user_entry += f"📱 Номер телефона: {phone}\n"
-        user_entry += f"🔗 Username: {username}\n\n"
-        
-        user_list_text += user_entry
-    
-    # Если список пустой (хотя бы админ должен быть)
-    if not user_list_text:
-        user_list_text = "Нет данных о пользователях."
-
-    # Разбиваем на части по ~4000 символов, чтобы не превысить лимит
-    parts = []
-    while len(user_list_text) > 0:
-        if len(user_list_text) > 4000:
-            part = user_list_text[:4000]
-            # Ищем последний перенос строки, чтобы не разрывать запись
-            last_newline = part.rfind('\n\n')
-            if last_newline != -1:
-                part = user_list_text[:last_newline+2]
-                user_list_text = user_list_text[last_newline+2:]
+    # Метрики очереди обработки обновлений
+    metrics = get_dispatch_metrics()
+    response += "⚙️ <b>Обработка обновлений</b>\n"
+    response += f"В очереди: {metrics['waiting']} (пользователей: {metrics['users_in_queue']}), в работе: {metrics['running']}\n"
+    response += f"Обработано: {metrics['processed']}\n"
+    response += f"Ожидание: среднее {metrics['wait_avg'] * 1000:.1f} мс, максимум {metrics['wait_max'] * 1000:.1f} мс\n"
+    response += f"Максимальная очередь одного пользователя: {metrics['max_user_depth']}\n\n"
+
+    # Счётчики ограничения частоты запросов
+    throttle = get_throttle_metrics()
+    response += "🚦 <b>Ограничение частоты</b>\n"
+    response += f"Отклонено нажатий: {throttle['callbacks']}, сообщений: {throttle['messages']}\n"
+    response += f"Пользователей под ограничением: {throttle['users']}\n"
+    if throttle["top_user_id"]:
+        response += f"Чаще всех: {throttle['top_user_id']} ({throttle['top_user_count']})\n"
+    response += "\n"
+
+    # Навигация по меню: правки на месте против новых сообщений
+    response += "🧭 <b>Навигация по меню</b>\n"
+    response += f"Отредактировано: {navigation_metrics['edited']}, отправлено новых: {navigation_metrics['sent']}, "
+    response += f"без изменений: {navigation_metrics['skipped']}\n\n"
+    
+    # Полные списки выгружаются файлами, а не сообщениями по 4000 символов
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📥 Пользователи (CSV)", callback_data=pack_callback("export", "users"))],
+        [InlineKeyboardButton(text="📥 Диалоги (JSONL)", callback_data=pack_callback("export", "dialogs"))],
+        [InlineKeyboardButton(text="📥 Переписка (TXT)", callback_data=pack_callback("export", "transcripts"))],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_admin")]
+    ])
+    await show_menu(callback, state, response, keyboard, parse_mode="HTML")
+
+
+# 2. Выгрузка данных: строки пишутся из генераторов во временный файл, который уходит одним документом,
+# поэтому объём выгрузки не зависит от лимита сообщения и не держится в памяти целиком
+EXPORT_KINDS = {
+    "users": ("users.csv", "👥 Пользователи"),
+    "dialogs": ("dialogs.jsonl", "💬 Диалоги"),
+    "transcripts": ("transcripts.txt", "📜 Переписка"),
+}
+
+
+def iter_users_rows(phones: dict):
+    yield ["user_id", "first_name", "last_name", "username", "phone"]
+    for user_id, data in phones.items():
+        yield [user_id, data.get("first_name") or "", data.get("last_name") or "", data.get("username") or "", data.get("phone") or ""]
+
+
+def iter_dialogs_jsonl(dialogs: dict):
+    for dialog_id, dialog in dialogs.items():
+        yield json.dumps({"dialog_id": dialog_id, **dialog}, ensure_ascii=False) + "\n"
+
+
+def iter_transcript_lines(dialogs: dict, dialog_ids):
+    for dialog_id in dialog_ids:
+        dialog = dialogs.get(dialog_id)
+        if not dialog:
+            continue
+        username = f" @{dialog['username']}" if dialog.get("username") else ""
+        yield f"=== {dialog_id} ===\n"
+        yield f"Пользователь: {dialog.get('user_name', 'Не указано')}{username}, {dialog.get('user_phone', 'Не указан')}\n"
+        yield f"Раздел: {' > '.join(dialog.get('button_path') or []) or '-'}\n"
+        yield f"Статус: {dialog['status']}, оператор: {dialog.get('operator_id') or '-'}, создан: {dialog.get('created_at', 'N/A')}\n\n"
+        for message in dialog.get("messages", []):
+            author = "Оператор" if message.get("from") == "operator" else "Пользователь"
+            yield f"[{message.get('timestamp', '')}] {author}: {message_label(message)}\n"
+        yield "\n"
+
+
+def write_export_file(kind: str, source: dict, dialog_ids=None) -> tuple[str, int]:
+    """Пишет выгрузку во временный файл и возвращает его путь и число записей"""
+    suffix = os.path.splitext(EXPORT_KINDS[kind][0])[1]
+    fd, path = tempfile.mkstemp(prefix=f"export_{kind}_", suffix=suffix)
+    try:
+        # utf-8-sig - чтобы Excel открыл CSV с кириллицей без настройки кодировки
+        with open(fd, "w", encoding="utf-8-sig" if kind == "users" else "utf-8", newline="") as f:
+            if kind == "users":
+                csv.writer(f).writerows(iter_users_rows(source))
+            elif kind == "dialogs":
+                f.writelines(iter_dialogs_jsonl(source))
             else:
-                user_list_text = user_list_text[4000:]
-            parts.append(part)
-        else:
-            parts.append(user_list_text)
-            user_list_text = ""
+                dialog_ids = list(source) if dialog_ids is None else dialog_ids
+                f.writelines(iter_transcript_lines(source, dialog_ids))
+                return path, sum(1 for dialog_id in dialog_ids if dialog_id in source)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, len(source)
+
+
+async def send_export(chat_id: int, kind: str, dialog_ids: list = None, filename: str = None):
+    """Формирует выгрузку в отдельном потоке и отправляет её одним документом"""
+    source = await load_phones() if kind == "users" else (await load_dialogs())["dialogs"]
+    path, count = await asyncio.to_thread(write_export_file, kind, source, dialog_ids)
+    try:
+        filename = filename or f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{EXPORT_KINDS[kind][0]}"
+        await bot.send_document(chat_id, FSInputFile(path, filename=filename), caption=f"{EXPORT_KINDS[kind][1]}: {count}")
+    finally:
+        os.remove(path)
+
 
-    # Отправляем заголовок (редактируем старое сообщение)
-    await callback.message.edit_text(response, parse_mode="HTML")
+@callback_route("export")
+async def handle_export(callback: CallbackQuery, state: FSMContext):
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Только для админов", show_alert=True)
+        return
     
-    # Отправляем части списка отдельными сообщениями
-    for part in parts:
-        await callback.message.answer(part, parse_mode="HTML")
-        await asyncio.sleep(0.1)
+    _, kind = unpack_callback(callback.data)
+    if kind not in EXPORT_KINDS:
+        await callback.answer()
+        return
+    await callback.answer("⏳ Готовлю файл...")
+    await send_export(callback.message.chat.id, kind)
+
+
+@dp.message(Command("export"))
+async def cmd_export(message: Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
+    
+    args = (message.text or "").split()[1:]
+    if not args or args[0] not in EXPORT_KINDS:
+        await message.answer(
+            "ℹ️ Использование: /export <вид>\n\n"
+            "users - пользователи (CSV)\n"
+            "dialogs - диалоги с сообщениями (JSONL)\n"
+            "transcripts - переписка всех диалогов (TXT)"
+        )
+        return
+    await send_export(message.chat.id, args[0])
+
+
+@dp.message(Command("transcript"))
+async def cmd_transcript(message: Message, state: FSMContext):
+    if not is_admin_or_operator(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде.")
+        return
+    
+    args = (message.text or "").split()[1:]
+    if not args:
+        await message.answer("ℹ️ Использование: /transcript <dialog_id>")
+        return
+    
+    dialog_id = args[0]
+    dialogs_data = await load_dialogs()
+    if dialog_id not in dialogs_data["dialogs"]:
+        await message.answer("❌ Диалог не найден.")
+        return
+    await send_export(message.chat.id, "transcripts", [dialog_id], filename=f"{dialog_id}.txt")
 
-    # Кнопка назад отдельным сообщением в конце
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_admin")]
-    ])
-    await callback.message.answer("🔽 Конец списка", reply_markup=keyboard)
 
-@dp.callback_query(F.data == "back_to_admin")
+@callback_route("back_to_admin")
 async def back_to_admin(callback: CallbackQuery, state: FSMContext):
     # Сначала отвечаем на callback
     try:
@@ -2359,12 +4050,13 @@ async def back_to_admin(callback: CallbackQuery, state: FSMContext):
     except:
         await callback.message.answer("🔧 Админ-панель", reply_markup=keyboard)
 
-# 2. Рассылка
-@dp.callback_query(F.data == "admin_broadcast")
+# 3. Рассылка
+@callback_route("admin_broadcast")
 async def start_broadcast(callback: CallbackQuery, state: FSMContext):
     if not is_admin(callback.from_user.id):
         await callback.answer("Только для админов", show_alert=True)
         return
+    await callback.answer()
         
     await state.set_state(AdminStates.waiting_broadcast_content)
     
@@ -2407,8 +4099,12 @@ async def process_broadcast_content(message: Message, state: FSMContext):
     # Тут можно было бы отправить копию для предпросмотра
     await message.copy_to(chat_id=message.chat.id)
 
-@dp.callback_query(F.data == "confirm_broadcast", AdminStates.waiting_broadcast_confirm)
+@callback_route("confirm_broadcast")
 async def execute_broadcast(callback: CallbackQuery, state: FSMContext):
+    if await state.get_state() != AdminStates.waiting_broadcast_confirm:
+        await callback.answer()
+        return
+    
     data = await state.get_data()
     msg_id = data.get("broadcast_message_id")
     chat_id = data.get("broadcast_chat_id")
@@ -2453,12 +4149,13 @@ async def execute_broadcast(callback: CallbackQuery, state: FSMContext):
     ])
     await callback.message.answer("🔧 Админ-панель", reply_markup=keyboard)
 
-# 3. Отложенная рассылка
-@dp.callback_query(F.data == "admin_scheduled_broadcast")
+# 4. Отложенная рассылка
+@callback_route("admin_scheduled_broadcast")
 async def start_scheduled_broadcast(callback: CallbackQuery, state: FSMContext):
     if not is_admin(callback.from_user.id):
         await callback.answer("Только для админов", show_alert=True)
         return
+    await callback.answer()
         
     await state.set_state(AdminStates.waiting_schedule_date)
     
@@ -2519,7 +4216,17 @@ async def process_schedule_content(message: Message, state: FSMContext):
     )
     await message.copy_to(chat_id=message.chat.id)
 
-async def send_scheduled_message(chat_id, message_id):
+async def send_scheduled_message(chat_id, message_id, broadcast_id=None):
+    # Отмечаем рассылку как начатую, чтобы другой процесс не отправил её повторно
+    if broadcast_id:
+        async with scheduled_lock:
+            broadcasts = await load_scheduled_broadcasts()
+            broadcast = broadcasts.get(broadcast_id)
+            if not broadcast or broadcast.get("status") != "pending":
+                return
+            broadcast["status"] = "sent"
+            await save_scheduled_broadcasts(broadcasts)
+    
     phones = await load_phones()
     users = list(phones.keys())
     print(f"[SCHEDULED] Starting broadcast to {len(users)} users")
@@ -2531,21 +4238,54 @@ async def send_scheduled_message(chat_id, message_id):
         except Exception as e:
             print(f"[SCHEDULED] Failed to send to {user_id}: {e}")
 
-@dp.callback_query(F.data == "confirm_schedule", AdminStates.waiting_schedule_confirm)
+
+async def sync_scheduled_broadcasts():
+    """Добавляет в планировщик ведущего процесса рассылки из общего хранилища"""
+    broadcasts = await load_scheduled_broadcasts()
+    for broadcast_id, broadcast in broadcasts.items():
+        if broadcast.get("status") != "pending" or scheduler.get_job(broadcast_id):
+            continue
+        # Испорченная запись (например, run_date не разбирается) не мешает остальным рассылкам
+        try:
+            scheduler.add_job(
+                send_scheduled_message,
+                'date',
+                id=broadcast_id,
+                run_date=datetime.fromisoformat(broadcast["run_date"]),
+                args=[broadcast["chat_id"], broadcast["message_id"], broadcast_id],
+                misfire_grace_time=None
+            )
+        except Exception as e:
+            print(f"[SCHEDULED] Не удалось запланировать рассылку {broadcast_id}: {e}")
+
+
+@callback_route("confirm_schedule")
 async def execute_schedule(callback: CallbackQuery, state: FSMContext):
+    if await state.get_state() != AdminStates.waiting_schedule_confirm:
+        await callback.answer()
+        return
+    
     data = await state.get_data()
     msg_id = data.get("broadcast_message_id")
     chat_id = data.get("broadcast_chat_id")
     run_date_str = data.get("run_date")
     run_date = datetime.fromisoformat(run_date_str)
     
-    # Добавляем задачу в планировщик
-    scheduler.add_job(
-        send_scheduled_message,
-        'date',
-        run_date=run_date,
-        args=[chat_id, msg_id]
-    )
+    # Сохраняем рассылку в общее хранилище - её выполнит ведущий процесс
+    broadcast_id = f"broadcast_{chat_id}_{msg_id}"
+    async with scheduled_lock:
+        broadcasts = await load_scheduled_broadcasts()
+        broadcasts[broadcast_id] = {
+            "chat_id": chat_id,
+            "message_id": msg_id,
+            "run_date": run_date.isoformat(),
+            "status": "pending"
+        }
+        await save_scheduled_broadcasts(broadcasts)
+    
+    # Если этот процесс ведущий, сразу добавляем задачу в планировщик
+    if is_leader:
+        await sync_scheduled_broadcasts()
     
     await callback.message.edit_text(
         f"✅ <b>Рассылка успешно запланирована!</b>\n"
@@ -2566,10 +4306,12 @@ async def execute_schedule(callback: CallbackQuery, state: FSMContext):
     await callback.message.answer("🔧 Админ-панель", reply_markup=keyboard)
 
 
-# Обработка сообщений пользователя вне диалога (обычные сообщения, не команды и не в состоянии диалога)
+# Обработка сообщений пользователя вне диалога (обычные сообщения и вложения, не команды и не в состоянии диалога).
+# Состояние in_dialog теряется после "Назад", перезапуска с MemoryStorage и при разборе накопившихся обновлений,
+# поэтому и текст, и вложения пользователя с активным диалогом доходят до оператора через поиск диалога
 async def is_not_command(message: Message) -> bool:
     """Проверяет, что сообщение не является командой"""
-    return message.text is not None and not message.text.startswith("/")
+    return not (message.text or "").startswith("/")
 
 @dp.message(is_not_command)
 async def handle_regular_message(message: Message, state: FSMContext):
@@ -2598,160 +4340,274 @@ async def handle_regular_message(message: Message, state: FSMContext):
     pass
 
 
+# ==========================================
+# Выбор ведущего процесса
+# ==========================================
+# Задачи планировщика (отложенные рассылки, периодические проверки) выполняет только
+# ведущий процесс. Роль подтверждается арендой в SQLite и продлевается каждые
+# LEADER_LEASE_TTL / 3 секунд; если ведущий перестал продлевать аренду, её забирает другой процесс.
+
+LEADER_LEASE_NAME = "scheduler"
+instance_id = f"{socket.gethostname()}:{os.getpid()}"
+is_leader = False
+
+# Фоновые задачи, которые работают только в ведущем процессе
+leader_tasks = [sla_watch_loop, idle_sweep_loop]
+running_leader_tasks = []
+
+
+def init_leases():
+    conn = get_db_connection()
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def try_acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """Берёт или продлевает аренду. Возвращает True, если аренда у holder"""
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        row = conn.execute("SELECT holder, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+        if row and row[0] != holder and row[1] > now:
+            conn.rollback()
+            return False
+        conn.execute(
+            "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at",
+            (name, holder, now + ttl)
+        )
+        conn.commit()
+        return True
+    finally:
+        conn.close()
+
+
+def release_lease(name: str, holder: str):
+    conn = get_db_connection()
+    try:
+        conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def become_leader():
+    global is_leader
+    is_leader = True
+    print(f"[LEADER] Процесс {instance_id} стал ведущим")
+    try:
+        await sync_scheduled_broadcasts()
+    except Exception as e:
+        # Рассылки досинхронизирует периодическая задача sync_scheduled_broadcasts
+        print(f"[LEADER] Ошибка загрузки отложенных рассылок: {e}")
+    scheduler.resume()
+    for task_func in leader_tasks:
+        running_leader_tasks.append(asyncio.create_task(task_func()))
+
+
+def resign_leader():
+    global is_leader
+    is_leader = False
+    print(f"[LEADER] Процесс {instance_id} больше не ведущий")
+    scheduler.pause()
+    for task in running_leader_tasks:
+        task.cancel()
+    running_leader_tasks.clear()
+
+
+async def leader_election_loop():
+    """Периодически берёт или продлевает аренду роли ведущего"""
+    try:
+        while True:
+            try:
+                acquired = await asyncio.to_thread(try_acquire_lease, LEADER_LEASE_NAME, instance_id, LEADER_LEASE_TTL)
+            except Exception as e:
+                print(f"[LEADER] Ошибка продления аренды: {e}")
+                acquired = False
+            
+            if acquired and not is_leader:
+                try:
+                    await become_leader()
+                except Exception as e:
+                    # Ошибка при вступлении в роль не останавливает выборы: аренда продолжает продлеваться
+                    print(f"[LEADER] Ошибка при получении роли ведущего: {e}")
+            elif not acquired and is_leader:
+                resign_leader()
+            
+            await asyncio.sleep(LEADER_LEASE_TTL / 3)
+    finally:
+        if is_leader:
+            resign_leader()
+            await asyncio.to_thread(release_lease, LEADER_LEASE_NAME, instance_id)
+
+
 async def setup_commands(bot: Bot):
     from aiogram.types import BotCommand
     commands = [
         BotCommand(command="start", description="🏠 Главное меню"),
+        BotCommand(command="language", description="🌐 Язык / Til / Забон / Тил"),
     ]
     await bot.set_my_commands(commands)
 
+# Нажатия кнопок, которые имеет смысл выполнить и после перезапуска бота.
+# Остальные нажатия из очереди - устаревшая навигация по меню, их пропускаем.
+BACKLOG_CALLBACK_ACTIONS = frozenset(("chat_operator", "continue_dialog", "accept_dialog", "reply_dialog", "close_dialog", "cancel_user_dialog"))
+
+
+def is_stale_backlog_update(update: Update) -> bool:
+    """Проверяет, что накопившееся обновление можно не обрабатывать"""
+    if update.callback_query:
+        action, _ = unpack_callback(update.callback_query.data or "")
+        return action not in BACKLOG_CALLBACK_ACTIONS
+    return False
+
+
+async def process_backlog():
+    """Обрабатывает обновления, накопившиеся пока бот был остановлен.
+
+    Обновления забираются пачками по 100 и обрабатываются параллельно для разных
+    пользователей (порядок для одного пользователя сохраняет ordered_updates_middleware)."""
+    started_at = time.monotonic()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    replayed = 0
+    dropped = 0
+    
+    while True:
+        updates = await bot.get_updates(offset=offset, limit=100, timeout=0, allowed_updates=allowed_updates)
+        if not updates:
+            break
+        offset = updates[-1].update_id + 1
+        
+        batch = []
+        for update in updates:
+            if is_stale_backlog_update(update):
+                dropped += 1
+            else:
+                batch.append(update)
+        
+        results = await asyncio.gather(*(dp.feed_update(bot, update, backlog=True) for update in batch), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"[BACKLOG] Ошибка обработки обновления: {result}")
+        replayed += len(batch)
+    
+    print(f"[BACKLOG] Обработано {replayed}, пропущено {dropped} накопившихся обновлений за {time.monotonic() - started_at:.2f} с")
+
+
+def create_webhook_app() -> web.Application:
+    """Создает aiohttp-приложение, принимающее обновления от Telegram"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+webhook_lock = FileLock(os.path.join(LOCKS_DIR, "webhook.lock"))
+
+
+async def register_webhook():
+    """Регистрирует webhook в Telegram. С общей базой SQLite (несколько процессов) адрес регистрирует только
+    первый процесс, а накопившиеся обновления не сбрасываются: перезапуск одного процесса не должен терять их для всех"""
+    url = f"{WEBHOOK_URL}{WEBHOOK_PATH}"
+    allowed_updates = dp.resolve_used_update_types()
+    if STORAGE_BACKEND != "sqlite":
+        # Накопившиеся обновления Telegram доставит сам, если их не сбросить
+        await bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET, allowed_updates=allowed_updates,
+                              drop_pending_updates=not PROCESS_BACKLOG)
+        return
+    
+    # Отпечаток настроек: секрет из getWebhookInfo не узнать, поэтому сравниваем с тем, что зарегистрировали сами
+    fingerprint = hashlib.sha256(json.dumps([url, WEBHOOK_SECRET, sorted(allowed_updates)]).encode()).hexdigest()
+    async with webhook_lock:
+        info = await bot.get_webhook_info()
+        if info.url == url and await asyncio.to_thread(db_read_document, "webhook") == fingerprint:
+            print("[WEBHOOK] Webhook уже зарегистрирован другим процессом")
+            return
+        await bot.set_webhook(url=url, secret_token=WEBHOOK_SECRET, allowed_updates=allowed_updates,
+                              drop_pending_updates=False)
+        await asyncio.to_thread(db_write_document, "webhook", fingerprint)
+
+
+async def run_webhook():
+    """Запускает приём обновлений через webhook"""
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        print("[WEBHOOK] Для режима webhook необходимо указать WEBHOOK_URL и WEBHOOK_SECRET")
+        return
+    
+    await register_webhook()
+    
+    runner = web.AppRunner(create_webhook_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+    await site.start()
+    print(f"[WEBHOOK] Приём обновлений на {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    try:
+        # Работаем, пока процесс не остановят
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 async def main():
-    # Запуск планировщика
-    scheduler.start()
+    # Запуск планировщика: задачи выполняются только после получения роли ведущего
+    scheduler.start(paused=True)
+    scheduler.add_job(sync_scheduled_broadcasts, 'interval', seconds=30, id="sync_scheduled_broadcasts")
+    init_leases()
+    leader_election = asyncio.create_task(leader_election_loop())
+    
+    # Перечитывание .env, texts.json и buttons.json: по сигналу SIGHUP и периодической проверкой
+    reload_roles()
+    if hasattr(signal, "SIGHUP"):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, lambda: asyncio.create_task(reload_config(force=True))
+        )
+    config_watch = asyncio.create_task(config_watch_loop()) if CONFIG_RELOAD_INTERVAL > 0 else None
     
     # Настройка команд (меню)
     await setup_commands(bot)
 
-    # Инициализация файлов, если их нет
-    texts = await load_texts()
-    if not texts:
-        await save_texts({
-            "welcome_message": 
-                "👋 Добро пожаловать, {name}!\n\n✨ Мы рады приветствовать вас в нашем сервисе!\n\n🏢 Наша организация специализируется на оказании профессиональных услуг в сфере миграционного права и документооборота.\n\n📋 Ниже представлен полный перечень услуг, которые мы предоставляем:\n\n📌 РВП — разрешение на временное проживание\n📌 ВНЖ — Вид на жительство\n📌 Гражданство Российской Федерации\n📌 Временная или постоянная регистрация\n📌 Миграционный учёт\n📌 Гражданско-правовой договор (ГПХ) / трудовой договор\n📌 Декларация физического лица (3-НДФЛ)\n📌 Перевод документов\n📌 Договор найма / безвозмездного пользования жилым помещением\n📌 Договор купли-продажи автомобиля / договор аренды\n📌 Уведомление о проживании\n📌 Уведомление о заключении договора ГПХ\n📌 Уведомление о расторжении договора ГПХ\n\n💼 Для получения подробной информации выберите интересующую услугу из меню ниже.",
-            "service_rvp": 
-                "📌 РВП — разрешение на временное проживание\n(мужчины — только через контракт)\n\nДля заполнения заявления потребуется:\n• Паспорт + перевод всех страниц\n• Свидетельство о рождении (своё)\n• Свидетельство о рождении\nсына / дочери / матери / отца — по основанию подачи\n• Свидетельство о браке\n• Регистрация и миграционный учёт\n• Миграционная карта\n• Медицинские справки\n• ИНН\n• Фото 3,5 × 4,5 см\n• Паспорт родственника\n(отца / матери / сына / дочери / супруга — по основанию)\n• Госпошлина",
-            "service_vnzh": 
-                "📌 ВНЖ — Вид на жительство\n(мужчины — только через контракт)\n\nДля заполнения заявления потребуется:\n• Паспорт + перевод всех страниц\n• Свидетельство о рождении (своё)\n• Свидетельство о рождении\nсына / дочери / матери / отца — по основанию подачи\n• Свидетельство о браке\n• Регистрация и миграционный учёт\n• Миграционная карта\n• Медицинские справки\n• ИНН\n• Фото 3,5 × 4,5 см\n• Паспорт родственника\n(отца / матери / сына / дочери / супруга — по основанию)\n• Госпошлина\n\nДополнительно необходимо предоставить:\n• Сведения об учёбе и работе / доходах за последние 3 года\n• Где проживали, чем занимались, куда переезжали\n• Информацию о родственниках\n(образец / бланк предоставляем)\n• Данные о родственниках:\nФИО, дата и место рождения, гражданство,\nадрес регистрации / проживания, род занятий\n(работает, учится, пенсионер, не работает)\n\nДля работающих:\n• Трудовой договор\n• При работе по патенту — патент + чеки",
-            "service_citizenship": 
-                "📌 Гражданство Российской Федерации\n(мужчины — только через контракт)\n\nДля заполнения заявления потребуется:\n• Паспорт + перевод всех страниц\n• Свидетельство о рождении (своё)\n• Свидетельство о рождении\nсына / дочери / матери / отца — по основанию подачи\n• Свидетельство о браке\n(о разводе / о смерти — при наличии)\n• Регистрация и миграционный учёт\n• ИНН\n• Фото 3 × 4 см\n• Паспорт родственника\n(отца / матери / сына / дочери / супруга — по основанию)\n• Госпошлина\n\nДополнительно необходимо предоставить:\n• Сведения об учёбе и работе / доходах за последние 5 лет\n• Где проживали, чем занимались, куда переезжали\n• Информацию о родственниках\n(образец / бланк предоставляем)\n• Данные о родственниках:\nФИО, дата и место рождения, гражданство,\nадрес регистрации / проживания, род занятий\n(работает, учится, пенсионер, не работает)\n\nДля работающих:\n• Трудовой договор",
-            "service_registration": 
-                "📌 Временная или постоянная регистрация\nпо ВНЖ или РВП\n\nРегистрация оформляется:\n• с печатью в ВНЖ\n• или в паспорт — при наличии РВП\n\nДля оформления потребуется:\n\n1️⃣ Документы заявителя:\n• Паспорт + ВНЖ или РВП\n\n2️⃣ Сведения о регистрации:\n• Информация о предыдущих регистрациях\n(миграционный учёт не учитывается)\n• При первой регистрации в РФ —\nадрес регистрации по месту жительства в другой стране\n\n3️⃣ Документы на жилое помещение:\n• Собственное жильё — выписка из ЕГРН\n• Жильё в найме — договор найма\n\n✍️ При необходимости можем оформить договор найма.\nДля этого потребуется:\n• Паспортные данные всех собственников\n• Выписка из ЕГРН или свидетельство\n(достаточно реквизитов для заполнения)",
-            "service_migration_account": 
-                "📋 Ниже представлен полный перечень услуг, которые мы предоставляем:\n\n📌 Миграционный учёт\n📌 Продление миграционного учёта по браку\n📌 Оформление на основании отца / матери\n\n💼 Для получения подробной информации выберите интересующую услугу из меню ниже.",
-            "service_migration_account_main": 
-                "📌 Миграционный учёт\n\nДля постановки на миграционный учёт потребуется:\n\n🧑‍💼 От собственника жилья (принимающей стороны):\n• Паспорт с регистрацией\n(паспортные данные: ФИО, серия и номер, кем и когда выдан, адрес прописки)\n• Документ на недвижимость\n(выписка из ЕГРН)\n• Номер телефона\n\n🌍 От иностранного гражданина:\n• Паспорт — все страницы с отметками\n• Место рождения\n(страна, населённый пункт)\n• Номер телефона\n• Миграционная карта — с двух сторон\n• Патент — с двух сторон\n(или трудовой договор)\n• Все чеки по патенту\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)",
-            "service_migration_account_marriage": 
-                "📌 Продление миграционного учёта по браку\n\nДля оформления потребуется:\n\n🌍 От иностранного гражданина:\n• Паспорт\n• Место рождения\n(страна, населённый пункт)\n• Номер телефона\n• Миграционная карта — с двух сторон\n• Свидетельство о браке\n• Медицинские справки и сопутствующие документы\n(для всех старше 6 лет)\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)\n\n👫 От супруга / супруги:\n• Паспорт РФ или ВНЖ\n• Регистрация по месту жительства",
-            "service_migration_account_parents": 
-                "📌 Оформление на основании отца / матери\nдля ребёнка (сына или дочери)\n\nДля оформления потребуется:\n\n👶 От ребёнка:\n• Паспорт\n• Номер телефона\n• Миграционная карта\n• Свидетельство о рождении\n• Медицинские справки и сопутствующие документы\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)\n\n👨‍👩‍👧 От отца / матери:\n• Паспорт РФ или ВНЖ\n• Регистрация по месту жительства\n• Номер телефона\n• Миграционная карта\n\nЕсли у отца / матери есть патент, дополнительно:\n• Патент\n• Все чеки по патенту\n\nТакже потребуется:\n• Место рождения\n(страна, населённый пункт)\n• Медицинские справки и сопутствующие документы\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)",
-            "service_declaration_3ndfl": 
-                "📌 Декларация физического лица (3-НДФЛ)\n\nДля подготовки декларации потребуется:\n• Паспорт\n• ИНН\n• Номер телефона\n• Размер дохода\n\nЕсли требуется налоговый вычет на детей:\n• Даты рождения всех детей\n• Копии свидетельств о рождении\n(предоставляются в налоговую)",
-            "service_translation": 
-                "📌 Перевод документов\n\nДля выполнения перевода потребуется:\n• Фото или скан документа\n\nПри необходимости нотариального заверения:\n• Оригинал документа",
-            "service_contracts": 
-                "📋 Ниже представлен полный перечень услуг, которые мы предоставляем:\n\n📌 Гражданско-правовой договор (ГПХ) / трудовой договор\n📌 Договор найма / безвозмездного пользования жилым помещением\n📌 Договор купли-продажи автомобиля / договор аренды\n\n💼 Для получения подробной информации выберите интересующую услугу из меню ниже.",
-            "service_contracts_gph": 
-                "📌 Гражданско-правовой договор (ГПХ) / трудовой договор\n\nЗаключение договора включает:\n• Подготовку договора\n• Уведомления в госорганы\n• Описи документов\n• Конверты — 2 пакета документов\n\nДля оформления необходимо предоставить:\n\n👤 От заказчика:\n• Паспорт РФ + регистрация (прописка)\n• ИНН\n• Адрес места работы\n• Срок действия договора\n(дата окончания или бессрочно)\n• Размер вознаграждения:\n— почасовая оплата (XXX ₽/час)\n— или ежемесячная оплата (XXXXX ₽/мес)\n\n👷 От исполнителя (работника):\n• Паспорт\n• Патент\n• ИНН (если не указан в патенте)\n• Регистрация\n(прописка или миграционный учёт)\n• Медицинская страховка\n(полис ДМС)",
-            "service_contracts_rent": 
-                "📌 Договор найма / безвозмездного пользования жилым помещением\n\nДля подготовки договора потребуется:\n• Паспорта обеих сторон\n(или паспортные данные)\n• Выписка из ЕГРН\n• Номера телефонов сторон",
-            "service_contracts_car": 
-                "📌 Договор купли-продажи автомобиля / договор аренды\n\nВ услугу входит:\n• Подготовка договора\n• Заявление в ГИБДД\n(на постановку или снятие с учёта)\n\nДля оформления потребуется:\n• СТС\n• ПТС\n• Паспорта обеих сторон\n(или паспортные данные)\n• Номера телефонов сторон",
-            "service_notifications": 
-                "📋 Ниже представлен полный перечень услуг, которые мы предоставляем:\n\n📌 Уведомление о проживании\n📌 Уведомление о заключении договора ГПХ\n📌 Уведомление о расторжении договора ГПХ\n\n💼 Для получения подробной информации выберите интересующую услугу из меню ниже.",
-            "service_notifications_residence": 
-                "📌 Уведомление о проживании\nежегодная отметка по ВНЖ или РВП\n\nДля оформления потребуется:\n\n1️⃣ Документы:\n• Паспорт + ВНЖ или РВП\n\n2️⃣ Регистрация:\n• Регистрация по месту жительства\nили миграционный учёт\n\n3️⃣ Доход (для ВНЖ):\n• Размер дохода\n• При официальной работе —\nсправка о доходах, должность, адрес организации\n\n4️⃣ Выезды за границу:\n• Информация обо всех периодах выезда и въезда\nза отчётный год",
-            "service_notifications_gph_conclusion": 
-                "📌 Уведомление о заключении договора ГПХ\n\nДля оформления потребуется:\n\n👤 От заказчика:\n• Паспорта обеих сторон\n(или паспортные данные)\n• ИНН заказчика\n• Номер телефона заказчика\n• Профессия исполнителя\n• Адрес места работы\n• Патент исполнителя\n\n👷 От исполнителя (с патентом):\n• Паспорт (паспортные данные)\n• Патент\n• Медицинский полис\n(страховка)\n• ИНН (если не указан в патенте)\n• Номер телефона\n• Адрес места работы",
-            "service_notifications_gph_termination": 
-                "📌 Уведомление о расторжении договора ГПХ\n\nДля оформления потребуется:\n• Паспорта обеих сторон\n(или паспортные данные)\n• ИНН заказчика\n• Номер телефона заказчика\n• Профессия исполнителя\n• Адрес места работы\n• Патент исполнителя\n• Дата расторжения договора",
-            "service_contacts": 
-                "📞 Контакты\n\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n📞 Помощь в заполнении бланков:\n\n📱 +7-950-415-8179\n👤 Олег\n\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n💬 Мы всегда готовы помочь вам с любыми вопросами!"
-        })
-    else:
-        # Проверяем и добавляем тексты для услуг, если их нет
-        updated = False
-        if "service_rvp" not in texts:
-            texts["service_rvp"] = "📌 РВП — разрешение на временное проживание\n(мужчины — только через контракт)\n\nДля заполнения заявления потребуется:\n• Паспорт + перевод всех страниц\n• Свидетельство о рождении (своё)\n• Свидетельство о рождении\nсына / дочери / матери / отца — по основанию подачи\n• Свидетельство о браке\n• Регистрация и миграционный учёт\n• Миграционная карта\n• Медицинские справки\n• ИНН\n• Фото 3,5 × 4,5 см\n• Паспорт родственника\n(отца / матери / сына / дочери / супруга — по основанию)\n• Госпошлина"
-            updated = True
-        
-        if "service_vnzh" not in texts:
-            texts["service_vnzh"] = "📌 ВНЖ — Вид на жительство\n(мужчины — только через контракт)\n\nДля заполнения заявления потребуется:\n• Паспорт + перевод всех страниц\n• Свидетельство о рождении (своё)\n• Свидетельство о рождении\nсына / дочери / матери / отца — по основанию подачи\n• Свидетельство о браке\n• Регистрация и миграционный учёт\n• Миграционная карта\n• Медицинские справки\n• ИНН\n• Фото 3,5 × 4,5 см\n• Паспорт родственника\n(отца / матери / сына / дочери / супруга — по основанию)\n• Госпошлина\n\nДополнительно необходимо предоставить:\n• Сведения об учёбе и работе / доходах за последние 3 года\n• Где проживали, чем занимались, куда переезжали\n• Информацию о родственниках\n(образец / бланк предоставляем)\n• Данные о родственниках:\nФИО, дата и место рождения, гражданство,\nадрес регистрации / проживания, род занятий\n(работает, учится, пенсионер, не работает)\n\nДля работающих:\n• Трудовой договор\n• При работе по патенту — патент + чеки"
-            updated = True
-        
-        if "service_citizenship" not in texts:
-            texts["service_citizenship"] = "📌 Гражданство Российской Федерации\n(мужчины — только через контракт)\n\nДля заполнения заявления потребуется:\n• Паспорт + перевод всех страниц\n• Свидетельство о рождении (своё)\n• Свидетельство о рождении\nсына / дочери / матери / отца — по основанию подачи\n• Свидетельство о браке\n(о разводе / о смерти — при наличии)\n• Регистрация и миграционный учёт\n• ИНН\n• Фото 3 × 4 см\n• Паспорт родственника\n(отца / матери / сына / дочери / супруга — по основанию)\n• Госпошлина\n\nДополнительно необходимо предоставить:\n• Сведения об учёбе и работе / доходах за последние 5 лет\n• Где проживали, чем занимались, куда переезжали\n• Информацию о родственниках\n(образец / бланк предоставляем)\n• Данные о родственниках:\nФИО, дата и место рождения, гражданство,\nадрес регистрации / проживания, род занятий\n(работает, учится, пенсионер, не работает)\n\nДля работающих:\n• Трудовой договор"
-            updated = True
-        
-        if "service_registration" not in texts:
-            texts["service_registration"] = "📌 Временная или постоянная регистрация\nпо ВНЖ или РВП\n\nРегистрация оформляется:\n• с печатью в ВНЖ\n• или в паспорт — при наличии РВП\n\nДля оформления потребуется:\n\n1️⃣ Документы заявителя:\n• Паспорт + ВНЖ или РВП\n\n2️⃣ Сведения о регистрации:\n• Информация о предыдущих регистрациях\n(миграционный учёт не учитывается)\n• При первой регистрации в РФ —\nадрес регистрации по месту жительства в другой стране\n\n3️⃣ Документы на жилое помещение:\n• Собственное жильё — выписка из ЕГРН\n• Жильё в найме — договор найма\n\n✍️ При необходимости можем оформить договор найма.\nДля этого потребуется:\n• Паспортные данные всех собственников\n• Выписка из ЕГРН или свидетельство\n(достаточно реквизитов для заполнения)"
-            updated = True
-        
-        if "service_migration_account" not in texts:
-            texts["service_migration_account"] = "📋 Ниже представлен полный перечень услуг, которые мы предоставляем:\n\n📌 Миграционный учёт\n📌 Продление миграционного учёта по браку\n📌 Оформление на основании отца / матери\n\n💼 Для получения подробной информации выберите интересующую услугу из меню ниже."
-            updated = True
-        
-        if "service_migration_account_main" not in texts:
-            texts["service_migration_account_main"] = "📌 Миграционный учёт\n\nДля постановки на миграционный учёт потребуется:\n\n🧑‍💼 От собственника жилья (принимающей стороны):\n• Паспорт с регистрацией\n(паспортные данные: ФИО, серия и номер, кем и когда выдан, адрес прописки)\n• Документ на недвижимость\n(выписка из ЕГРН)\n• Номер телефона\n\n🌍 От иностранного гражданина:\n• Паспорт — все страницы с отметками\n• Место рождения\n(страна, населённый пункт)\n• Номер телефона\n• Миграционная карта — с двух сторон\n• Патент — с двух сторон\n(или трудовой договор)\n• Все чеки по патенту\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)"
-            updated = True
-        
-        if "service_migration_account_marriage" not in texts:
-            texts["service_migration_account_marriage"] = "📌 Продление миграционного учёта по браку\n\nДля оформления потребуется:\n\n🌍 От иностранного гражданина:\n• Паспорт\n• Место рождения\n(страна, населённый пункт)\n• Номер телефона\n• Миграционная карта — с двух сторон\n• Свидетельство о браке\n• Медицинские справки и сопутствующие документы\n(для всех старше 6 лет)\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)\n\n👫 От супруга / супруги:\n• Паспорт РФ или ВНЖ\n• Регистрация по месту жительства"
-            updated = True
-        
-        if "service_migration_account_parents" not in texts:
-            texts["service_migration_account_parents"] = "📌 Оформление на основании отца / матери\nдля ребёнка (сына или дочери)\n\nДля оформления потребуется:\n\n👶 От ребёнка:\n• Паспорт\n• Номер телефона\n• Миграционная карта\n• Свидетельство о рождении\n• Медицинские справки и сопутствующие документы\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)\n\n👨‍👩‍👧 От отца / матери:\n• Паспорт РФ или ВНЖ\n• Регистрация по месту жительства\n• Номер телефона\n• Миграционная карта\n\nЕсли у отца / матери есть патент, дополнительно:\n• Патент\n• Все чеки по патенту\n\nТакже потребуется:\n• Место рождения\n(страна, населённый пункт)\n• Медицинские справки и сопутствующие документы\n• Карточка дактилоскопии\n(отпечатки пальцев — для всех старше 6 лет)"
-            updated = True
-        
-        if "service_declaration_3ndfl" not in texts:
-            texts["service_declaration_3ndfl"] = "📌 Декларация физического лица (3-НДФЛ)\n\nДля подготовки декларации потребуется:\n• Паспорт\n• ИНН\n• Номер телефона\n• Размер дохода\n\nЕсли требуется налоговый вычет на детей:\n• Даты рождения всех детей\n• Копии свидетельств о рождении\n(предоставляются в налоговую)"
-            updated = True
-        
-        if "service_translation" not in texts:
-            texts["service_translation"] = "📌 Перевод документов\n\nДля выполнения перевода потребуется:\n• Фото или скан документа\n\nПри необходимости нотариального заверения:\n• Оригинал документа"
-            updated = True
-        
-        if "service_contracts" not in texts:
-            texts["service_contracts"] = "📋 Ниже представлен полный перечень услуг, которые мы предоставляем:\n\n📌 Гражданско-правовой договор (ГПХ) / трудовой договор\n📌 Договор найма / безвозмездного пользования жилым помещением\n📌 Договор купли-продажи автомобиля / договор аренды\n\n💼 Для получения подробной информации выберите интересующую услугу из меню ниже."
-            updated = True
-        
-        if "service_contracts_gph" not in texts:
-            texts["service_contracts_gph"] = "📌 Гражданско-правовой договор (ГПХ) / трудовой договор\n\nЗаключение договора включает:\n• Подготовку договора\n• Уведомления в госорганы\n• Описи документов\n• Конверты — 2 пакета документов\n\nДля оформления необходимо предоставить:\n\n👤 От заказчика:\n• Паспорт РФ + регистрация (прописка)\n• ИНН\n• Адрес места работы\n• Срок действия договора\n(дата окончания или бессрочно)\n• Размер вознаграждения:\n— почасовая оплата (XXX ₽/час)\n— или ежемесячная оплата (XXXXX ₽/мес)\n\n👷 От исполнителя (работника):\n• Паспорт\n• Патент\n• ИНН (если не указан в патенте)\n• Регистрация\n(прописка или миграционный учёт)\n• Медицинская страховка\n(полис ДМС)"
-            updated = True
-        
-        if "service_contracts_rent" not in texts:
-            texts["service_contracts_rent"] = "📌 Договор найма / безвозмездного пользования жилым помещением\n\nДля подготовки договора потребуется:\n• Паспорта обеих сторон\n(или паспортные данные)\n• Выписка из ЕГРН\n• Номера телефонов сторон"
-            updated = True
-        
-        if "service_contracts_car" not in texts:
-            texts["service_contracts_car"] = "📌 Договор купли-продажи автомобиля / договор аренды\n\nВ услугу входит:\n• Подготовка договора\n• Заявление в ГИБДД\n(на постановку или снятие с учёта)\n\nДля оформления потребуется:\n• СТС\n• ПТС\n• Паспорта обеих сторон\n(или паспортные данные)\n• Номера телефонов сторон"
-            updated = True
-        
-        if "service_notifications" not in texts:
-            texts["service_notifications"] = "📋 Ниже представлен полный перечень услуг, которые мы предоставляем:\n\n📌 Уведомление о проживании\n📌 Уведомление о заключении договора ГПХ\n📌 Уведомление о расторжении договора ГПХ\n\n💼 Для получения подробной информации выберите интересующую услугу из меню ниже."
-            updated = True
-        
-        if "service_notifications_residence" not in texts:
-            texts["service_notifications_residence"] = "📌 Уведомление о проживании\nежегодная отметка по ВНЖ или РВП\n\nДля оформления потребуется:\n\n1️⃣ Документы:\n• Паспорт + ВНЖ или РВП\n\n2️⃣ Регистрация:\n• Регистрация по месту жительства\nили миграционный учёт\n\n3️⃣ Доход (для ВНЖ):\n• Размер дохода\n• При официальной работе —\nсправка о доходах, должность, адрес организации\n\n4️⃣ Выезды за границу:\n• Информация обо всех периодах выезда и въезда\nза отчётный год"
-            updated = True
-        
-        if "service_notifications_gph_conclusion" not in texts:
-            texts["service_notifications_gph_conclusion"] = "📌 Уведомление о заключении договора ГПХ\n\nДля оформления потребуется:\n\n👤 От заказчика:\n• Паспорта обеих сторон\n(или паспортные данные)\n• ИНН заказчика\n• Номер телефона заказчика\n• Профессия исполнителя\n• Адрес места работы\n• Патент исполнителя\n\n👷 От исполнителя (с патентом):\n• Паспорт (паспортные данные)\n• Патент\n• Медицинский полис\n(страховка)\n• ИНН (если не указан в патенте)\n• Номер телефона\n• Адрес места работы"
-            updated = True
-        
-        if "service_notifications_gph_termination" not in texts:
-            texts["service_notifications_gph_termination"] = "📌 Уведомление о расторжении договора ГПХ\n\nДля оформления потребуется:\n• Паспорта обеих сторон\n(или паспортные данные)\n• ИНН заказчика\n• Номер телефона заказчика\n• Профессия исполнителя\n• Адрес места работы\n• Патент исполнителя\n• Дата расторжения договора"
-            updated = True
-        
-        if "service_contacts" not in texts:
-            texts["service_contacts"] = "📞 Контакты\n\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n📞 Помощь в заполнении бланков:\n\n📱 +7-950-415-8179\n👤 Олег\n\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n💬 Мы всегда готовы помочь вам с любыми вопросами!"
-            updated = True
-        
-        if updated:
-            await save_texts(texts)
+    # Тексты по умолчанию из defaults.json добавляются в texts.json одним проходом
+    await merge_default_texts()
     
+    # Индекс поиска по диалогам (заполняется существующими диалогами при первом запуске)
+    dialogs_data = await load_dialogs()
+    try:
+        await asyncio.to_thread(init_search_index, dialogs_data)
+    except sqlite3.Error as e:
+        print(f"[SEARCH] Индекс поиска недоступен: {e}")
+    
+    # Присутствие и нагрузка операторов для назначения диалогов, таймеры непринятых предложений
+    apply_presence(await load_presence())
+    assignment_pool.rebuild(dialogs_data)
+    restore_offer_timers(dialogs_data)
+    
+    # Каталог услуг; старый список main_menu переносится в каталог один раз
     buttons = await load_buttons()
-    if not buttons:
-        await save_buttons({"main_menu": [
-            ["РВП", "ВНЖ", "Гражданство"],
-            ["Регистрация", "Миграционный учёт"],
-            ["Декларация (3-НДФЛ)", "Перевод документов"],
-            ["Договоры", "Уведомления"],
-            ["Контакты"]
-        ]})
+    if "catalog" not in buttons:
+        buttons["catalog"] = catalog_from_main_menu(buttons.pop("main_menu", None))
+        await save_buttons(buttons)
     
     print("Бот запущен!")
     try:
-        await dp.start_polling(bot, skip_updates=True)
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            # Если ранее был установлен webhook, getUpdates с ним не работает
+            await bot.delete_webhook(drop_pending_updates=not PROCESS_BACKLOG)
+            if PROCESS_BACKLOG:
+                await process_backlog()
+            await dp.start_polling(bot)
     except KeyboardInterrupt:
         print("Бот остановлен пользователем")
     except Exception as e:
@@ -2759,6 +4615,13 @@ async def main():
         import traceback
         traceback.print_exc()
     finally:
+        if config_watch:
+            config_watch.cancel()
+        leader_election.cancel()
+        try:
+            await leader_election
+        except asyncio.CancelledError:
+            pass
         try:
             await bot.session.close()
         except:
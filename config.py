@@ -1,15 +1,38 @@
 import os
-from dotenv import load_dotenv
+from dotenv import load_dotenv, find_dotenv
+
+# Файл .env; бот перечитывает из него роли при изменении, поэтому путь запоминается
+ENV_FILE = os.getenv("ENV_FILE") or find_dotenv() or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+# Окружение процесса до загрузки .env: при перечитывании ролей ключ, удалённый из .env, берётся отсюда
+PROCESS_ENV = dict(os.environ)
+load_dotenv(ENV_FILE)
+
+
+def parse_ids(value: str) -> list:
+    """Список Telegram ID из строки через запятую"""
+    return [int(item.strip()) for item in value.split(",") if item.strip()]
+
+
+def parse_skills(value: str) -> dict:
+    """Навыки операторов из строки вида "id:тег|тег,id:тег" """
+    skills = {}
+    for item in value.split(","):
+        operator_id, _, tags = item.partition(":")
+        tags = frozenset(tag.strip() for tag in tags.split("|") if tag.strip())
+        if operator_id.strip() and tags:
+            skills[int(operator_id)] = tags
+    return skills
 
-load_dotenv()
 
 # Получаем значения из переменных окружения или используем значения по умолчанию
 BOT_TOKEN = os.getenv("BOT_TOKEN", "8137212504:AAHUyVbh634U0gINFOuTCSOpjMnern9HDRk")
 
 # Админы (через запятую)
-ADMIN_IDS = [int(admin_id.strip()) for admin_id in os.getenv("ADMIN_IDS", "6933111964,506336774").split(",") if admin_id.strip()]
+DEFAULT_ADMIN_IDS = "6933111964,506336774"
+ADMIN_IDS = parse_ids(os.getenv("ADMIN_IDS", DEFAULT_ADMIN_IDS))
 # Операторы (через запятую)
-OPERATOR_IDS = [int(operator_id.strip()) for operator_id in os.getenv("OPERATOR_IDS", "1182543866").split(",") if operator_id.strip()]
+DEFAULT_OPERATOR_IDS = "1182543866"
+OPERATOR_IDS = parse_ids(os.getenv("OPERATOR_IDS", DEFAULT_OPERATOR_IDS))
 
 # Для обратной совместимости
 ADMIN_ID = ADMIN_IDS[0] if ADMIN_IDS else 6933111964
@@ -21,4 +44,109 @@ DATA_DIR = os.getenv("DATA_DIR", "data")
 TEXTS_FILE = os.path.join(DATA_DIR, "texts.json")
 BUTTONS_FILE = os.path.join(DATA_DIR, "buttons.json")
 PHONES_FILE = os.path.join(DATA_DIR, "phones.json")
-DIALOGS_FILE = os.path.join(DATA_DIR, "dialogs.json")
\ No newline at end of file
+DIALOGS_FILE = os.path.join(DATA_DIR, "dialogs.json")
+PRESENCE_FILE = os.path.join(DATA_DIR, "presence.json")
+
+# Окно объединения подряд идущих сообщений пользователя в одно уведомление оператору (в секундах, 0 - отключено,
+# при STORAGE_BACKEND=sqlite отключено всегда, см. ниже)
+RELAY_MERGE_WINDOW = float(os.getenv("RELAY_MERGE_WINDOW", "10"))
+
+# Настройки HTTP-сессии бота
+# Адрес собственного сервера Telegram Bot API (например, http://localhost:8081), пусто - api.telegram.org
+BOT_API_URL = os.getenv("BOT_API_URL", "").strip()
+# Сервер Bot API запущен с флагом --local (файлы доступны по локальному пути)
+BOT_API_LOCAL = os.getenv("BOT_API_LOCAL", "0").strip().lower() in ("1", "true", "yes")
+# Максимальное число одновременных соединений в пуле (0 - без ограничений)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+# Сколько секунд держать неиспользуемое соединение открытым (keep-alive)
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+# Таймаут запроса к Bot API в секундах
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# Публичный адрес, на который Telegram будет отправлять обновления (например, https://bot.example.com)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+# Путь обработчика webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook").strip()
+# Секретный токен, который Telegram передаёт в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+# Адрес и порт, на которых слушает встроенный веб-сервер
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1").strip()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+
+# Максимальное число обновлений, обрабатываемых одновременно (обновления одного пользователя всегда идут по очереди)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "50"))
+
+# Хранилище диалогов, пользователей и состояний FSM:
+# json - файлы в DATA_DIR (один процесс), sqlite - общая база в режиме WAL (несколько процессов бота)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").strip().lower()
+# Объединение пересылок опирается на последнее сообщение в чате оператора, которое знает только свой процесс:
+# с общей базой другой процесс мог уже отправить оператору более новое сообщение, поэтому объединение отключается
+if STORAGE_BACKEND == "sqlite":
+    RELAY_MERGE_WINDOW = 0
+SQLITE_FILE = os.getenv("SQLITE_FILE", os.path.join(DATA_DIR, "bot.db"))
+# Файлы межпроцессных блокировок
+LOCKS_DIR = os.path.join(DATA_DIR, "locks")
+SCHEDULED_FILE = os.path.join(DATA_DIR, "scheduled.json")
+
+# Срок аренды роли ведущего процесса в секундах: только ведущий выполняет задачи планировщика,
+# при его остановке роль переходит другому процессу после истечения срока
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+
+# Обрабатывать ли обновления, накопившиеся пока бот был остановлен (1), или пропускать их (0)
+PROCESS_BACKLOG = os.getenv("PROCESS_BACKLOG", "0").strip().lower() in ("1", "true", "yes")
+
+# Ограничение частоты запросов от одного пользователя (админы и операторы не ограничиваются):
+# сколько нажатий кнопок / сообщений можно отправить подряд и сколько восстанавливается в секунду (0 - без ограничений)
+THROTTLE_CALLBACK_BURST = int(os.getenv("THROTTLE_CALLBACK_BURST", "5"))
+THROTTLE_CALLBACK_RATE = float(os.getenv("THROTTLE_CALLBACK_RATE", "1"))
+THROTTLE_MESSAGE_BURST = int(os.getenv("THROTTLE_MESSAGE_BURST", "10"))
+THROTTLE_MESSAGE_RATE = float(os.getenv("THROTTLE_MESSAGE_RATE", "1"))
+
+# Повторное нажатие той же кнопки в том же сообщении в течение этого времени (сек) считается
+# случайным двойным нажатием и не обрабатывается (0 - отключено). Касается кнопок, которые меняют
+# данные (принять, закрыть, удалить диалог, рассылка, выгрузка), навигация по меню не отсеивается
+CALLBACK_DEDUP_TTL = float(os.getenv("CALLBACK_DEDUP_TTL", "3"))
+
+# Навигация по меню редактирует сообщение с нажатой кнопкой (1) или открывает разделы главного меню
+# новыми сообщениями (0)
+MENU_EDIT_IN_PLACE = os.getenv("MENU_EDIT_IN_PLACE", "1").strip().lower() in ("1", "true", "yes")
+
+# Тексты по умолчанию, которые при запуске добавляются в texts.json (лежит рядом с кодом бота)
+DEFAULTS_FILE = os.getenv("DEFAULTS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "defaults.json"))
+
+# Как часто (сек) проверять изменения .env, texts.json и buttons.json (0 - только по сигналу SIGHUP)
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "5"))
+
+# Языки интерфейса через запятую: первый - основной (тексты без суффикса), для остальных
+# переводы хранятся в texts.json под ключами "ключ.язык"
+LOCALES = [locale.strip() for locale in os.getenv("LOCALES", "ru,uz,tg,ky").split(",") if locale.strip()] or ["ru"]
+DEFAULT_LOCALE = LOCALES[0]
+
+# Сколько диалогов показывать на одной странице панели /dialogs
+DASHBOARD_PAGE_SIZE = int(os.getenv("DASHBOARD_PAGE_SIZE", "5"))
+
+# Индекс полнотекстового поиска по диалогам (/search), база SQLite с FTS5
+SEARCH_FILE = os.getenv("SEARCH_FILE", os.path.join(DATA_DIR, "search.db"))
+
+# Назначение новых диалогов операторам: least_loaded - наименее загруженному, round_robin - по очереди,
+# broadcast - уведомление всем операторам (кто первым принял, тот и ведёт)
+ASSIGNMENT_POLICY = os.getenv("ASSIGNMENT_POLICY", "least_loaded").strip().lower()
+# Сколько диалогов (принятых и предложенных) может быть у оператора одновременно (0 - без ограничений)
+OPERATOR_CAPACITY = int(os.getenv("OPERATOR_CAPACITY", "5"))
+# Через сколько секунд непринятый диалог предлагается всем операторам
+ASSIGNMENT_TIMEOUT = float(os.getenv("ASSIGNMENT_TIMEOUT", "120"))
+# Навыки операторов "id:тег|тег,id:тег": тег - id раздела каталога верхнего уровня или поле "skill" узла.
+# Оператор без навыков получает диалоги любых разделов
+OPERATOR_SKILLS = parse_skills(os.getenv("OPERATOR_SKILLS", ""))
+# Оператор без отметки /online или /away считается на месте, если действовал в боте за последние N секунд
+OPERATOR_ACTIVE_WINDOW = float(os.getenv("OPERATOR_ACTIVE_WINDOW", "900"))
+
+# Сроки ответа на ожидающий диалог (сек, 0 - отключено): после первого диалог считается просроченным
+# и операторам приходит напоминание, после второго о нём сообщается админам
+SLA_PENDING_TIMEOUT = float(os.getenv("SLA_PENDING_TIMEOUT", "600"))
+SLA_ESCALATE_TIMEOUT = float(os.getenv("SLA_ESCALATE_TIMEOUT", "1800"))
+
+# Принятый диалог без сообщений дольше этого времени (сек) закрывается автоматически (0 - отключено)
+DIALOG_IDLE_TIMEOUT = float(os.getenv("DIALOG_IDLE_TIMEOUT", "86400"))
@@ -0,0 +1,25 @@
+"""Короткие идентификаторы диалогов.
+
+Новые диалоги нумеруются по порядку: "d" + номер в base36 (d1, d2, ..., dz, d10, ...). ID повторяется
+в индексах документа dialogs и в callback_data кнопок, поэтому короткий ID уменьшает и то и другое.
+ID старого вида dialog_<user>_<время> остаются действительными."""
+
+DIALOG_ID_PREFIX = "d"
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def format_dialog_id(number: int) -> str:
+    digits = ""
+    while True:
+        number, digit = divmod(number, 36)
+        digits = BASE36_DIGITS[digit] + digits
+        if not number:
+            return DIALOG_ID_PREFIX + digits
+
+
+def parse_dialog_id(dialog_id: str) -> int | str:
+    """Номер диалога для ID нового формата, остальные ID (dialog_<user>_<время>) возвращаются как есть"""
+    digits = dialog_id[len(DIALOG_ID_PREFIX):]
+    if dialog_id.startswith(DIALOG_ID_PREFIX) and digits and digits[0] != "0" and all(c in BASE36_DIGITS for c in digits):
+        return int(digits, 36)
+    return dialog_id
@@ -0,0 +1,65 @@
+"""Общие настройки тестов: бот работает с временным каталогом данных, запросы к Telegram не уходят в сеть"""
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+DATA_DIR = tempfile.mkdtemp(prefix="bot-tests-")
+os.environ.update(
+    DATA_DIR=DATA_DIR,
+    ENV_FILE=os.path.join(DATA_DIR, ".env"),
+    STORAGE_BACKEND="json",
+    ADMIN_IDS="1",
+    OPERATOR_IDS="2",
+    WEBHOOK_SECRET="test-secret",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Message, WebhookInfo
+
+import bot as bot_module
+
+
+class RecordingSession(BaseSession):
+    """Сессия вместо Bot API: запоминает вызванные методы и отвечает как Telegram"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.message_ids = itertools.count(1000)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        if method.__returning__ is Message:
+            return Message.model_validate({
+                "message_id": getattr(method, "message_id", None) or next(self.message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(getattr(method, "chat_id", 0) or 0), "type": "private"},
+                "text": getattr(method, "text", None) or "-"
+            }, context={"bot": bot})
+        if method.__returning__ is WebhookInfo:
+            webhooks = self.sent("SetWebhook")
+            return WebhookInfo(url=webhooks[-1].url if webhooks else "", has_custom_certificate=False, pending_update_count=0)
+        return True
+
+    def sent(self, method_name: str) -> list:
+        return [call for call in self.calls if type(call).__name__ == method_name]
+
+
+@pytest.fixture
+def telegram():
+    session = RecordingSession()
+    session.middleware = bot_module.bot.session.middleware
+    original, bot_module.bot.session = bot_module.bot.session, session
+    yield session
+    bot_module.bot.session = original
@@ -0,0 +1,30 @@
+import time
+
+from aiogram.types import Update
+
+import bot as bot_module
+
+
+def callback_update(data: str) -> Update:
+    return Update.model_validate({
+        "update_id": 1,
+        "callback_query": {
+            "id": "q1",
+            "chat_instance": "test",
+            "data": data,
+            "from": {"id": 500, "is_bot": False, "first_name": "Тест"},
+            "message": {
+                "message_id": 1, "date": int(time.time()), "text": "-",
+                "chat": {"id": 500, "type": "private"}
+            }
+        }
+    })
+
+
+def test_dialog_callbacks_are_replayed():
+    for data in ("continue_dialog", "chat_operator", bot_module.pack_callback("accept_dialog", "d1")):
+        assert not bot_module.is_stale_backlog_update(callback_update(data))
+
+
+def test_menu_navigation_is_dropped():
+    assert bot_module.is_stale_backlog_update(callback_update("back_to_menu"))
@@ -0,0 +1,56 @@
+import asyncio
+import time
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import CallbackQuery
+
+import bot as bot_module
+
+
+def press(data: str, user_id: int, message_id: int = 77) -> CallbackQuery:
+    return CallbackQuery.model_validate({
+        "id": f"q{time.perf_counter_ns()}",
+        "chat_instance": "test",
+        "data": data,
+        "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+        "message": {
+            "message_id": message_id, "date": int(time.time()), "text": "-",
+            "chat": {"id": user_id, "type": "private"}
+        }
+    }, context={"bot": bot_module.bot})
+
+
+def count_calls(monkeypatch, actions: list) -> list:
+    handled = []
+    for action in actions:
+        async def handler(callback, state, action=action):
+            handled.append(callback.data)
+        monkeypatch.setitem(bot_module.CALLBACK_ROUTES, action, handler)
+    return handled
+
+
+def run_presses(user_id: int, presses: list):
+    state = FSMContext(storage=MemoryStorage(), key=StorageKey(bot_id=1, chat_id=user_id, user_id=user_id))
+
+    async def scenario():
+        for data in presses:
+            await bot_module.route_callback(press(data, user_id), state)
+
+    asyncio.run(scenario())
+
+
+def test_back_then_forward_navigation_is_handled(telegram, monkeypatch):
+    handled = count_calls(monkeypatch, ["service", "back_to_menu", "dash"])
+    presses = ["service:patent", "back_to_menu", "service:patent", "dash:closed:5", "dash:closed:0", "dash:closed:5"]
+    run_presses(901, presses)
+    assert handled == presses
+
+
+def test_double_press_on_state_changing_button_is_dropped(telegram, monkeypatch):
+    handled = count_calls(monkeypatch, ["accept_dialog"])
+    data = bot_module.pack_callback("accept_dialog", "d1")
+    run_presses(902, [data, data])
+    assert handled == [data]
+    assert len(telegram.sent("AnswerCallbackQuery")) == 1
@@ -0,0 +1,37 @@
+import asyncio
+
+import bot as bot_module
+
+LONG_ID = "service_" + "x" * bot_module.CATALOG_ID_MAX_BYTES
+
+CATALOG = {
+    bot_module.CATALOG_ROOT: {"children": [["patent", "вид_на_жительство"], [LONG_ID]]},
+    "patent": {"title": "Патент"},
+    "вид_на_жительство": {"title": "ВНЖ", "children": [["renewal"]]},
+    "renewal": {"title": "Продление"},
+    LONG_ID: {"title": "Длинный раздел"},
+}
+
+
+def test_invalid_ids_are_mapped_to_short_tokens():
+    nodes = bot_module.build_catalog_index(CATALOG)
+    assert all(bot_module.valid_catalog_id(node_id) for node_id in nodes)
+    assert len(nodes) == len(CATALOG)
+
+    root_ids = [child_id for row in nodes[bot_module.CATALOG_ROOT]["children"] for child_id in row]
+    titles = [nodes[child_id]["title"] for child_id in root_ids]
+    assert titles == ["Патент", "ВНЖ", "Длинный раздел"]
+
+    residence = nodes[root_ids[1]]
+    assert residence["text_key"] == "service_вид_на_жительство"
+    assert nodes["renewal"]["parent"] == residence["id"]
+
+
+def test_keyboards_are_built_for_invalid_ids():
+    nodes = bot_module.build_catalog_index(CATALOG)
+    texts = asyncio.run(bot_module.load_texts())
+    for node in nodes.values():
+        keyboard = bot_module.build_catalog_keyboard(nodes, node, texts, bot_module.DEFAULT_LOCALE)
+        for row in keyboard.inline_keyboard:
+            for button in row:
+                assert bot_module.unpack_callback(button.callback_data)[0] in bot_module.CALLBACK_ROUTES
@@ -0,0 +1,27 @@
+import asyncio
+
+import bot as bot_module
+
+
+def pending_buttons(viewer_id: int) -> set:
+    text, keyboard = bot_module.render_dashboard(asyncio.run(bot_module.load_dialogs()), viewer_id, "pending")
+    return {bot_module.unpack_callback(button.callback_data)[0] for row in keyboard.inline_keyboard for button in row}
+
+
+def test_pending_delete_button_is_admin_only(telegram):
+    dialog_id = asyncio.run(bot_module.create_dialog(601, "Тест", "+79990000000", "", []))
+    try:
+        assert "delete_dialog" in pending_buttons(1)
+        operator_buttons = pending_buttons(2)
+        assert "accept_dialog" in operator_buttons and "delete_dialog" not in operator_buttons
+    finally:
+        asyncio.run(bot_module.delete_dialog(dialog_id))
+
+
+def test_phone_is_escaped(telegram):
+    dialog_id = asyncio.run(bot_module.create_dialog(602, "Тест", "+7<i>999</i>", "", []))
+    try:
+        text, _ = bot_module.render_dashboard(asyncio.run(bot_module.load_dialogs()), 1, "pending")
+        assert "<i>" not in text and "&lt;i&gt;999&lt;/i&gt;" in text
+    finally:
+        asyncio.run(bot_module.delete_dialog(dialog_id))
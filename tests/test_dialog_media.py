@@ -0,0 +1,32 @@
+import asyncio
+import time
+
+from aiogram.types import Update
+
+import bot as bot_module
+
+
+def photo_update(user_id: int) -> Update:
+    return Update.model_validate({
+        "update_id": 1,
+        "message": {
+            "message_id": 55, "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+            "photo": [{"file_id": "photo-file", "file_unique_id": "photo-unique", "width": 90, "height": 90}],
+            "caption": "паспорт"
+        }
+    })
+
+
+def test_photo_outside_dialog_state_reaches_dialog(telegram):
+    user_id = 611
+    dialog_id = asyncio.run(bot_module.create_dialog(user_id, "Тест", "+79990000001", "", []))
+    try:
+        # Пользователь не в состоянии in_dialog (например, после "Назад" или перезапуска)
+        asyncio.run(bot_module.dp.feed_update(bot_module.bot, photo_update(user_id)))
+        dialog = asyncio.run(bot_module.load_dialogs())["dialogs"][dialog_id]
+        assert [message["text"] for message in dialog["messages"]] == ["паспорт"]
+        assert dialog["messages"][0].get("media")
+    finally:
+        asyncio.run(bot_module.delete_dialog(dialog_id))
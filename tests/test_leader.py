@@ -0,0 +1,52 @@
+import asyncio
+import contextlib
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+import bot as bot_module
+
+
+def broadcast(run_date: str) -> dict:
+    return {"chat_id": 1, "message_id": 10, "run_date": run_date, "status": "pending"}
+
+
+async def run_election(monkeypatch) -> AsyncIOScheduler:
+    scheduler = AsyncIOScheduler()
+    monkeypatch.setattr(bot_module, "scheduler", scheduler)
+    monkeypatch.setattr(bot_module, "leader_tasks", [])
+    monkeypatch.setattr(bot_module, "LEADER_LEASE_TTL", 0.06)
+    scheduler.start(paused=True)
+    bot_module.init_leases()
+    election = asyncio.create_task(bot_module.leader_election_loop())
+    await asyncio.sleep(0.1)
+    assert bot_module.is_leader and not election.done()
+    election.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await election
+    scheduler.shutdown(wait=False)
+    return scheduler
+
+
+def test_bad_scheduled_entry_does_not_stop_election(monkeypatch):
+    run_date = (datetime.now() + timedelta(days=1)).isoformat()
+    asyncio.run(bot_module.save_scheduled_broadcasts({"bad": broadcast("завтра"), "good": broadcast(run_date)}))
+    jobs = []
+
+    async def scenario():
+        scheduler = await run_election(monkeypatch)
+        jobs.extend(job.id for job in scheduler.get_jobs())
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        asyncio.run(bot_module.save_scheduled_broadcasts({}))
+    assert jobs == ["good"]
+
+
+def test_failed_promotion_keeps_leadership(monkeypatch):
+    async def broken_sync():
+        raise RuntimeError("хранилище недоступно")
+
+    monkeypatch.setattr(bot_module, "sync_scheduled_broadcasts", broken_sync)
+    asyncio.run(run_election(monkeypatch))
@@ -0,0 +1,35 @@
+import asyncio
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import User
+
+import bot as bot_module
+
+
+def test_render_text_keeps_placeholders_with_bad_format():
+    texts = {"greeting": "{name:d}, {name:{width}}, {count:>3}, {missing}"}
+    rendered = bot_module.render_text(texts, "greeting", bot_module.DEFAULT_LOCALE, "", name="Анна", count=5)
+    assert rendered == "{name:d}, {name:{width}},   5, {missing}"
+
+
+def test_locale_cache_expires_and_is_bounded(monkeypatch):
+    storage = MemoryStorage()
+    user = User(id=801, is_bot=False, first_name="Тест", language_code="ru")
+    state = FSMContext(storage=storage, key=StorageKey(bot_id=1, chat_id=user.id, user_id=user.id))
+
+    async def scenario():
+        await bot_module.set_user_locale(user.id, state, "uz")
+        assert await bot_module.get_user_locale(user, state) == "uz"
+        # Язык сменили в другом процессе: запись в кэше подхватит его после истечения
+        await storage.set_data(bot_module.locale_storage_key(state), {"locale": "tg"})
+        assert await bot_module.get_user_locale(user, state) == "uz"
+        monkeypatch.setattr(bot_module, "LOCALE_CACHE_TTL", -1)
+        assert await bot_module.get_user_locale(user, state) == "tg"
+
+    asyncio.run(scenario())
+    monkeypatch.setattr(bot_module, "LOCALE_CACHE_LIMIT", 3)
+    for user_id in range(900, 910):
+        bot_module.remember_user_locale(user_id, None, 0)
+    assert list(bot_module.user_locales) == [907, 908, 909]
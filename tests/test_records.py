@@ -0,0 +1,13 @@
+from records import format_dialog_id, parse_dialog_id
+
+
+def test_dialog_id_round_trip():
+    for number in (1, 35, 36, 1295, 1296, 10 ** 9):
+        dialog_id = format_dialog_id(number)
+        assert dialog_id.startswith("d") and parse_dialog_id(dialog_id) == number
+    assert format_dialog_id(36) == "d10"
+
+
+def test_other_ids_are_returned_as_is():
+    for dialog_id in ("dialog_500_1700000000", "d", "d0", "d01", "dA", "dx-1"):
+        assert parse_dialog_id(dialog_id) == dialog_id
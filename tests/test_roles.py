@@ -0,0 +1,28 @@
+import os
+
+import bot as bot_module
+
+
+def write_env(text: str):
+    with open(bot_module.ENV_FILE, "w", encoding="utf-8") as f:
+        f.write(text)
+    # Время изменения может совпасть с прошлой записью, поэтому перечитываем принудительно
+    os.utime(bot_module.ENV_FILE)
+
+
+def test_removed_ids_lose_access_after_reload(monkeypatch):
+    # Так окружение выглядит после load_dotenv, если при запуске в .env был ADMIN_IDS=1,9
+    monkeypatch.setenv("ADMIN_IDS", "1,9")
+    try:
+        write_env("ADMIN_IDS=1,9\nOPERATOR_IDS=2,8\n")
+        assert bot_module.reload_roles(force=True)
+        assert bot_module.is_admin(9) and bot_module.is_operator(8)
+
+        # Ключ ADMIN_IDS удалён из файла: значение берётся из окружения до загрузки .env
+        write_env("OPERATOR_IDS=2\n")
+        assert bot_module.reload_roles(force=True)
+        assert not bot_module.is_admin(9) and not bot_module.is_operator(8)
+        assert bot_module.roles["admins"] == {1} and bot_module.roles["operators"] == {2}
+    finally:
+        os.remove(bot_module.ENV_FILE)
+        bot_module.reload_roles(force=True)
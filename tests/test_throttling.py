@@ -0,0 +1,37 @@
+import asyncio
+import time
+
+from aiogram.types import Update, User
+
+import bot as bot_module
+
+
+def message_update(number: int, user_id: int) -> Update:
+    return Update.model_validate({
+        "update_id": number,
+        "message": {
+            "message_id": number, "date": int(time.time()), "text": f"сообщение {number}",
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Тест"}
+        }
+    })
+
+
+async def count_handled(user_id: int, **extra) -> int:
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event.update_id)
+
+    user = User(id=user_id, is_bot=False, first_name="Тест")
+    for number in range(1, bot_module.THROTTLE_MESSAGE_BURST + 6):
+        await bot_module.throttling_middleware(handler, message_update(number, user_id), {"event_from_user": user, **extra})
+    return len(handled)
+
+
+def test_message_burst_is_throttled():
+    assert asyncio.run(count_handled(701)) == bot_module.THROTTLE_MESSAGE_BURST
+
+
+def test_backlog_replay_is_not_throttled():
+    assert asyncio.run(count_handled(702, backlog=True)) == bot_module.THROTTLE_MESSAGE_BURST + 5
@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import bot as bot_module
+from config import WEBHOOK_PATH
+
+
+def start_update(update_id: int, user_id: int = 500) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}]
+        }
+    }
+
+
+async def post_update(update: dict, headers: dict) -> int:
+    async with TestClient(TestServer(bot_module.create_webhook_app())) as client:
+        response = await client.post(WEBHOOK_PATH, json=update, headers=headers)
+        # Обновление обрабатывается в фоне - даём обработчику отправить ответ
+        for _ in range(100):
+            if response.status != 200 or bot_module.bot.session.sent("SendMessage"):
+                break
+            await asyncio.sleep(0.02)
+        return response.status
+
+
+def test_update_with_secret_is_handled(telegram):
+    status = asyncio.run(post_update(start_update(1), {"X-Telegram-Bot-Api-Secret-Token": "test-secret"}))
+    assert status == 200
+    assert [call.chat_id for call in telegram.sent("SendMessage")] == [500]
+
+
+def test_update_without_valid_secret_is_rejected(telegram):
+    assert asyncio.run(post_update(start_update(2), {})) in (401, 403)
+    assert asyncio.run(post_update(start_update(3), {"X-Telegram-Bot-Api-Secret-Token": "wrong"})) in (401, 403)
+    assert telegram.calls == []
+
+
+def test_webhook_is_registered_once_with_shared_storage(telegram, monkeypatch):
+    monkeypatch.setattr(bot_module, "STORAGE_BACKEND", "sqlite")
+    monkeypatch.setattr(bot_module, "WEBHOOK_URL", "https://bot.example.com")
+    bot_module.init_db()
+    for _ in range(3):
+        asyncio.run(bot_module.register_webhook())
+    webhooks = telegram.sent("SetWebhook")
+    assert len(webhooks) == 1 and not webhooks[0].drop_pending_updates